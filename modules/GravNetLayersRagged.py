@@ -1433,10 +1433,73 @@ class MultiBackScatterOrGather(tf.keras.layers.Layer):
 ############# Local clustering section ends
 
 
+class KnnGraphCache(object):
+    def __init__(self, max_entries=16):
+        """
+
+        Cache for exact kNN results (BinnedSelectKnn), keyed on the identity of the
+        coordinate and row split tensors and the radius. A request for K neighbours
+        can be served from an entry with at least K neighbours: the closest K are
+        selected (self stays first), their order can differ from a direct query.
+
+        Entries keep references to the tensors they were computed from, such that
+        an identity match is never a reused id. The oldest entries are dropped
+        when more than max_entries are stored.
+        Hits and misses are counted in self.hits and self.misses.
+        """
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, coordinates, row_splits, radius):
+        return (id(coordinates), id(row_splits), float(radius))
+
+    def _matches(self, entry, coordinates, row_splits):
+        return entry['coordinates'] is coordinates and entry['row_splits'] is row_splits
+
+    def lookup(self, coordinates, row_splits, n_neighbours, radius):
+        '''
+        returns idx, dist with n_neighbours columns (incl. self) or None, None
+        '''
+        entry = self.entries.get(self._key(coordinates, row_splits, radius))
+        if (entry is None or not self._matches(entry, coordinates, row_splits)
+            or entry['n_neighbours'] < n_neighbours):
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        if entry['n_neighbours'] == n_neighbours:
+            return entry['idx'], entry['dist']
+        #the kNN output is not sorted by distance, -1 (no neighbour) goes last
+        idx, dist = entry['idx'], entry['dist']
+        sort_dist = tf.where(idx < 0, float('inf'), dist)
+        sel = tf.argsort(sort_dist, axis=1, stable=True)[:,:n_neighbours]
+        return tf.gather(idx, sel, batch_dims=1), tf.gather(dist, sel, batch_dims=1)
+
+    def insert(self, coordinates, row_splits, n_neighbours, radius, idx, dist):
+        key = self._key(coordinates, row_splits, radius)
+        entry = self.entries.pop(key, None)
+        if (entry is not None and self._matches(entry, coordinates, row_splits)
+            and entry['n_neighbours'] > n_neighbours):
+            self.entries[key] = entry #keep the larger one
+            return
+        self.entries[key] = {'coordinates': coordinates, 'row_splits': row_splits,
+                             'n_neighbours': n_neighbours, 'idx': idx, 'dist': dist}
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    def clear(self):
+        self.entries = {}
+
+#shared by all KNN layers with use_graph_cache=True
+knn_graph_cache = KnnGraphCache()
+
+
 class KNN(LayerWithMetrics):
     def __init__(self,K: int, radius=-1., 
                  use_approximate_knn=False,
                  min_bins=None,
+                 use_graph_cache=False,
                  **kwargs):
         """
         
@@ -1452,12 +1515,16 @@ class KNN(LayerWithMetrics):
         :param radius: maximum distance of nearest neighbours,
                        can also contain the keyword 'dynamic'
         :param use_approximate_knn: use approximate kNN method (SlicingKnn) instead of exact method (SelectKnn)
+        :param use_graph_cache: share results with other KNN layers on the same coordinate and row split
+                                tensors through knn_graph_cache (exact kNN with fixed radius only).
+                                Records the metric <name>_graph_cache_hit if record_metrics is set.
         """
         super(KNN, self).__init__(**kwargs) 
         self.K = K
         
         self.use_approximate_knn = use_approximate_knn
         self.min_bins = min_bins
+        self.use_graph_cache = use_graph_cache
         
         if isinstance(radius,int):
             radius=float(radius)
@@ -1475,7 +1542,8 @@ class KNN(LayerWithMetrics):
         config = {'K': self.K,
                   'radius': self.radius,
                   'min_bins':self.min_bins,
-                  'use_approximate_knn': self.use_approximate_knn}
+                  'use_approximate_knn': self.use_approximate_knn,
+                  'use_graph_cache': self.use_graph_cache}
         base_config = super(KNN, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
@@ -1510,9 +1578,22 @@ class KNN(LayerWithMetrics):
         updated_radius = tf.keras.backend.in_train_phase(update,self.dynamic_radius,training=training)
         tf.keras.backend.update(self.dynamic_radius,updated_radius)
         
+    def cached_call(self, coordinates, row_splits):
+        idx,dist = knn_graph_cache.lookup(coordinates, row_splits, self.K+1, self.radius)
+        hit = idx is not None
+        if not hit:
+            idx,dist,_ = KNN.raw_call(coordinates, row_splits, self.K, 
+                                      self.radius, False, self.min_bins)
+            knn_graph_cache.insert(coordinates, row_splits, self.K+1, self.radius, idx, dist)
+        self.add_prompt_metric(float(hit),self.name+'_graph_cache_hit')
+        return idx,dist
+        
     def call(self, inputs, training=None):
         coordinates, row_splits = inputs
         idx,dist = None, None
+        #approximate and dynamic radius results depend on more than the inputs
+        if self.use_graph_cache and not self.use_approximate_knn and self.dynamic_radius is None:
+            return self.cached_call(coordinates, row_splits)
         if self.dynamic_radius is None:
             idx,dist,nbins = KNN.raw_call(coordinates, row_splits, self.K, 
                                           self.radius, self.use_approximate_knn,
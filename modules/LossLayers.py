@@ -730,6 +730,9 @@ class LLFullObjectCondensation(LossLayerBase):
                  super_attraction=False,
                  div_repulsion=False,
                  dynamic_payload_scaling_onset=-0.005,
+                 knn_repulsion_k=-1,
+                 knn_repulsion_radius=-1.,
+                 batched_oc_loss=False,
                  **kwargs):
         """
         Read carefully before changing parameters
@@ -767,6 +770,10 @@ class LLFullObjectCondensation(LossLayerBase):
         :param standard_configuration:
         :param alt_energy_loss: introduces energy loss with very mild gradient for large delta. (modified 1-exp form)
         :param dynamic_payload_scaling_onset: only apply payload loss to well reconstructed showers. typical values 0.1 (negative=off)
+        :param knn_repulsion_k: only evaluate the repulsive potential for this number of nearest neighbours 
+                                of each condensation point (-1: all vertices)
+        :param knn_repulsion_radius: maximum distance of these neighbours in the clustering space (-1: no limit)
+        :param batched_oc_loss: compute the object condensation terms for all row splits in one pass
         :param kwargs:
         """
         if 'dynamic' in kwargs:
@@ -785,10 +792,13 @@ class LLFullObjectCondensation(LossLayerBase):
         #configuration here, no need for all that stuff below 
         #as far as the OC part is concerned (still config for payload though)
         self.oc_loss_object = OC_loss(
+            batched=batched_oc_loss,
             q_min= q_min,
                  s_b=s_b,
                  use_mean_x=use_average_cc_pos,
-                 spect_supp=1.
+                 spect_supp=1.,
+                 knn_repulsion_k=knn_repulsion_k,
+                 knn_repulsion_radius=knn_repulsion_radius
             )
         #### the latter needs to be cleaned up
 
@@ -838,6 +848,9 @@ class LLFullObjectCondensation(LossLayerBase):
         self.div_repulsion=div_repulsion
         self.dynamic_payload_scaling_onset = dynamic_payload_scaling_onset
         self.alt_energy_weight = alt_energy_weight
+        self.knn_repulsion_k = knn_repulsion_k
+        self.knn_repulsion_radius = knn_repulsion_radius
+        self.batched_oc_loss = batched_oc_loss
         self.loc_time=time.time()
         self.call_count=0
         
@@ -1165,7 +1178,10 @@ class LLFullObjectCondensation(LossLayerBase):
             'energy_weighted_qmin': self.energy_weighted_qmin,
             'super_attraction':self.super_attraction,
             'div_repulsion' : self.div_repulsion,
-            'dynamic_payload_scaling_onset': self.dynamic_payload_scaling_onset
+            'dynamic_payload_scaling_onset': self.dynamic_payload_scaling_onset,
+            'knn_repulsion_k': self.knn_repulsion_k,
+            'knn_repulsion_radius': self.knn_repulsion_radius,
+            'batched_oc_loss': self.batched_oc_loss
         }
         base_config = super(LLFullObjectCondensation, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+from scipy.spatial import cKDTree
 
 
 def reconstruct_showers_cond_op(cc, beta, beta_threshold=0.5, dist_threshold=0.5, limit=500, return_alpha_indices=False,
@@ -95,6 +96,177 @@ def reconstruct_showers_no_op(cc, beta, beta_threshold=0.5, dist_threshold=0.5,
     return pred_sid[:, np.newaxis], alpha_indices
 
 
+def reconstruct_showers_kdtree(cc, beta, beta_threshold=0.5, dist_threshold=0.5, pred_dist=None, max_hits_per_shower=-1):
+    """
+    Same clustering as reconstruct_showers_no_op, but only visits hits in the neighbourhood of each
+    condensation point using a KD-tree over the clustering coordinates. Does not require the compiled ops.
+
+    :param cc: clustering coordinates, shape [N, C]
+    :param beta: beta values, shape [N, 1]
+    :param pred_dist: local distance scaling, shape [N, 1] or None
+    :return: pred_sid with shape [N, 1], list of alpha indices
+    """
+    beta = beta[:, 0]
+    pred_dist = None if pred_dist is None else pred_dist[:, 0]
+    pred_sid = np.full(len(beta), -1, dtype=np.int32)
+
+    # candidates in order of decreasing beta (stable: same tie breaking as argmax)
+    candidates = np.argwhere(beta > beta_threshold)[:, 0]
+    candidates = candidates[np.argsort(-beta[candidates], kind='stable')]
+    is_candidate = np.zeros(len(beta), dtype=bool)
+    is_candidate[candidates] = True
+
+    tree = cKDTree(cc)
+    alpha_indices = []
+
+    for alpha_index in candidates:
+        if not is_candidate[alpha_index]:
+            continue
+        cc_alpha = cc[alpha_index]
+        this_threshold = dist_threshold * (1 if pred_dist is None else pred_dist[alpha_index])
+        search_radius = this_threshold if max_hits_per_shower == -1 else max(this_threshold, dist_threshold)
+
+        # slightly enlarged radius, the exact selection is done on the distances below
+        neighbours = np.array(tree.query_ball_point(cc_alpha, r=search_radius * (1. + 1e-5) + 1e-7), dtype=np.int64)
+        dists = np.sqrt(np.sum((cc[neighbours] - cc_alpha) ** 2, axis=-1))
+
+        if max_hits_per_shower != -1:
+            free = np.logical_and(dists <= dist_threshold, pred_sid[neighbours] == -1)
+            picked = neighbours[free][np.argsort(dists[free], kind='stable')[:max_hits_per_shower]]
+            pred_sid[picked] = len(alpha_indices)
+        else:
+            pred_sid[neighbours[np.logical_and(dists < this_threshold, pred_sid[neighbours] == -1)]] = len(alpha_indices)
+
+        is_candidate[neighbours[dists < this_threshold]] = False
+        is_candidate[alpha_index] = False
+        alpha_indices.append(alpha_index)
+
+    return pred_sid[:, np.newaxis], alpha_indices
+
+
+class ShowerThresholdSweep():
+    def __init__(self, cc, beta, pred_dist=None, assign_to_closest=False):
+        """
+        Clusters one endcap for many (beta_threshold, distance_threshold) points, reusing the work
+        that does not depend on the thresholds: the candidates are sorted by beta once, the KD-tree is
+        built once and the neighbours (with their distances in clustering space) of every condensation
+        point are queried once and cached for all points.
+
+        Without assign_to_closest the showers are the same as the ones of reconstruct_showers_kdtree.
+        With assign_to_closest, each hit is assigned to the closest condensation point in (scaled)
+        clustering space like reconstruct_showers (BuildAndAssignCondensates) does, and the alpha
+        indices are in increasing order. Differences to the compiled op can only come from rounding
+        for hits exactly at the threshold.
+
+        :param cc: clustering coordinates, shape [N, C]
+        :param beta: beta values, shape [N, 1]
+        :param pred_dist: local distance scaling, shape [N, 1] or None
+        """
+        self.cc = cc
+        self.beta = beta[:, 0]
+        self.pred_dist = None if pred_dist is None else pred_dist[:, 0]
+        self.assign_to_closest = assign_to_closest
+
+        # all hits in order of decreasing beta, the candidates for any beta threshold are a prefix
+        self.order = np.argsort(-self.beta, kind='stable')
+        self.sorted_neg_beta = -self.beta[self.order]
+        self.tree = None
+        self.neighbours = dict()
+
+    def _get_neighbours(self, alpha_index, max_dist_threshold):
+        """
+        :return: neighbours of alpha_index and their distances, sorted by distance, at least up to
+                 max_dist_threshold (scaled by the local distance scaling)
+        """
+        cached = self.neighbours.get(alpha_index)
+        if cached is not None and cached[0] >= max_dist_threshold:
+            return cached[1], cached[2]
+        if self.tree is None:
+            self.tree = cKDTree(self.cc)
+        cc_alpha = self.cc[alpha_index]
+        search_radius = max_dist_threshold * (1 if self.pred_dist is None else self.pred_dist[alpha_index])
+        neighbours = np.array(self.tree.query_ball_point(cc_alpha, r=search_radius * (1. + 1e-5) + 1e-7), dtype=np.int64)
+        dists = np.sqrt(np.sum((self.cc[neighbours] - cc_alpha) ** 2, axis=-1))
+        sorting = np.argsort(dists, kind='stable')
+        neighbours, dists = neighbours[sorting], dists[sorting]
+        self.neighbours[alpha_index] = (max_dist_threshold, neighbours, dists)
+        return neighbours, dists
+
+    def _n_candidates(self, beta_threshold):
+        # number of hits with beta > beta_threshold
+        return np.searchsorted(self.sorted_neg_beta, -beta_threshold, side='left')
+
+    def _assign_to_closest(self, alpha_indices, dist_threshold):
+        pred_sid = np.full(len(self.beta), -1, dtype=np.int32)
+        alpha_indices = sorted(alpha_indices)
+        hits, scaled_dists, sids = [], [], []
+        for sid, alpha_index in enumerate(alpha_indices):
+            neighbours, dists = self._get_neighbours(alpha_index, dist_threshold)
+            this_threshold = dist_threshold * (1 if self.pred_dist is None else self.pred_dist[alpha_index])
+            n = np.searchsorted(dists, this_threshold, side='left')
+            hits.append(neighbours[:n])
+            scaled_dists.append(dists[:n] / (1 if self.pred_dist is None else self.pred_dist[alpha_index]))
+            sids.append(np.full(n, sid, dtype=np.int32))
+        if len(alpha_indices):
+            hits, scaled_dists, sids = np.concatenate(hits), np.concatenate(scaled_dists), np.concatenate(sids)
+            # closest condensation point first for every hit, lowest alpha index for equal distances
+            sorting = np.lexsort((sids, scaled_dists, hits))
+            hits, sids = hits[sorting], sids[sorting]
+            first = np.ones(len(hits), dtype=bool)
+            first[1:] = hits[1:] != hits[:-1]
+            pred_sid[hits[first]] = sids[first]
+        return pred_sid[:, np.newaxis], alpha_indices
+
+    def sweep(self, thresholds):
+        """
+        :param thresholds: list of (beta_threshold, distance_threshold)
+        :return: list of (pred_sid with shape [N, 1], list of alpha indices), one per point in thresholds
+        """
+        results = [None] * len(thresholds)
+        max_dist_threshold = max([d for _, d in thresholds]) if len(thresholds) else 0.
+
+        by_distance = dict()
+        for i, (b, d) in enumerate(thresholds):
+            by_distance.setdefault(d, []).append(i)
+
+        for dist_threshold, point_indices in by_distance.items():
+            # the clustering for a lower beta threshold continues the one for a higher threshold
+            # with the additional candidates, so all beta thresholds are done in one pass
+            point_indices = sorted(point_indices, key=lambda i: -thresholds[i][0])
+            pred_sid = np.full(len(self.beta), -1, dtype=np.int32)
+            is_candidate = np.ones(len(self.beta), dtype=bool)
+            alpha_indices = []
+            done = 0
+            for i in point_indices:
+                n_candidates = self._n_candidates(thresholds[i][0])
+                for alpha_index in self.order[done:n_candidates]:
+                    if not is_candidate[alpha_index]:
+                        continue
+                    neighbours, dists = self._get_neighbours(alpha_index, max_dist_threshold)
+                    this_threshold = dist_threshold * (1 if self.pred_dist is None else self.pred_dist[alpha_index])
+                    neighbours = neighbours[:np.searchsorted(dists, this_threshold, side='left')]
+
+                    pred_sid[neighbours[pred_sid[neighbours] == -1]] = len(alpha_indices)
+                    is_candidate[neighbours] = False
+                    is_candidate[alpha_index] = False
+                    alpha_indices.append(alpha_index)
+                done = max(done, n_candidates)
+
+                if self.assign_to_closest:
+                    results[i] = self._assign_to_closest(alpha_indices, dist_threshold)
+                else:
+                    results[i] = (pred_sid.copy()[:, np.newaxis], list(alpha_indices))
+        return results
+
+    def cluster(self, beta_threshold, distance_threshold):
+        """
+        Single point, still using the cached neighbours of previous calls.
+
+        :return: pred_sid with shape [N, 1], list of alpha indices
+        """
+        return self.sweep([(beta_threshold, distance_threshold)])[0]
+
+
 class OCHits2Showers():
     def __init__(self, beta_threshold, distance_threshold, is_soft, with_local_distance_scaling, op):
         self.beta_threshold = beta_threshold
@@ -103,6 +275,14 @@ class OCHits2Showers():
         self.with_local_distance_scaling = with_local_distance_scaling
         self.op = op
 
+    def get_config(self):
+        """:return: the constructor arguments, with the current beta and distance thresholds"""
+        return {'beta_threshold': self.beta_threshold,
+                'distance_threshold': self.distance_threshold,
+                'is_soft': self.is_soft,
+                'with_local_distance_scaling': self.with_local_distance_scaling,
+                'op': self.op}
+
     def set_beta_threshold(self, beta_threshold):
         self.beta_threshold = beta_threshold
 
@@ -123,20 +303,42 @@ class OCHits2Showers():
                                                                   self.distance_threshold,
                                                                   pred_dist=pred_dict['pred_dist'] if self.with_local_distance_scaling else None)
         else:
-            pred_sid, pred_shower_alpha_idx = reconstruct_showers_no_op(pred_dict['pred_ccoords'],
-                                                                  pred_dict['pred_beta'],
-                                                                  self.beta_threshold,
-                                                                  self.distance_threshold,
-                                                                  pred_dist=pred_dict['pred_dist'] if self.with_local_distance_scaling else None)
+            pred_sid, pred_shower_alpha_idx = reconstruct_showers_kdtree(pred_dict['pred_ccoords'],
+                                                                         pred_dict['pred_beta'],
+                                                                         self.beta_threshold,
+                                                                         self.distance_threshold,
+                                                                         pred_dist=pred_dict['pred_dist'] if self.with_local_distance_scaling else None)
+
+        return self._process_showers(features_dict, pred_dict, pred_sid, pred_shower_alpha_idx)
 
+    def call_sweep(self, features_dict, pred_dict, thresholds):
+        """
+        Same as call for every (beta_threshold, distance_threshold) point in thresholds, but the
+        clustering work that does not depend on the thresholds is only done once (see ShowerThresholdSweep).
+        The beta and distance thresholds of this object are not changed.
+
+        :return: list of (processed_pred_dict, pred_shower_alpha_idx), one per point in thresholds
+        """
+        sweep = ShowerThresholdSweep(pred_dict['pred_ccoords'],
+                                     pred_dict['pred_beta'],
+                                     pred_dist=pred_dict['pred_dist'] if self.with_local_distance_scaling else None,
+                                     assign_to_closest=self.op)
+        return [self._process_showers(features_dict, pred_dict, pred_sid, pred_shower_alpha_idx)
+                for pred_sid, pred_shower_alpha_idx in sweep.sweep(thresholds)]
+
+    def _process_showers(self, features_dict, pred_dict, pred_sid, pred_shower_alpha_idx):
         processed_pred_dict = dict()
         processed_pred_dict['pred_sid'] = pred_sid
-        processed_pred_dict['pred_energy'] = np.zeros_like(processed_pred_dict['pred_sid'], np.float)
-
-        for idx in pred_shower_alpha_idx:
-            filter = (processed_pred_dict['pred_sid']==pred_sid[idx])[:,0]
-            processed_pred_dict['pred_energy'][filter] \
-                = np.sum(pred_dict['pred_energy_corr_factor'][filter] * features_dict['recHitEnergy'][filter])
+        processed_pred_dict['pred_energy'] = np.zeros_like(processed_pred_dict['pred_sid'], np.float64)
+
+        # sum the corrected energies per shower in one pass instead of masking per shower.
+        # pred_sid is the position of the shower in pred_shower_alpha_idx, -1 for unassigned hits.
+        # a condensation point is not always part of its own shower (e.g. zero distance threshold)
+        sid = pred_sid[:, 0]
+        assigned = sid >= 0
+        hit_energy = (pred_dict['pred_energy_corr_factor'] * features_dict['recHitEnergy'])[:, 0]
+        shower_energy = np.bincount(sid[assigned], weights=hit_energy[assigned], minlength=len(pred_shower_alpha_idx))
+        processed_pred_dict['pred_energy'][assigned, 0] = shower_energy[sid[assigned]]
         processed_pred_dict['pred_energy_unc'] \
             = 0.5*(pred_dict['pred_energy_high_quantile']-pred_dict['pred_energy_low_quantile'])
 
@@ -58,6 +58,62 @@ def calculate_iou_tf(truth_sid,
             return overlap_matrix
 
 
+def _shower_index(sid, shower_sid):
+    """
+    Maps the shower id of each hit to the index of this shower in shower_sid, or -1 if not found
+    """
+    sid = np.asarray(sid).astype(np.int64)
+    shower_sid = np.asarray(shower_sid).astype(np.int64)
+    if len(shower_sid) == 0:
+        return np.full(len(sid), -1, dtype=np.int64)
+    order = np.argsort(shower_sid, kind='stable')
+    sorted_sid = shower_sid[order]
+    pos = np.minimum(np.searchsorted(sorted_sid, sid), len(sorted_sid) - 1)
+    return np.where(sorted_sid[pos] == sid, order[pos], -1)
+
+
+def calculate_iou_sparse(truth_sid,
+                         pred_sid,
+                         truth_shower_sid,
+                         pred_shower_sid,
+                         hit_weight, return_all=False):
+    """
+    Same as calculate_iou_tf, but only accumulates the weights of the (pred, truth) pairs that
+    actually occur in the hits instead of building dense hits x showers one-hot matrices.
+    Memory and time scale with the number of hits plus the size of the returned matrices.
+
+    :return: overlap matrix [n_pred, n_truth] and, if return_all, also the pred sum, truth sum and
+             intersection matrices (same shapes) as numpy arrays
+    """
+    n_pred = len(pred_shower_sid)
+    n_truth = len(truth_shower_sid)
+    hit_weight = np.asarray(hit_weight, dtype=np.float64)
+
+    pred_idx = _shower_index(pred_sid, pred_shower_sid)
+    truth_idx = _shower_index(truth_sid, truth_shower_sid)
+
+    in_pred = pred_idx >= 0
+    in_truth = truth_idx >= 0
+    both = np.logical_and(in_pred, in_truth)
+
+    pred_sum = np.bincount(pred_idx[in_pred], weights=hit_weight[in_pred], minlength=n_pred)
+    truth_sum = np.bincount(truth_idx[in_truth], weights=hit_weight[in_truth], minlength=n_truth)
+    intersection_sum_matrix = np.bincount(pred_idx[both] * n_truth + truth_idx[both], weights=hit_weight[both],
+                                          minlength=n_pred * n_truth).reshape((n_pred, n_truth))
+
+    union_sum_matrix = pred_sum[:, np.newaxis] + truth_sum[np.newaxis, :] - intersection_sum_matrix
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlap_matrix = intersection_sum_matrix / union_sum_matrix
+
+    if return_all:
+        pred_sum_matrix = np.repeat(pred_sum[:, np.newaxis], n_truth, axis=1)
+        truth_sum_matrix = np.repeat(truth_sum[np.newaxis, :], n_pred, axis=0)
+        return overlap_matrix, pred_sum_matrix, truth_sum_matrix, intersection_sum_matrix
+    else:
+        return overlap_matrix
+
+
 def angle(p, t):
     t = np.array([t['x'], t['y'], t['z']])
     p = np.array([p['dep_x'], p['dep_y'], p['dep_z']])
@@ -79,6 +135,13 @@ class ShowersMatcher:
         self.de_e_cut=de_e_cut
         self.angle_cut=angle_cut
 
+    def get_config(self):
+        """:return: the constructor arguments"""
+        return {'match_mode': self.match_mode,
+                'iou_threshold': self.iou_threshold,
+                'de_e_cut': self.de_e_cut,
+                'angle_cut': self.angle_cut}
+
 
     def set_inputs(self, features_dict, truth_dict, predictions_dict, pred_alpha_idx):
         self.features_dict = features_dict.copy()
@@ -86,112 +149,100 @@ class ShowersMatcher:
         self.predictions_dict = predictions_dict.copy()
         self.pred_alpha_idx = pred_alpha_idx.copy()
 
-    def _build_data_graph(self):
-        graph = nx.Graph()
-
+    def _build_data_tables(self):
+        """
+        Builds one column per attribute for truth showers and one for predicted showers,
+        instead of one graph node with a dict of attributes per shower.
+        """
         truth_sid = self.truth_dict['truthHitAssignementIdx'][:, 0].astype(np.int32)
         truth_shower_sid, truth_shower_idx = np.unique(truth_sid, return_index=True)
         f = truth_shower_sid !=- 1
         truth_shower_sid, truth_shower_idx = truth_shower_sid[f], truth_shower_idx[f]
 
-        truth_nodes = []
-        keys = self.truth_dict.keys()
-
-        for i in range(len(truth_shower_sid)):
-            node_attributes = dict()
-
-            for k in keys:
-                node_attributes[k] = self.truth_dict[k][truth_shower_idx[i], 0]
-
-            node_attributes['type'] = ShowersMatcher._NODE_TYPE_TRUTH_SHOWER
-
-            node = (int(truth_shower_sid[i]), node_attributes)
-            truth_nodes.append(node)
+        self.truth_shower_sid = truth_shower_sid
+        self.truth_table = {k: self.truth_dict[k][truth_shower_idx, 0] for k in self.truth_dict.keys()}
 
-        graph.add_nodes_from(truth_nodes)
-
-        pred_sid = self.predictions_dict['pred_sid'] + np.max(truth_shower_sid) + 1000   # Offset node ids for pred nodes, can also be +1.
+        # Offset ids for pred showers, can also be +1.
+        offset = (np.max(truth_shower_sid) if len(truth_shower_sid) else 0) + 1000
+        pred_sid = self.predictions_dict['pred_sid'] + offset
         self.pred_sid = pred_sid
-        pred_shower_sid = [pred_sid[x,0] for x in self.pred_alpha_idx if pred_sid[x] != -1]
+        pred_alpha_idx = np.array(self.pred_alpha_idx, dtype=np.int64)
+        self.pred_shower_sid = pred_sid[pred_alpha_idx, 0]
 
-        keys = self.predictions_dict.keys()
-        pred_nodes = []
         skip = {'row_splits'}
-
-        for i in range(len(pred_shower_sid)):
-            node_attributes = dict()
-            for k in keys:
-                if k in skip:
-                    continue
-                node_attributes[k] = self.predictions_dict[k][self.pred_alpha_idx[i], 0]
-            node = (pred_shower_sid[i], node_attributes)
-            node_attributes['type'] = ShowersMatcher._NODE_TYPE_PRED_SHOWER
-
-            pred_nodes.append(node)
-
-        graph.add_nodes_from(pred_nodes)
-
-        self.graph = graph
+        self.pred_table = {k: self.predictions_dict[k][pred_alpha_idx, 0]
+                           for k in self.predictions_dict.keys() if k not in skip}
+
+        # index of the matched shower in the other table, -1 if not matched
+        self.truth_matched_pred_idx = np.full(len(self.truth_shower_sid), -1, dtype=np.int64)
+        self.pred_matched_truth_idx = np.full(len(self.pred_shower_sid), -1, dtype=np.int64)
+        self.calculated_graph = None
+
+    def _energy_cut_mask(self, pred_shower_energy, truth_shower_energy):
+        """
+        :return: [n_pred, n_truth] boolean mask of pairs passing the relative energy difference cut
+        """
+        if self.de_e_cut == -1:
+            return np.ones((len(pred_shower_energy), len(truth_shower_energy)), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (np.abs(pred_shower_energy[:, np.newaxis] - truth_shower_energy[np.newaxis, :])
+                    / truth_shower_energy[np.newaxis, :]) < self.de_e_cut
 
     def _cost_matrix_intersection_based(self, truth_shower_sid, pred_shower_sid):
-        pred_shower_energy = [self.graph.nodes[x]['pred_energy'] for x in pred_shower_sid]
-        truth_shower_energy = [self.graph.nodes[x]['truthHitAssignedEnergies'] for x in truth_shower_sid]
+        pred_shower_energy = self.pred_table['pred_energy'].astype(np.float64)
+        truth_shower_energy = self.truth_table['truthHitAssignedEnergies'].astype(np.float64)
         weight = self.features_dict['recHitEnergy'][:, 0]
-        iou_matrix = calculate_iou_tf(self.truth_dict['truthHitAssignementIdx'][:, 0],
-                                      self.pred_sid[:, 0],
-                                       truth_shower_sid,
-                                       pred_shower_sid,
-                                       weight)
+        iou_matrix = calculate_iou_sparse(self.truth_dict['truthHitAssignementIdx'][:, 0],
+                                          self.pred_sid[:, 0],
+                                          truth_shower_sid,
+                                          pred_shower_sid,
+                                          weight)
 
-        if self.de_e_cut == -1:
-            allow = lambda i,j: True
-        else:
-            de_e_cut_on_matching = self.de_e_cut
-            allow = lambda i,j : (np.abs(pred_shower_energy[i] - truth_shower_energy[j]) / truth_shower_energy[j]) < de_e_cut_on_matching
+        allow = np.logical_and(iou_matrix >= self.iou_threshold,
+                               self._energy_cut_mask(pred_shower_energy, truth_shower_energy))
 
         n = max(len(truth_shower_sid), len(pred_shower_sid))
         C = np.zeros((n, n))
         if self.match_mode == 'iou_max':
-            for i in range(len(pred_shower_sid)):
-                for j in range(len(truth_shower_sid)):
-                    overlap = iou_matrix[i, j]
-                    if overlap >= self.iou_threshold and allow(i,j):
-                        C[i, j] = overlap
+            C[:len(pred_shower_sid), :len(truth_shower_sid)] = np.where(allow, iou_matrix, 0.)
         elif self.match_mode == 'emax_iou':
-            for i in range(len(pred_shower_sid)):
-                for j in range(len(truth_shower_sid)):
-                    overlap = iou_matrix[i, j]
-                    if overlap >= self.iou_threshold and allow(i,j):
-                        C[i, j] = min(self.graph.nodes[truth_shower_sid[j]]['energy'], self.graph.nodes[pred_shower_sid[i]]['energy'])
+            min_energy = np.minimum(self.pred_table['energy'].astype(np.float64)[:, np.newaxis],
+                                    self.truth_table['energy'].astype(np.float64)[np.newaxis, :])
+            C[:len(pred_shower_sid), :len(truth_shower_sid)] = np.where(allow, min_energy, 0.)
         return C
 
 
     def _cost_matrix_angle_based(self, truth_shower_sid, pred_shower_sid):
-        pred_shower_energy = [self.graph.nodes[x]['dep_energy'] for x in pred_shower_sid]
-        truth_shower_energy = [self.graph.nodes[x]['energy'] for x in truth_shower_sid]
-        if self.de_e_cut==-1:
-            allow = lambda i,j: True
-        else:
-            de_e_cut_on_matching = self.de_e_cut
-            allow = lambda i,j : (np.abs(pred_shower_energy[i] - truth_shower_energy[j]) / truth_shower_energy[j]) < de_e_cut_on_matching
+        pred_shower_energy = self.pred_table['dep_energy'].astype(np.float64)
+        truth_shower_energy = self.truth_table['energy'].astype(np.float64)
+
+        pred_direction = np.stack([self.pred_table[k] for k in ['dep_x', 'dep_y', 'dep_z']],
+                                  axis=-1).astype(np.float64).reshape((-1, 3))
+        truth_direction = np.stack([self.truth_table[k] for k in ['x', 'y', 'z']],
+                                   axis=-1).astype(np.float64).reshape((-1, 3))
+
+        # same as angle(x, y) for all pairs
+        norm = np.sqrt(np.sum(pred_direction**2, axis=-1))[:, np.newaxis] \
+               * np.sqrt(np.sum(truth_direction**2, axis=-1))[np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angles = np.arccos(np.matmul(pred_direction, truth_direction.T) / norm)
+
+        allow = np.logical_and(angles < self.angle_cut,
+                               self._energy_cut_mask(pred_shower_energy, truth_shower_energy))
+
+        min_energy = np.minimum(self.pred_table['energy'].astype(np.float64)[:, np.newaxis],
+                                truth_shower_energy[np.newaxis, :])
 
         n = max(len(truth_shower_sid), len(pred_shower_sid))
         C = np.zeros((n, n))
-
-        for a, j in enumerate(pred_shower_sid):
-            x = self.graph.nodes(data=True)[j]
-            for b, i in enumerate(truth_shower_sid):
-                y = self.graph.nodes(data=True)[i]
-                if angle(x,y) < self.angle_cut and allow(x,y):
-                    C[a, b] = min(x['energy'],
-                                  y['energy'])
+        C[:len(pred_shower_sid), :len(truth_shower_sid)] = np.where(allow, min_energy, 0.)
 
         return C
 
 
     def _match_single_pass(self):
-        truth_shower_sid = [x[0] for x in self.graph.nodes(data=True) if x[1]['type']==ShowersMatcher._NODE_TYPE_TRUTH_SHOWER]
-        pred_shower_sid = [x[0] for x in self.graph.nodes(data=True) if x[1]['type']==ShowersMatcher._NODE_TYPE_PRED_SHOWER]
+        truth_shower_sid = self.truth_shower_sid
+        pred_shower_sid = self.pred_shower_sid
 
         if self.match_mode == 'iou_max' or self.match_mode == 'emax_iou':
             C = self._cost_matrix_intersection_based(truth_shower_sid, pred_shower_sid)
@@ -202,14 +253,10 @@ class ShowersMatcher:
 
         row_id, col_id = linear_sum_assignment(C, maximize=True)
 
-        matched_full_graph = nx.Graph()
-        matched_full_graph.add_nodes_from(self.graph.nodes(data=True))
-
-        for p, t in zip(row_id, col_id):
-            if C[p, t] > 0:
-                matched_full_graph.add_edge(truth_shower_sid[t], pred_shower_sid[p], attached_in_pass=0)
-
-        self.calculated_graph = matched_full_graph
+        matched = C[row_id, col_id] > 0
+        row_id, col_id = row_id[matched], col_id[matched]
+        self.pred_matched_truth_idx[row_id] = col_id
+        self.truth_matched_pred_idx[col_id] = row_id
 
     # def _reduce_graph(self, graph):
     #     pairs = []  # List of all the pairs to which to attach to
@@ -364,7 +411,7 @@ class ShowersMatcher:
 
 
     def process(self):
-        self._build_data_graph()
+        self._build_data_tables()
 
         if self.match_mode == 'iou_max':
             self._match_single_pass()
@@ -384,44 +431,85 @@ class ShowersMatcher:
         return event_truth_dataframe, event_pred_dataframe
 
     def get_result_as_dataframe(self):
-        event_variables = None # Not sure if it should be a dataframe, can just be a dictionary
-        skip_keys = {'type'}
-        keys_ = [list(attr.keys()) for n, attr in self.calculated_graph.nodes(data=True)]
-        keys_ = [item for sublist in keys_ for item in sublist]
-        keys_ = [k for k in keys_ if k not in skip_keys]
-        result_data = {k:[] for k in keys_}
-
-        done = set()
-        for n, attr in self.calculated_graph.nodes(data=True):
-            if n in done:
-                continue
-            done.add(n)
-
-            N = list(self.calculated_graph.neighbors(n))
-            assert len(N) == 0 or len(N) == 1
-
-            if len(N) == 1:
-                attr.update(self.calculated_graph.nodes[N[0]])
-                done.add(N[0])
-
-            add = {key: np.NaN for key in keys_}
-
-            for k,v in attr.items():
-                if k in add:
-                    add[k] = v
-
-            for k,v in add.items():
-                result_data[k].append(v)
+        """
+        One row per truth shower (merged with the matched predicted shower, if any),
+        followed by one row per unmatched predicted shower. Attributes that are not
+        available for a row are NaN. If a key exists for both, the predicted value is used
+        for matched showers.
+        """
+        truth_table = self.truth_table if len(self.truth_shower_sid) else {}
+        pred_table = self.pred_table if len(self.pred_shower_sid) else {}
+
+        matched = self.truth_matched_pred_idx
+        is_matched = matched >= 0
+        matched_or_zero = np.where(is_matched, matched, 0)
+        unmatched_pred = np.argwhere(self.pred_matched_truth_idx == -1)[:, 0]
+
+        n_truth_rows = len(matched)
+        n_rows = n_truth_rows + len(unmatched_pred)
+
+        keys = list(truth_table.keys()) + [k for k in pred_table.keys() if k not in truth_table]
+
+        result_data = dict()
+        for k in keys:
+            if k in pred_table:
+                pred_values = pred_table[k]
+                truth_rows = pred_values[matched_or_zero]
+                if k in truth_table:
+                    truth_rows = np.where(is_matched, truth_rows, truth_table[k])
+                    truth_missing = False
+                else:
+                    truth_missing = not np.all(is_matched)
+                pred_rows = pred_values[unmatched_pred]
+                pred_missing = False
+            else:
+                truth_rows = truth_table[k]
+                truth_missing = False
+                pred_rows = None
+                pred_missing = len(unmatched_pred) > 0
+
+            if truth_missing or pred_missing:
+                column = np.full(n_rows, np.nan, dtype=np.float64)
+                column[:n_truth_rows] = np.where(is_matched, truth_rows, np.nan) if truth_missing else truth_rows
+                if pred_rows is not None:
+                    column[n_truth_rows:] = pred_rows
+            elif pred_rows is None:
+                column = truth_rows
+            else:
+                column = np.concatenate([truth_rows, pred_rows])
+            result_data[k] = column
 
         frame = pd.DataFrame(result_data)
 
-        total_energy_truth = 0.0
-        total_energy_pred = 0.0
-        for n, attr in self.calculated_graph.nodes(data=True):
-            pass
-
         return frame
 
     def get_result_as_graph(self):
-        return self.calculated_graph
+        """
+        The graph is only built on request, from the shower tables and the matching.
+        """
+        if self.calculated_graph is None:
+            graph = nx.Graph()
+
+            truth_keys = list(self.truth_table.keys())
+            truth_nodes = []
+            for i in range(len(self.truth_shower_sid)):
+                node_attributes = {k: self.truth_table[k][i] for k in truth_keys}
+                node_attributes['type'] = ShowersMatcher._NODE_TYPE_TRUTH_SHOWER
+                truth_nodes.append((int(self.truth_shower_sid[i]), node_attributes))
+            graph.add_nodes_from(truth_nodes)
+
+            pred_keys = list(self.pred_table.keys())
+            pred_nodes = []
+            for i in range(len(self.pred_shower_sid)):
+                node_attributes = {k: self.pred_table[k][i] for k in pred_keys}
+                node_attributes['type'] = ShowersMatcher._NODE_TYPE_PRED_SHOWER
+                pred_nodes.append((self.pred_shower_sid[i], node_attributes))
+            graph.add_nodes_from(pred_nodes)
+
+            for t, p in enumerate(self.truth_matched_pred_idx):
+                if p >= 0:
+                    graph.add_edge(int(self.truth_shower_sid[t]), self.pred_shower_sid[p], attached_in_pass=0)
+
+            self.calculated_graph = graph
 
+        return self.calculated_graph
@@ -20,12 +20,11 @@ def _BinnedSelectKnn(K : int, coords,  bin_idx, dim_bin_idx, bin_boundaries, n_b
                                               )
 
 
-def BinnedSelectKnn(K : int, coords, row_splits, n_bins=None, max_bin_dims=3, tf_compatible=False, max_radius=None):
+def _bin_and_sort(K : int, coords, row_splits, n_bins=None, max_bin_dims=3):
     '''
-    max_radius is a dummy for now to make it a drop-in replacement
+    bins the coordinates and sorts them by bin, as expected by the op kernels
     '''
     from bin_by_coordinates_op import BinByCoordinates
-    from index_replacer_op import IndexReplacer
     
     # the following number of bins seems a good~ish estimate for good performance
     # for homogenous point distributions but should be subject to more tests
@@ -57,6 +56,18 @@ def BinnedSelectKnn(K : int, coords, row_splits, n_bins=None, max_bin_dims=3, tf
     # make it row split like
     bin_boundaries = tf.cumsum(bin_boundaries)
     
+    return sorting, scoords, sbinning, sdbinning, bin_boundaries, nb, bin_width
+
+
+def BinnedSelectKnn(K : int, coords, row_splits, n_bins=None, max_bin_dims=3, tf_compatible=False, max_radius=None):
+    '''
+    max_radius is a dummy for now to make it a drop-in replacement
+    '''
+    from index_replacer_op import IndexReplacer
+    
+    sorting, scoords, sbinning, sdbinning, bin_boundaries, nb, bin_width = _bin_and_sort(
+        K, coords, row_splits, n_bins=n_bins, max_bin_dims=max_bin_dims)
+    
     idx,dist = _BinnedSelectKnn(K, scoords,  sbinning, sdbinning, bin_boundaries=bin_boundaries, 
                                 n_bins=nb, bin_width=bin_width, tf_compatible=tf_compatible )
     
@@ -64,8 +75,8 @@ def BinnedSelectKnn(K : int, coords, row_splits, n_bins=None, max_bin_dims=3, tf
         return idx, dist
     #sort back 
     idx = IndexReplacer(idx,sorting)
-    dist = tf.scatter_nd(sorting[...,tf.newaxis], dist, dist.shape)
-    idx = tf.scatter_nd(sorting[...,tf.newaxis], idx, idx.shape)
+    dist = tf.scatter_nd(sorting[...,tf.newaxis], dist, tf.shape(dist))
+    idx = tf.scatter_nd(sorting[...,tf.newaxis], idx, tf.shape(idx))
     
     return idx, dist
 
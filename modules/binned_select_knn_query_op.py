@@ -0,0 +1,50 @@
+import tensorflow as tf
+from tensorflow.python.framework import ops
+
+from binned_select_knn_op import _bin_and_sort
+
+_binned_select_knn_query = tf.load_op_library('binned_select_knn_query.so')
+
+def BinnedSelectKnnQuery(K : int, coords, row_splits, query_idx, n_bins=None, max_bin_dims=3, 
+                         tf_compatible=False, max_radius=None):
+    '''
+    Same as BinnedSelectKnn, but only the vertices in query_idx search for neighbours
+    (among all vertices in the same row split). The cost and the output size scale
+    with the number of queries instead of the number of vertices.
+    
+    Inputs:
+    - query_idx: Q, indices of the query vertices
+    - max_radius: neighbours further away are not selected (padded with -1 / self)
+    
+    Output:
+    - indices Q x K, the first entry is the query vertex itself
+    - distances**2 Q x K
+    
+    No gradient. CPU only: on GPU machines the op is placed on the CPU.
+    '''
+    sorting, scoords, sbinning, sdbinning, bin_boundaries, nb, bin_width = _bin_and_sort(
+        K, coords, row_splits, n_bins=n_bins, max_bin_dims=max_bin_dims)
+    
+    #position of the query vertices after sorting
+    query_idx = tf.cast(tf.reshape(query_idx, [-1]), 'int32')
+    sorted_pos = tf.scatter_nd(sorting[...,tf.newaxis], tf.range(tf.shape(sorting)[0]), tf.shape(sorting))
+    squery_idx = tf.gather(sorted_pos, query_idx)
+    
+    if max_radius is None:
+        max_radius = -1.
+    
+    idx, dist = _binned_select_knn_query.BinnedSelectKnnQuery(n_neighbours=K,
+                                                             tf_compatible=tf_compatible,
+                                                             max_radius=float(max_radius),
+                                                             coords=scoords,
+                                                             bin_idx=sbinning,
+                                                             dim_bin_idx=sdbinning,
+                                                             bin_boundaries=bin_boundaries,
+                                                             n_bins=nb,
+                                                             bin_width=bin_width,
+                                                             query_idx=squery_idx)
+    #back to the original vertex indices
+    idx = tf.where(idx < 0, -1, tf.gather(sorting, tf.maximum(idx, 0)))
+    return idx, dist
+
+ops.NotDifferentiable("BinnedSelectKnnQuery")
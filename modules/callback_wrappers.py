@@ -27,6 +27,7 @@ def build_callbacks(train,
                     de_e_cut=-1,
                     angle_cut=-1,
                     full_analysis_after_batches=7000,
+                    full_analysis_in_background=False,
                     cluster_summary_after_batches=400):
 
     if beta_and_dist_thresholds is not None:
@@ -59,7 +60,8 @@ def build_callbacks(train,
                                     min_batch=0,
                                     limit_endcaps = -1,#all endcaps in file
                                     limit_endcaps_by_time = 180,#in seconds, don't spend more than 10 minutes on this
-                                    trial_batch=10
+                                    trial_batch=10,
+                                    run_in_background=full_analysis_in_background
         )]
 
     cb += [
@@ -492,18 +492,123 @@ class plotGravNetCoordsDuringTraining(plotDuringTrainingBase):
         
 
 
+import json
+import shutil
+import subprocess
+import sys
+
 import tensorflow as tf
 
 from hplots.hgcal_analysis_plotter import HGCalAnalysisPlotter
 from plotting_tools import publish
 
 
+def summarise_showers(showers_dataframe):
+    '''
+    efficiency, fake rate and mean response of the matched showers from a shower data frame
+    as returned by ShowersMatcher.get_result_as_dataframe
+    '''
+    if len(showers_dataframe):
+        has_truth = showers_dataframe['truthHitAssignementIdx'].notnull().to_numpy()
+        has_pred = showers_dataframe['pred_sid'].notnull().to_numpy()
+        matched = np.logical_and(has_truth, has_pred)
+        response = showers_dataframe['pred_energy'][matched].to_numpy() \
+                   / showers_dataframe['truthHitAssignedEnergies'][matched].to_numpy()
+    else:
+        has_truth = has_pred = matched = response = np.zeros(0)
+
+    summary = dict()
+    summary['efficiency'] = float(np.sum(matched) / max(np.sum(has_truth), 1))
+    summary['fake_rate'] = float(np.sum(np.logical_and(has_pred, np.logical_not(has_truth))) / max(np.sum(has_pred), 1))
+    summary['response_mean'] = float(np.mean(response)) if len(response) else 0.
+    summary['num_truth_showers'] = int(np.sum(has_truth))
+    summary['num_pred_showers'] = int(np.sum(has_pred))
+    return summary
+
+
+def run_full_validation(all_data, hits2showers, showers_matcher, test_on, pdfs_path, batch_idx):
+    '''
+    Clusters and matches all endcaps in all_data (as returned by HGCalPredictor.predict with
+    output_to_file=False) for every (beta_threshold, distance_threshold) point in test_on and
+    writes one pdf file per point.
+
+    :return: one dict of summary metrics (see summarise_showers) per point
+    '''
+    showers_dataframes = [[] for _ in test_on]
+    event_id = 0
+
+    for file_data in all_data:
+        for endcap_data in file_data:
+            features_dict, truth_dict, predictions_dict = endcap_data
+            # all threshold points at once, reusing the clustering work per endcap
+            sweep_results = hits2showers.call_sweep(features_dict, predictions_dict, test_on)
+            for i, (processed_pred_dict, pred_shower_alpha_idx) in enumerate(sweep_results):
+                showers_matcher.set_inputs(
+                    features_dict=features_dict,
+                    truth_dict=truth_dict,
+                    predictions_dict=processed_pred_dict,
+                    pred_alpha_idx=pred_shower_alpha_idx
+                )
+                showers_matcher.process()
+
+                dataframe = showers_matcher.get_result_as_dataframe()
+                dataframe['event_id'] = event_id
+                showers_dataframes[i].append(dataframe)
+            event_id += 1
+
+    results = []
+    for (b, d), dataframes in zip(test_on, showers_dataframes):
+        showers_dataframe = pd.concat(dataframes) if len(dataframes) else pd.DataFrame()
+
+        # This is only to write to pdf files
+        scalar_variables = {
+            'beta_threshold': str(b),
+            'distance_threshold': str(d),
+            'iou_threshold': str(showers_matcher.iou_threshold),
+            'matching_mode': str(showers_matcher.match_mode),
+            'is_soft': str(hits2showers.is_soft),
+            'de_e_cut': str(showers_matcher.de_e_cut),
+            'angle_cut': str(showers_matcher.angle_cut),
+        }
+        plotter = HGCalAnalysisPlotter()
+        pdf_path = os.path.join(pdfs_path, 'validation_results_%07d_%.2f_%.2f.pdf'%(batch_idx, b,d))
+        plotter.set_data(showers_dataframe, None, '', pdf_path, scalar_variables=scalar_variables)
+        plotter.process()
+
+        result = {'iteration': int(batch_idx), 'beta_threshold': float(b), 'distance_threshold': float(d)}
+        result.update(summarise_showers(showers_dataframe))
+        results.append(result)
+
+    return results
+
+
 class RunningFullValidation(tf.keras.callbacks.Callback):
+
+    # runs one background job, usage: python3 <worker_script> <job file>
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'full_validation_worker.py')
+
     def __init__(self, after_n_batches, predictor, hits2showers, showers_matcher, test_on_points,
                  pdfs_path, min_batch=0,
                  limit_endcaps = -1,#all endcaps in file
                  limit_endcaps_by_time = 600,#in seconds, don't spend more than 10 minutes on this
-                 trial_batch=10):
+                 trial_batch=10,
+                 run_in_background=False,
+                 background_policy='skip',
+                 database_manager=None,
+                 tensorboard_manager=None,
+                 table_name='full_validation_metrics'):
+        """
+        :param run_in_background: snapshot the model and run prediction, clustering, matching and plotting
+                                  in a separate process on CPU (see full_validation_worker.py) instead of
+                                  blocking the training loop. The results are reported when the process is done.
+        :param background_policy: what to do if a validation is due while the previous one is still running:
+                                  'skip' drops the new one, 'replace' stops the running one (its results
+                                  would be stale) and starts the new one
+        :param database_manager: ExperimentDatabaseManager, the summary metrics of each point are inserted
+                                 into table_name if given
+        :param tensorboard_manager: TensorBoardManager, the summary metrics of each point are written
+                                    as scalars if given
+        """
 
         super().__init__()
         self.after_n_batches = after_n_batches
@@ -516,9 +621,17 @@ class RunningFullValidation(tf.keras.callbacks.Callback):
         self.trial_batch = trial_batch
         self.hits2showers = hits2showers
         self.showers_matcher = showers_matcher
+        self.run_in_background = run_in_background
+        self.background_policy = background_policy
+        self.database_manager = database_manager
+        self.tensorboard_manager = tensorboard_manager
+        self.table_name = table_name
+        self.background_job = None
 
         if pdfs_path is None:
             raise RuntimeError("Set pdf output path")
+        if background_policy not in ['skip', 'replace']:
+            raise ValueError("background_policy must be 'skip' or 'replace'")
 
     def on_train_batch_end(self, batch, logs=None):
         try:
@@ -526,9 +639,82 @@ class RunningFullValidation(tf.keras.callbacks.Callback):
         except Exception as e:
             print('encountered the following exception when running RunningFullValidation callback:')
             print(e)
-        
+
+    def on_train_end(self, logs=None):
+        if self.background_job is not None:
+            print('RunningFullValidation: waiting for the background validation to finish')
+            self.background_job['process'].wait()
+            self._poll_background_job()
+
+    def _report(self, results):
+        for result in results:
+            if self.database_manager is not None:
+                self.database_manager.insert_experiment_data(self.table_name, result)
+            if self.tensorboard_manager is not None:
+                prefix = 'full_validation_b%.2f_d%.2f/' % (result['beta_threshold'], result['distance_threshold'])
+                self.tensorboard_manager.step(result['iteration'],
+                                              {prefix + k: v for k, v in result.items() if k != 'iteration'})
+
+    def _start_background_job(self):
+        if self.background_job is not None:
+            if self.background_policy == 'skip':
+                print('RunningFullValidation: previous validation still running, skipping this one.')
+                return
+            print('RunningFullValidation: stopping the previous validation, its results would be stale.')
+            self._stop_background_job()
+
+        job_dir = os.path.join(self.pdfs_path, 'background_job_%07d' % self.batch_idx)
+        os.makedirs(job_dir, exist_ok=True)
+        model_path = os.path.join(job_dir, 'model_snapshot.h5')
+        self.model.save(model_path)
+
+        # only the settings, the worker creates the predictor, clustering and matching objects again
+        job = {'predictor': self.predictor.get_config(),
+               'hits2showers': self.hits2showers.get_config(),
+               'showers_matcher': self.showers_matcher.get_config(),
+               'test_on': [[float(b), float(d)] for b, d in self.hyper_param_points],
+               'pdfs_path': self.pdfs_path,
+               'batch_idx': self.batch_idx,
+               'model_path': model_path,
+               'result_file': os.path.join(job_dir, 'results.json')}
+        job_file = os.path.join(job_dir, 'job.json')
+        with open(job_file, 'w') as f:
+            json.dump(job, f, indent=1)
+
+        # a new interpreter instead of a fork, the training process has tensorflow (and the GPU) initialised
+        log = open(os.path.join(job_dir, 'log.txt'), 'w')
+        process = subprocess.Popen([sys.executable, self.worker_script, job_file], stdout=log, stderr=subprocess.STDOUT)
+        self.background_job = {'process': process, 'log': log, 'job_dir': job_dir,
+                               'result_file': job['result_file']}
+        print('RunningFullValidation: started background validation, log in', log.name)
+
+    def _stop_background_job(self):
+        job = self.background_job
+        self.background_job = None
+        job['process'].terminate()
+        job['process'].wait()
+        job['log'].close()
+        shutil.rmtree(job['job_dir'], ignore_errors=True)
+
+    def _poll_background_job(self):
+        job = self.background_job
+        if job is None or job['process'].poll() is None:
+            return
+        self.background_job = None
+        job['log'].close()
+        if job['process'].returncode != 0 or not os.path.exists(job['result_file']):
+            print('RunningFullValidation: background validation failed, see', job['log'].name)
+            return
+        with open(job['result_file']) as f:
+            results = json.load(f)
+        self._report(results)
+        shutil.rmtree(job['job_dir'], ignore_errors=True)
+        print('RunningFullValidation: background validation finished.')
+
     def _on_train_batch_end(self, batch, logs=None):
-        
+
+        self._poll_background_job()
+
         runcallback = False
         
         if self.trial_batch > 0:
@@ -546,6 +732,10 @@ class RunningFullValidation(tf.keras.callbacks.Callback):
         self.batch_idx+=1
         if not runcallback:
             return
+
+        if self.run_in_background:
+            self._start_background_job()
+            return
             
         print("\n\nGonna run callback to do full validation...\n\n")
 
@@ -555,45 +745,9 @@ class RunningFullValidation(tf.keras.callbacks.Callback):
             print("Model file not found. Will skip.")
             return
 
-        test_on = self.hyper_param_points
-        showers_dataframe = pd.DataFrame()
-        event_id = 0
-
-        #TBI: this should be sent to a thread and not block main execution
-        for b, d in test_on:
-            for file_data in all_data:
-                for endcap_data in file_data:
-                    features_dict, truth_dict, predictions_dict = endcap_data
-                    self.hits2showers.set_beta_threshold(b)
-                    self.hits2showers.set_distance_threshold(d)
-                    processed_pred_dict, pred_shower_alpha_idx = self.hits2showers.call(features_dict, predictions_dict)
-                    self.showers_matcher.set_inputs(
-                        features_dict=features_dict,
-                        truth_dict=truth_dict,
-                        predictions_dict=processed_pred_dict,
-                        pred_alpha_idx=pred_shower_alpha_idx
-                    )
-                    self.showers_matcher.process()
-
-                    dataframe = self.showers_matcher.get_result_as_dataframe()
-                    dataframe['event_id'] = event_id
-                    event_id += 1
-                    showers_dataframe = pd.concat((showers_dataframe, dataframe))
-
-            # This is only to write to pdf files
-            scalar_variables = {
-                'beta_threshold': str(b),
-                'distance_threshold': str(d),
-                'iou_threshold': str(self.showers_matcher.iou_threshold),
-                'matching_mode': str(self.showers_matcher.match_mode),
-                'is_soft': str(self.hits2showers.is_soft),
-                'de_e_cut': str(self.showers_matcher.de_e_cut),
-                'angle_cut': str(self.showers_matcher.angle_cut),
-            }
-            plotter = HGCalAnalysisPlotter()
-            pdf_path = os.path.join(self.pdfs_path, 'validation_results_%07d_%.2f_%.2f.pdf'%(self.batch_idx, b,d))
-            plotter.set_data(showers_dataframe, None, '', pdf_path, scalar_variables=scalar_variables)
-            plotter.process()
+        results = run_full_validation(all_data, self.hits2showers, self.showers_matcher, self.hyper_param_points,
+                                      self.pdfs_path, self.batch_idx)
+        self._report(results)
 
         print('finished full validation callback, proceeding with training.')
         
@@ -602,4 +756,3 @@ class RunningFullValidation(tf.keras.callbacks.Callback):
         
         
         
-        
@@ -1,6 +1,7 @@
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
+#define EIGEN_USE_THREADS
 
 
 #include "tensorflow/core/framework/op_kernel.h"
@@ -8,6 +9,7 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <algorithm> //min
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -21,19 +23,15 @@ inline static float distanceWeight(const float& distsq){
     return distsq;
 }
 
-static void set_feature_grad_zero(
-        float * d_out_grad_features,
-        size_t n_vert,
-        size_t n_feat
-){
-
-    for (size_t i_v = 0; i_v < n_vert; i_v++){
-        for (size_t i_f = 0; i_f < n_feat; i_f++)
-            d_out_grad_features[I2D(i_v, i_f, n_feat)] = 0;
-    }
-}
-
+// The feature gradient is a scatter to the neighbours. To avoid atomics, the output
+// vertices are split in ranges. Each task runs over all (vertex, neighbour) pairs in the
+// serial order, but only accumulates into the output rows of its own range.
+// Every output element is therefore summed in the same order as in a serial loop,
+// independent of the number of ranges, so the result does not depend on the number of threads.
+// Reading the neighbour indices is cheap compared to the feature loop, such that the
+// repeated scan costs little.
 static void calc_feature_gradients(
+        const CPUDevice &d,
         const float * d_grad_from_out_features,
         const int * d_max_feat_indices,
         const int * d_neigh_indices,
@@ -48,55 +46,68 @@ static void calc_feature_gradients(
         float * d_out_grad_features,
         bool mean_and_max
 ){
-    for (size_t i_v = 0; i_v < n_vert; i_v++){
-        for(size_t nu_f=0;nu_f<n_feat;nu_f++){
-
-            const float ginu = d_grad_from_out_features[I2D(i_v, nu_f, n_grad_from_out_feat)];
-            float ginu_max = 0;
-            int max_for_iv = -1;
-            if(mean_and_max){
-                ginu_max = d_grad_from_out_features[I2D(i_v, nu_f+n_feat, n_grad_from_out_feat)];
-                max_for_iv = d_max_feat_indices[I2D(i_v,nu_f,n_feat)];
-            }
+    //a few ranges per thread for load balancing
+    const int n_ranges = std::max(1, std::min(n_vert, 4 * d.numThreads()));
+    const double range_size = (double)n_vert / (double)n_ranges;
+
+    const Eigen::TensorOpCost cost(
+            (double)n_vert * n_neigh * sizeof(int) + range_size * n_neigh * n_feat * (2 + mean_and_max) * sizeof(float), //loaded
+            range_size * n_neigh * n_feat * sizeof(float),   //stored
+            (double)n_vert * n_neigh + range_size * n_neigh * n_feat * 5.);  //compute
 
+    d.parallelFor(n_ranges, cost,
+            [&](Eigen::Index first, Eigen::Index last){
+
+        //consecutive ranges of one shard are treated as one
+        const int m_first = (int)(first * range_size);
+        const int m_last = last == n_ranges ? n_vert : (int)(last * range_size);
+
+        for (int m_v = m_first; m_v < m_last; m_v++){
+            for (int nu_f = 0; nu_f < n_feat; nu_f++)
+                d_out_grad_features[I2D(m_v, nu_f, n_feat)] = 0;
+        }
+
+        for (int i_v = 0; i_v < n_vert; i_v++){
+
+            const float * ginu = d_grad_from_out_features + I2D(i_v, 0, n_grad_from_out_feat);
+            const int * max_for_iv = d_max_feat_indices + I2D(i_v, 0, n_feat);
 
             bool firstself=true;
-            for(size_t i_i_n = 0; i_i_n < n_neigh; i_i_n++){
+            for(int i_i_n = 0; i_i_n < n_neigh; i_i_n++){
 
                 int m_v = d_neigh_indices[I2D(i_v, i_i_n, n_neigh)];
                 if(m_v<0) continue;
 
-                const float distsq_im = d_distances[I2D(i_v,i_i_n,n_neigh)];
+                //count self just once
+                const int max_match = (m_v != i_v || firstself) ? m_v : -1;
+                if(m_v == i_v)
+                    firstself = false;
 
-                const float weight_im = distanceWeight(distsq_im);
+                if(m_v < m_first || m_v >= m_last) continue; //not in this range
 
-                //if weight_im > some number?
-                //     for (size_t nu_f = 0; nu_f < n_feat; nu_f++){
+                const float weight_im = distanceWeight(d_distances[I2D(i_v,i_i_n,n_neigh)]);
+                float * out_grad = d_out_grad_features + I2D(m_v, 0, n_feat);
 
-                float mean_contrib = ginu  / (float)n_neigh  * weight_im;
-                float max_contrib = 0;
-                if(m_v ==  max_for_iv){
-                    if(m_v == i_v){
-                        if(firstself){//count self just once
-                            max_contrib = ginu_max * weight_im;
-                            firstself=false;
-                        }
-                    }
-                    else{
-                        max_contrib = ginu_max * weight_im;
-                    }
+                if(!mean_and_max){
+                    for (int nu_f = 0; nu_f < n_feat; nu_f++)
+                        out_grad[nu_f] += ginu[nu_f]  / (float)n_neigh  * weight_im;
+                    continue;
                 }
 
-                //ATOMIC because of m_v which can occur in different threads. this is slow.. but needs to be atomic at least here...
-                d_out_grad_features[I2D(m_v, nu_f, n_feat)] += mean_contrib + max_contrib;
-
-                //     }
+                for (int nu_f = 0; nu_f < n_feat; nu_f++){
+                    float mean_contrib = ginu[nu_f]  / (float)n_neigh  * weight_im;
+                    float max_contrib = 0;
+                    if(max_for_iv[nu_f] == max_match)
+                        max_contrib = ginu[nu_f + n_feat] * weight_im;
+                    out_grad[nu_f] += mean_contrib + max_contrib;
+                }
             }
         }
-    }
+    });
 }
 
 static void calc_distance_gradients(
+        const CPUDevice &d,
         const float * d_grad_from_out_features,
         const int *   d_max_feat_indices,
         const int *   d_neigh_indices,
@@ -112,56 +123,66 @@ static void calc_distance_gradients(
         float * d_out_grad_distances,
         bool mean_and_max
 ){
-    for (size_t m = 0; m < n_vert; m++){
+    // each vertex only writes its own row
+    const Eigen::TensorOpCost cost(
+            n_neigh * n_feat * (2 + mean_and_max) * sizeof(float), //loaded
+            n_neigh * sizeof(float),                               //stored
+            n_neigh * n_feat * 5.);                                //compute
 
-        for (size_t l = 0; l < n_neigh; l++){
+    d.parallelFor(n_vert, cost,
+            [&](Eigen::Index first, Eigen::Index last){
 
+        for (Eigen::Index m = first; m < last; m++){
 
-            int l_g = d_neigh_indices[I2D(m,l,n_neigh)];
-            if(l_g  < 0 ){
-                d_out_grad_distances[I2D(m,l,n_neigh)] = 0;
-                continue;
-            }
+            for (size_t l = 0; l < n_neigh; l++){
+
+
+                int l_g = d_neigh_indices[I2D(m,l,n_neigh)];
+                if(l_g  < 0 ){
+                    d_out_grad_distances[I2D(m,l,n_neigh)] = 0;
+                    continue;
+                }
 
-            float mean_contrib=0;
-            float max_contrib=0;
+                float mean_contrib=0;
+                float max_contrib=0;
 
-            float dml = d_distances[I2D(m,l,n_neigh)]; //dlm == dml
-            float expml = 1.; //linear scaling so grad 1 distanceWeight(dml);
+                float dml = d_distances[I2D(m,l,n_neigh)]; //dlm == dml
+                float expml = 1.; //linear scaling so grad 1 distanceWeight(dml);
 
-            for(size_t b_f=0;b_f<n_feat;b_f++){
+                for(size_t b_f=0;b_f<n_feat;b_f++){
 
-                bool firstself=true; ///To be checked!!! this needs to be per feature and stored!
+                    bool firstself=true; ///To be checked!!! this needs to be per feature and stored!
 
-                float gmb = d_grad_from_out_features[I2D(m, b_f, n_grad_from_out_feat)];
-                float gmbmax = 0;
-                if(mean_and_max)
-                    gmbmax  = d_grad_from_out_features[I2D(m, b_f+n_feat, n_grad_from_out_feat)];
-                float flb = d_feat[I2D(l_g, b_f, n_feat)];
+                    float gmb = d_grad_from_out_features[I2D(m, b_f, n_grad_from_out_feat)];
+                    float gmbmax = 0;
+                    if(mean_and_max)
+                        gmbmax  = d_grad_from_out_features[I2D(m, b_f+n_feat, n_grad_from_out_feat)];
+                    float flb = d_feat[I2D(l_g, b_f, n_feat)];
 
-                mean_contrib += gmb * flb *expml;
-                int maxform = -1;
-                if(mean_and_max)
-                    maxform = d_max_feat_indices[I2D(m,b_f,n_feat)] ;
-                if( l_g == maxform){
-                    if( l_g == m){
-                        if(firstself){
+                    mean_contrib += gmb * flb *expml;
+                    int maxform = -1;
+                    if(mean_and_max)
+                        maxform = d_max_feat_indices[I2D(m,b_f,n_feat)] ;
+                    if( l_g == maxform){
+                        if( l_g == m){
+                            if(firstself){
+                                max_contrib += gmbmax * flb * expml;
+                                firstself = false;
+                            }
+                        }
+                        else{
                             max_contrib += gmbmax * flb * expml;
-                            firstself = false;
                         }
                     }
-                    else{
-                        max_contrib += gmbmax * flb * expml;
-                    }
+
                 }
+                mean_contrib *= 1. / (float)n_neigh;
+                max_contrib *= 1;
 
+                d_out_grad_distances[I2D(m,l,n_neigh)] = mean_contrib + max_contrib;
             }
-            mean_contrib *= 1. / (float)n_neigh;
-            max_contrib *= 1;
-
-            d_out_grad_distances[I2D(m,l,n_neigh)] = mean_contrib + max_contrib;
         }
-    }
+    });
 }
 
 // CPU specialization
@@ -189,10 +210,8 @@ struct AccumulateKnnGradOpFunctor<CPUDevice, dummy> {
 
         //CPU implementation
 
-        //set zero
-        set_feature_grad_zero(d_out_grad_features, n_vert, n_feat);
-
         calc_feature_gradients(
+                d,
                 d_grad_from_out_features,
                 d_max_feat_indices,
                 d_neigh_indices,
@@ -208,6 +227,7 @@ struct AccumulateKnnGradOpFunctor<CPUDevice, dummy> {
                 mean_and_max);
 
         calc_distance_gradients(
+                d,
                 d_grad_from_out_features,
                 d_max_feat_indices,
                 d_neigh_indices,
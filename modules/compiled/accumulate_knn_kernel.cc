@@ -2,6 +2,7 @@
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
+#define EIGEN_USE_THREADS
 
 
 #include "tensorflow/core/framework/op_kernel.h"
@@ -45,40 +46,62 @@ struct AccumulateKnnOpFunctor<CPUDevice, dummy> {
             bool mean_and_max) {
 
 
-        for (size_t i_v = 0; i_v < n_vert; i_v++) {
+        // Vertices are independent, each one only writes its own output rows.
+        // Per vertex, the loop runs over neighbours first and over features inside,
+        // such that the neighbour feature rows are read contiguously. The output rows
+        // are used as accumulators; the summation order per feature is the same as
+        // in a feature-outer loop, so the results do not depend on the loop order.
+        const Eigen::TensorOpCost cost(
+                n_neigh * (n_feat + 2) * sizeof(float),      //loaded
+                n_out_feat * sizeof(float) + n_feat * sizeof(int), //stored
+                n_neigh * n_feat * 4.);                      //compute
 
-            for(size_t i_f=0;i_f<n_feat;i_f++){
-                float t_mean = 0;
-                float t_max = 0;
-                int max_i_n_gidx = 0;
+        d.parallelFor(n_vert, cost,
+                [&](Eigen::Index first, Eigen::Index last){
 
-                for(size_t i_n=0;i_n<n_neigh;i_n++){
+            for (Eigen::Index i_v = first; i_v < last; i_v++) {
+
+                float * out_mean = d_out_feat + I2D(i_v, 0, n_out_feat);
+                float * out_max = out_mean + n_feat;
+                int * out_maxidx = d_out_maxidxs + I2D(i_v, 0, n_feat);
+
+                for(int i_f=0;i_f<n_feat;i_f++){
+                    out_mean[i_f] = 0;
+                    if(mean_and_max){
+                        out_max[i_f] = 0;
+                        out_maxidx[i_f] = 0;
+                    }
+                }
+
+                for(int i_n=0;i_n<n_neigh;i_n++){
                     int nidx = d_idxs[I2D(i_v,i_n,n_neigh)];
 
                     if(nidx<0) continue;
 
-                    float vnf = d_feat[I2D(nidx,i_f,n_feat)];
-                    float distsq = d_distances[I2D(i_v,i_n,n_neigh)];
-                    float wfeat = vnf * distanceWeight(distsq);
-                    //DEBUGCOUT(wfeat);
-                    t_mean += wfeat;
-                    if(mean_and_max && (wfeat >= t_max || !i_n)){
-                        max_i_n_gidx = nidx;
-                        t_max = wfeat;
+                    const float weight = distanceWeight(d_distances[I2D(i_v,i_n,n_neigh)]);
+                    const float * nfeat = d_feat + I2D(nidx, 0, n_feat);
+
+                    if(!mean_and_max){
+                        for(int i_f=0;i_f<n_feat;i_f++)
+                            out_mean[i_f] += nfeat[i_f] * weight;
+                        continue;
+                    }
+                    for(int i_f=0;i_f<n_feat;i_f++){
+                        float wfeat = nfeat[i_f] * weight;
+                        out_mean[i_f] += wfeat;
+                        if(wfeat >= out_max[i_f] || !i_n){
+                            out_maxidx[i_f] = nidx; //just used for gradient
+                            out_max[i_f] = wfeat;
+                        }
                     }
                 }
-                t_mean /= (float)n_neigh;
 
-                d_out_feat[I2D(i_v,i_f,n_out_feat)] = t_mean;
-                if(mean_and_max){
-                    d_out_maxidxs[I2D(i_v,i_f,n_feat)] = max_i_n_gidx; //just used for gradient
-                    d_out_feat[I2D(i_v,i_f+n_feat,n_out_feat)] = t_max;
-                }
-                //moments in n_coords x n_neigh loop here {}
+                for(int i_f=0;i_f<n_feat;i_f++)
+                    out_mean[i_f] /= (float)n_neigh;
 
+                //moments in n_coords x n_neigh loop here {}
             }
-
-        }
+        });
     }
 };
 
@@ -3,11 +3,13 @@
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif 
+#define EIGEN_USE_THREADS
 
 #include "tensorflow/core/framework/op_kernel.h"
 #include "helpers.h"
 #include "binned_select_knn_kernel.h"
 #include "binstepper.h"
+#include <vector>
 
 namespace tensorflow {
 typedef Eigen::ThreadPoolDevice CPUDevice;
@@ -48,10 +50,11 @@ static void set_defaults(
         int *d_indices,
         float *d_dist,
         const bool tf_compat,
-        const int n_vert,
+        const int start_vert,
+        const int end_vert,
         const int n_neigh
 ){
-    for(size_t i_v =0 ; i_v < n_vert ; i_v++){
+    for(size_t i_v = start_vert ; i_v < end_vert ; i_v++){
         for(size_t n = 0; n < n_neigh; n++){
 
             if(n){
@@ -69,8 +72,36 @@ static void set_defaults(
     }
 }
 
+/*
+ * buffers that are re-used for all bins processed by the same thread
+ */
+struct bin_search_buffer{
+    std::vector<int> shell_start, shell_end; //vertex ranges of the bins on the current shell
+    std::vector<int> active; //local index of vertices in the bin that still search
+    std::vector<size_t> nfilled, maxidx_local;
+    std::vector<float> maxdistsq;
+
+    void reset(int n_in_bin){
+        active.resize(n_in_bin);
+        nfilled.assign(n_in_bin, 1);//self-reference from defaults
+        maxidx_local.assign(n_in_bin, 0);
+        maxdistsq.assign(n_in_bin, 0);
+        for(int i=0;i<n_in_bin;i++)
+            active[i]=i;
+    }
+};
+
+/*
+ * Processes all vertices in one bin. All of them share the same bin stepping,
+ * so the bins on each shell are only collected once and the resulting candidate
+ * ranges are used for all vertices that are still searching. A vertex stops
+ * stepping outward as soon as it has K neighbours and the K-th distance is
+ * within the radius already covered by the shells.
+ * Only writes to the output rows of vertices in this bin, such that different bins
+ * can be processed in parallel.
+ */
 template<int N_binning_dims>
-static void select_knn_kernel(
+static void select_knn_bin_kernel(
 
         const float * d_coord,
         const int * d_bin_idx,
@@ -89,65 +120,68 @@ static void select_knn_kernel(
         const int n_coords,
         const int n_bin_dim,
 
-        const int n_bboundaries) {
+        const int n_bboundaries,
+        const int i_bin,
+        bin_search_buffer& buf) {
 
     //bin boundaries [i] [i+1] describe the scan ranges
 
+    const int start_vert = d_bin_boundaries[i_bin];
+    const int end_vert = d_bin_boundaries[i_bin+1];
+    if(start_vert >= end_vert || end_vert > n_vert)
+        return;//empty bin or safe guard
 
-    //really no buffering at all here
-
-    for(int i_v = 0; i_v < n_vert; i_v ++){//parallelise in cu
-        if(i_v>=n_vert)
-            return;//safe guard
-
-        //continue;//do nothing
-
-
-        size_t nfilled=1;//self-reference from defaults
-        size_t maxidx_local=0;
-        float maxdistsq=0;
-
-        int total_subbins = 1;
-        for(int sbi=0;sbi<n_bin_dim;sbi++)
-            total_subbins *= d_n_bins[sbi];
-
-        int iv_bin = d_bin_idx[i_v];
-        int gbin_offset = total_subbins*(iv_bin / total_subbins);
-        int sb_flat_offset = iv_bin - gbin_offset;
+    int total_subbins = 1;
+    for(int sbi=0;sbi<n_bin_dim;sbi++)
+        total_subbins *= d_n_bins[sbi];
 
-        //fill with number of bins and global bin index of the point
-        //(without row splits being the first dimension)
-        binstepper<N_binning_dims> stepper(d_n_bins, &d_dim_bin_idx[I2D(i_v,1,n_bin_dim+1)]);
+    //all vertices in this bin have the same (global) bin index
+    const int gbin_offset = total_subbins*(d_bin_idx[start_vert] / total_subbins);
 
-        bool continue_search = true;
-        int distance = 0;
-        while(continue_search){
+    //fill with number of bins and global bin index of the first point
+    //(without row splits being the first dimension)
+    binstepper<N_binning_dims> stepper(d_n_bins, &d_dim_bin_idx[I2D(start_vert,1,n_bin_dim+1)]);
 
-            stepper.set_d(distance);
+    buf.reset(end_vert - start_vert);
 
-            continue_search=false;
+    int distance = 0;
+    while(buf.active.size()){
 
-            while(true){
-                int idx = stepper.step();
-                if(idx<0){//not valid
-                    if(!continue_search && !distance){//this should not happen
-                        printf("stopping search for vtx %d at distance %d\n",i_v,distance);
-                    }
-                    break;
+        //collect candidate ranges on this shell once for all vertices in the bin
+        stepper.set_d(distance);
+        buf.shell_start.clear();
+        buf.shell_end.clear();
+        while(true){
+            int idx = stepper.step();
+            if(idx<0)//not valid
+                break;
 
-                }
+            idx+=gbin_offset;
 
-                idx+=gbin_offset;
+            if(idx>=n_bboundaries-1){
+                printf("idx %d out of range, gb offset %d, distance %d, nbb %d\n", idx, gbin_offset, distance, n_bboundaries);
+                continue;
+            }
+            buf.shell_start.push_back(d_bin_boundaries[idx]);
+            buf.shell_end.push_back(d_bin_boundaries[idx+1]);
+        }
+        if(!buf.shell_start.size()){
+            if(!distance)//this should not happen
+                printf("stopping search for bin %d at distance %d\n",i_bin,distance);
+            break;//search space exhausted
+        }
 
-                if(idx>=n_bboundaries-1){
-                    printf("idx %d out of range, gb offset %d, distance %d, sb_flat_offset %d, nbb %d\n", idx, gbin_offset, distance, sb_flat_offset,n_bboundaries);
-                    continue;
-                }
+        size_t n_still_active=0;
+        for(size_t ia=0;ia<buf.active.size();ia++){
+            const int l_v = buf.active[ia];
+            const size_t i_v = start_vert + l_v;
 
-                int start_vertex = d_bin_boundaries[idx];
-                int end_vertex = d_bin_boundaries[idx+1];
+            size_t nfilled = buf.nfilled[l_v];
+            size_t maxidx_local = buf.maxidx_local[l_v];
+            float maxdistsq = buf.maxdistsq[l_v];
 
-                for(size_t j_v=start_vertex;j_v<end_vertex;j_v++){
+            for(size_t i_s=0;i_s<buf.shell_start.size();i_s++){
+                for(size_t j_v=buf.shell_start[i_s];j_v<buf.shell_end[i_s];j_v++){
                     if(i_v == j_v)
                         continue;
 
@@ -171,43 +205,72 @@ static void select_knn_kernel(
                         maxidx_local = searchLargestDistance(i_v,d_dist,n_neigh,maxdistsq);
                     }
                 }
-
-                continue_search=true;//at least one was valid
-
             }
 
-            if(nfilled==n_neigh && d_bin_width[0]*distance * d_bin_width[0]*distance > maxdistsq)
-                break;//done
+            buf.nfilled[l_v] = nfilled;
+            buf.maxidx_local[l_v] = maxidx_local;
+            buf.maxdistsq[l_v] = maxdistsq;
 
-            distance++;
+            if(nfilled==n_neigh && d_bin_width[0]*distance * d_bin_width[0]*distance > maxdistsq)
+                continue;//done
+            buf.active[n_still_active++] = l_v;
         }
+        buf.active.resize(n_still_active);
 
-    }//cu parallelised loop
+        distance++;
+    }
 }
 
+template<int N_binning_dims>
+static void select_knn_kernel(
+        const CPUDevice &d,
+
+        const float * d_coord,
+        const int * d_bin_idx,
+        const int * d_dim_bin_idx,
 
+        const int * d_bin_boundaries,
+        const int * d_n_bins,
 
-//specify  dimensions
-template __global__ void select_knn_kernel<2>(
-        const float * d_coord,const int * d_bin_idx,const int * d_dim_bin_idx,const int * d_bin_boundaries,
-        const int * d_n_bins,const float* d_bin_width,int *d_indices,float *d_dist,const int n_vert,
-        const int n_neigh,const int n_coords, const int n_bin_dim,
-        const int n_bboundaries);
-template __global__ void select_knn_kernel<3>(
-        const float * d_coord,const int * d_bin_idx,const int * d_dim_bin_idx,const int * d_bin_boundaries,
-        const int * d_n_bins,const float* d_bin_width,int *d_indices,float *d_dist,const int n_vert,
-        const int n_neigh,const int n_coords, const int n_bin_dim,
-        const int n_bboundaries);
-template __global__ void select_knn_kernel<4>(
-        const float * d_coord,const int * d_bin_idx,const int * d_dim_bin_idx,const int * d_bin_boundaries,
-        const int * d_n_bins,const float* d_bin_width,int *d_indices,float *d_dist,const int n_vert,
-        const int n_neigh,const int n_coords, const int n_bin_dim,
-        const int n_bboundaries);
-template __global__ void select_knn_kernel<5>(
-        const float * d_coord,const int * d_bin_idx,const int * d_dim_bin_idx,const int * d_bin_boundaries,
-        const int * d_n_bins,const float* d_bin_width,int *d_indices,float *d_dist,const int n_vert,
-        const int n_neigh,const int n_coords, const int n_bin_dim,
-        const int n_bboundaries);
+        const float* d_bin_width,
+
+        int *d_indices,
+        float *d_dist,
+
+        const int n_vert,
+        const int n_neigh,
+        const int n_coords,
+        const int n_bin_dim,
+
+        const int n_bboundaries) {
+
+    const int n_total_bins = n_bboundaries-1;
+    if(n_total_bins < 1)
+        return;
+
+    //rough estimate: each vertex in a bin checks the vertices in the 3^N surrounding bins
+    double avg_in_bin = (double)n_vert / (double)n_total_bins;
+    double n_cand = avg_in_bin;
+    for(int i=0;i<N_binning_dims;i++)
+        n_cand *= 3.;
+
+    const Eigen::TensorOpCost cost(
+            n_cand * n_coords * sizeof(float),                 //loaded
+            avg_in_bin * n_neigh * (sizeof(int) + sizeof(float)), //stored
+            avg_in_bin * n_cand * (3. * n_coords + 2.) );         //compute
+
+    d.parallelFor(n_total_bins, cost,
+            [&](Eigen::Index first, Eigen::Index last){
+        bin_search_buffer buf;
+        for(Eigen::Index i_bin = first; i_bin < last; i_bin++){
+            select_knn_bin_kernel<N_binning_dims>(d_coord,d_bin_idx,d_dim_bin_idx,
+                    d_bin_boundaries,d_n_bins,d_bin_width,
+                    d_indices,d_dist,
+                    n_vert,n_neigh,n_coords,n_bin_dim,n_bboundaries,
+                    i_bin, buf);
+        }
+    });
+}
 
 
 template<typename dummy>
@@ -235,33 +298,39 @@ struct BinnedSelectKnnOpFunctor<CPUDevice, dummy> { //just because access needs
             const int n_bboundaries,
             bool tf_compat
     ){
-        set_defaults(d_indices,
-                d_dist,
-                tf_compat,
-                n_vert,
-                n_neigh);
-        //really no buffering at all here
+        const Eigen::TensorOpCost default_cost(0, n_neigh * (sizeof(int) + sizeof(float)), n_neigh);
+        d.parallelFor(n_vert, default_cost,
+                [&](Eigen::Index first, Eigen::Index last){
+            set_defaults(d_indices,
+                    d_dist,
+                    tf_compat,
+                    first,
+                    last,
+                    n_neigh);
+        });
+
+        //bins are processed in parallel, each vertex is part of exactly one bin
 
         if(n_bin_dim==2)
-            select_knn_kernel<2>(d_coord,d_bin_idx,d_dim_bin_idx,
+            select_knn_kernel<2>(d, d_coord,d_bin_idx,d_dim_bin_idx,
                 d_bin_boundaries,d_n_bins,d_bin_width,
                 d_indices,d_dist,
                 n_vert,n_neigh,n_coords,n_bin_dim,n_bboundaries);
 
         if(n_bin_dim==3)
-            select_knn_kernel<3>(d_coord,d_bin_idx,d_dim_bin_idx,
+            select_knn_kernel<3>(d, d_coord,d_bin_idx,d_dim_bin_idx,
                 d_bin_boundaries,d_n_bins,d_bin_width,
                 d_indices,d_dist,
                 n_vert,n_neigh,n_coords,n_bin_dim,n_bboundaries);
 
         if(n_bin_dim==4)
-            select_knn_kernel<4>(d_coord,d_bin_idx,d_dim_bin_idx,
+            select_knn_kernel<4>(d, d_coord,d_bin_idx,d_dim_bin_idx,
                 d_bin_boundaries,d_n_bins,d_bin_width,
                 d_indices,d_dist,
                 n_vert,n_neigh,n_coords,n_bin_dim,n_bboundaries);
 
-        if(n_bin_dim==4)
-            select_knn_kernel<5>(d_coord,d_bin_idx,d_dim_bin_idx,
+        if(n_bin_dim==5)
+            select_knn_kernel<5>(d, d_coord,d_bin_idx,d_dim_bin_idx,
                 d_bin_boundaries,d_n_bins,d_bin_width,
                 d_indices,d_dist,
                 n_vert,n_neigh,n_coords,n_bin_dim,n_bboundaries);
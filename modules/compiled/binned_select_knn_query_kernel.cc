@@ -0,0 +1,381 @@
+
+
+#if GOOGLE_CUDA
+#define EIGEN_USE_GPU
+#endif
+#define EIGEN_USE_THREADS
+
+#include "tensorflow/core/framework/op_kernel.h"
+#include "helpers.h"
+#include "binned_select_knn_query_kernel.h"
+#include "binstepper.h"
+
+namespace tensorflow {
+typedef Eigen::ThreadPoolDevice CPUDevice;
+typedef Eigen::GpuDevice GPUDevice;
+
+namespace functor {
+
+
+static float calculateDistance(size_t i_v, size_t j_v, const float * d_coord, size_t n_coords){
+    float distsq=0;
+    if(i_v == j_v)
+        return 0;
+    for(size_t i=0;i<n_coords;i++){
+        float dist = d_coord[I2D(i_v,i,n_coords)] - d_coord[I2D(j_v,i,n_coords)];
+        distsq += dist*dist;
+    }
+    return distsq;
+}
+
+
+static int searchLargestDistance(int i_q, float* d_dist, int n_neigh, float& maxdist){
+
+    maxdist=0;
+    int maxidx=0;
+    if(n_neigh < 2)
+        return maxidx;
+    for(size_t n=1;n<n_neigh;n++){ //0 is self
+        float distsq = d_dist[I2D(i_q,n,n_neigh)];
+        if(distsq > maxdist){
+            maxdist = distsq;
+            maxidx = n;
+        }
+    }
+    return maxidx;
+}
+
+static void set_defaults(
+        int *d_indices,
+        float *d_dist,
+        const bool tf_compat,
+        const int i_q,
+        const int i_v,
+        const int n_neigh
+){
+    for(size_t n = 0; n < n_neigh; n++){
+        if(n && !tf_compat)
+            d_indices[I2D(i_q,n,n_neigh)] = -1;
+        else
+            d_indices[I2D(i_q,n,n_neigh)] = i_v;
+        d_dist[I2D(i_q,n,n_neigh)] = 0;
+    }
+}
+
+/*
+ * Same search as the BinnedSelectKnn kernel, but only for the query vertex i_v,
+ * written to output row i_q. Candidates outside of max_radius are skipped and the
+ * search stops once the shells cover the radius.
+ */
+template<int N_binning_dims>
+static void select_knn_query_kernel(
+
+        const float * d_coord,
+        const int * d_bin_idx,
+        const int * d_dim_bin_idx,
+
+        const int * d_bin_boundaries,
+        const int * d_n_bins,
+
+        const float* d_bin_width,
+
+        int *d_indices,
+        float *d_dist,
+
+        const int n_neigh,
+        const int n_coords,
+        const int n_bin_dim,
+
+        const int n_bboundaries,
+        const float max_radius,
+        const int i_q,
+        const int i_v) {
+
+    size_t nfilled=1;//self-reference from defaults
+    size_t maxidx_local=0;
+    float maxdistsq=0;
+
+    int total_subbins = 1;
+    for(int sbi=0;sbi<n_bin_dim;sbi++)
+        total_subbins *= d_n_bins[sbi];
+
+    const int gbin_offset = total_subbins*(d_bin_idx[i_v] / total_subbins);
+
+    binstepper<N_binning_dims> stepper(d_n_bins, &d_dim_bin_idx[I2D(i_v,1,n_bin_dim+1)]);
+
+    int distance = 0;
+    while(true){
+
+        stepper.set_d(distance);
+        bool valid_shell = false;
+        while(true){
+            int idx = stepper.step();
+            if(idx<0)//not valid
+                break;
+
+            idx+=gbin_offset;
+
+            if(idx>=n_bboundaries-1)
+                continue;//safe guard
+            valid_shell = true;
+
+            for(size_t j_v=d_bin_boundaries[idx];j_v<d_bin_boundaries[idx+1];j_v++){
+                if(i_v == j_v)
+                    continue;
+
+                float distsq = calculateDistance(i_v,j_v,d_coord,n_coords);
+                if(max_radius > 0 && distsq > max_radius)
+                    continue;
+                //fill up
+                if(nfilled< n_neigh){
+                    d_indices[I2D(i_q,nfilled,n_neigh)] = j_v;
+                    d_dist[I2D(i_q,nfilled,n_neigh)] = distsq;
+                    if(distsq > maxdistsq){
+                        maxdistsq = distsq;
+                        maxidx_local = nfilled;
+                    }
+                    nfilled++;
+                    continue;
+                }
+                if(distsq < maxdistsq){
+                    //replace former max
+                    d_indices[I2D(i_q,maxidx_local,n_neigh)] = j_v;
+                    d_dist[I2D(i_q,maxidx_local,n_neigh)] = distsq;
+                    //search new max
+                    maxidx_local = searchLargestDistance(i_q,d_dist,n_neigh,maxdistsq);
+                }
+            }
+        }
+        if(!valid_shell)
+            break;//search space exhausted
+
+        //everything closer than this is covered by the shells so far
+        const float covered = d_bin_width[0]*distance * d_bin_width[0]*distance;
+        if(nfilled==n_neigh && covered > maxdistsq)
+            break;
+        if(max_radius > 0 && covered > max_radius)
+            break;
+
+        distance++;
+    }
+}
+
+template<int N_binning_dims>
+static void select_knn_query(
+        const CPUDevice &d,
+
+        const float * d_coord,
+        const int * d_bin_idx,
+        const int * d_dim_bin_idx,
+
+        const int * d_bin_boundaries,
+        const int * d_n_bins,
+
+        const float* d_bin_width,
+        const int * d_query_idx,
+
+        int *d_indices,
+        float *d_dist,
+
+        const int n_vert,
+        const int n_query,
+        const int n_neigh,
+        const int n_coords,
+        const int n_bin_dim,
+
+        const int n_bboundaries,
+        const bool tf_compat,
+        const float max_radius) {
+
+    //rough estimate: each query checks the vertices in the 3^N surrounding bins
+    const int n_total_bins = n_bboundaries > 1 ? n_bboundaries-1 : 1;
+    double n_cand = (double)n_vert / (double)n_total_bins;
+    for(int i=0;i<N_binning_dims;i++)
+        n_cand *= 3.;
+
+    const Eigen::TensorOpCost cost(
+            n_cand * n_coords * sizeof(float),        //loaded
+            n_neigh * (sizeof(int) + sizeof(float)),  //stored
+            n_cand * (3. * n_coords + 2.) );          //compute
+
+    //each query only writes its own output row
+    d.parallelFor(n_query, cost,
+            [&](Eigen::Index first, Eigen::Index last){
+        for(Eigen::Index i_q = first; i_q < last; i_q++){
+            const int i_v = d_query_idx[i_q];
+            set_defaults(d_indices, d_dist, tf_compat, i_q, i_v, n_neigh);
+            if(i_v < 0 || i_v >= n_vert)
+                continue;//safe guard, not checked in the op: the output row keeps its defaults
+            select_knn_query_kernel<N_binning_dims>(d_coord,d_bin_idx,d_dim_bin_idx,
+                    d_bin_boundaries,d_n_bins,d_bin_width,
+                    d_indices,d_dist,
+                    n_neigh,n_coords,n_bin_dim,n_bboundaries,max_radius,
+                    i_q, i_v);
+        }
+    });
+}
+
+
+template<typename dummy>
+struct BinnedSelectKnnQueryOpFunctor<CPUDevice, dummy> {
+    void operator()(
+            const CPUDevice &d,
+
+            const float * d_coord,
+            const int * d_bin_idx,
+            const int * d_dim_bin_idx,
+
+            const int * d_bin_boundaries,
+            const int * d_n_bins,
+
+            const float* d_bin_width,
+            const int * d_query_idx,
+
+            int *d_indices,
+            float *d_dist,
+
+            const int n_vert,
+            const int n_query,
+            const int n_neigh,
+            const int n_coords,
+            const int n_bin_dim,
+
+            const int n_bboundaries,
+            bool tf_compat,
+            float max_radius
+    ){
+        if(n_bin_dim==2)
+            select_knn_query<2>(d, d_coord,d_bin_idx,d_dim_bin_idx,
+                d_bin_boundaries,d_n_bins,d_bin_width,d_query_idx,
+                d_indices,d_dist,
+                n_vert,n_query,n_neigh,n_coords,n_bin_dim,n_bboundaries,tf_compat,max_radius);
+
+        if(n_bin_dim==3)
+            select_knn_query<3>(d, d_coord,d_bin_idx,d_dim_bin_idx,
+                d_bin_boundaries,d_n_bins,d_bin_width,d_query_idx,
+                d_indices,d_dist,
+                n_vert,n_query,n_neigh,n_coords,n_bin_dim,n_bboundaries,tf_compat,max_radius);
+
+        if(n_bin_dim==4)
+            select_knn_query<4>(d, d_coord,d_bin_idx,d_dim_bin_idx,
+                d_bin_boundaries,d_n_bins,d_bin_width,d_query_idx,
+                d_indices,d_dist,
+                n_vert,n_query,n_neigh,n_coords,n_bin_dim,n_bboundaries,tf_compat,max_radius);
+
+        if(n_bin_dim==5)
+            select_knn_query<5>(d, d_coord,d_bin_idx,d_dim_bin_idx,
+                d_bin_boundaries,d_n_bins,d_bin_width,d_query_idx,
+                d_indices,d_dist,
+                n_vert,n_query,n_neigh,n_coords,n_bin_dim,n_bboundaries,tf_compat,max_radius);
+    }
+};
+
+
+
+template<typename Device>
+class BinnedSelectKnnQueryOp : public OpKernel {
+public:
+    explicit BinnedSelectKnnQueryOp(OpKernelConstruction *context) : OpKernel(context) {
+
+        OP_REQUIRES_OK(context,
+                context->GetAttr("n_neighbours", &K_));
+        OP_REQUIRES_OK(context,
+                context->GetAttr("tf_compatible", &tf_compat_));
+        OP_REQUIRES_OK(context,
+                context->GetAttr("max_radius", &max_radius_));
+        if(max_radius_>0)
+            max_radius_ *= max_radius_;//use squared
+    }
+
+
+    void Compute(OpKernelContext *context) override {
+
+        const Tensor &t_coords = context->input(0);
+        const Tensor &t_bin_idx = context->input(1);
+        const Tensor &t_dim_bin_idx = context->input(2);
+        const Tensor &t_bin_boundaries = context->input(3);
+        const Tensor &t_n_bins = context->input(4);
+        const Tensor &t_bin_width = context->input(5);
+        const Tensor &t_query_idx = context->input(6);
+
+        const int n_vert = t_coords.dim_size(0);
+        const int n_coords = t_coords.dim_size(1);
+        const int n_bboundaries = t_bin_boundaries.dim_size(0);
+        const int n_bin_dims_withrs = t_dim_bin_idx.dim_size(1);
+        const int n_bin_dims = t_n_bins.dim_size(0);
+        const int n_query = t_query_idx.dim_size(0);
+
+        //checks
+
+        OP_REQUIRES(context, n_bin_dims>1,
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects at least 2 binning dimensions."));
+        OP_REQUIRES(context, n_bin_dims<6,
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects maximum 5 binning dimensions."));
+        OP_REQUIRES(context, n_bin_dims_withrs-1 == n_bin_dims,
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects number of bin dimensions (including row splits) -1 == number of total bin dimensions."));
+        OP_REQUIRES(context, n_coords>1,
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects at least 2 dimensions."));
+        OP_REQUIRES(context, n_vert == t_bin_idx.dim_size(0),
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects same first dimension for bin idx and coordinates."));
+        OP_REQUIRES(context, 1 == t_bin_width.dim_size(0),
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects singleton (dim(1)) for bin width."));
+        OP_REQUIRES(context, t_query_idx.dims() == 1,
+                    errors::InvalidArgument("BinnedSelectKnnQueryOp expects a 1D query index tensor."));
+
+
+        TensorShape outputShape;
+        outputShape.AddDim(n_query);
+        outputShape.AddDim(K_);
+
+        Tensor *output_tensor = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(0, outputShape, &output_tensor));
+
+        Tensor *output_distances = NULL;
+        OP_REQUIRES_OK(context, context->allocate_output(1, outputShape, &output_distances));
+
+
+        BinnedSelectKnnQueryOpFunctor<Device, int>() (
+                context->eigen_device<Device>(),
+
+                t_coords.flat<float>().data(),
+                t_bin_idx.flat<int>().data(),
+                t_dim_bin_idx.flat<int>().data(),
+
+                t_bin_boundaries.flat<int>().data(),
+                t_n_bins.flat<int>().data(),
+
+                t_bin_width.flat<float>().data(),
+                t_query_idx.flat<int>().data(),
+
+                output_tensor->flat<int>().data(),
+                output_distances->flat<float>().data(),
+
+                n_vert,
+                n_query,
+                K_,
+                n_coords,
+                n_bin_dims,
+
+                n_bboundaries,
+                tf_compat_,
+                max_radius_
+        );
+
+    }
+private:
+    int K_;
+    bool tf_compat_;
+    float max_radius_;
+
+};
+
+REGISTER_KERNEL_BUILDER(Name("BinnedSelectKnnQuery").Device(DEVICE_CPU), BinnedSelectKnnQueryOp<CPUDevice>);
+
+//no GPU implementation yet, the op runs on the CPU
+//#ifdef GOOGLE_CUDA
+//extern template struct BinnedSelectKnnQueryOpFunctor<GPUDevice, int>;
+//REGISTER_KERNEL_BUILDER(Name("BinnedSelectKnnQuery").Device(DEVICE_GPU), BinnedSelectKnnQueryOp<GPUDevice>);
+//#endif
+
+}//functor
+}//tensorflow
@@ -0,0 +1,7 @@
+//#define GOOGLE_CUDA 1
+
+// BinnedSelectKnnQuery has no GPU implementation (yet), the op runs on the CPU.
+// This file only exists for the common build rule of the ops.
+
+#if GOOGLE_CUDA
+#endif  // GOOGLE_CUDA
@@ -0,0 +1,22 @@
+
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/shape_inference.h"
+
+using namespace tensorflow;
+
+
+REGISTER_OP("BinnedSelectKnnQuery")
+    .Attr("n_neighbours: int")
+    .Attr("tf_compatible: bool")
+    .Attr("max_radius: float")
+    .Input("coords: float")
+    .Input("bin_idx: int32")
+    .Input("dim_bin_idx: int32")
+    .Input("bin_boundaries: int32")
+    .Input("n_bins: int32")
+    .Input("bin_width: float")
+    .Input("query_idx: int32") //vertices that search for neighbours
+    .Output("indices: int32")  //query x K
+    .Output("distances: float32");
+
+
@@ -2,6 +2,7 @@
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
+#define EIGEN_USE_THREADS
 
 
 #include "tensorflow/core/framework/op_kernel.h"
@@ -9,6 +10,10 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <vector>
+#include <queue>
+#include <algorithm>
+#include <memory>
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -54,38 +59,178 @@ static void copy_to_sum_and_default(
 }
 
 
-static void get_max_beta(
-        const float* temp_betas,
+/*
+ * Candidates for condensation points in one row split: all unassociated vertices
+ * with beta above min_beta, highest beta first and lowest index first for equal
+ * betas (the same order as a linear search for the maximum).
+ * With soft suppression the betas only decrease. Entries are then updated
+ * lazily: a popped entry with an outdated beta is inserted again with the
+ * current one. Each condensation point is found in O(log N) instead of O(N).
+ */
+class condensate_candidates {
+public:
+    condensate_candidates(const float* temp_betas,
+            const int start_vertex,
+            const int end_vertex,
+            const float min_beta){
+        std::vector<entry> entries;
+        for(int i_v=start_vertex;i_v<end_vertex;i_v++){
+            if(temp_betas[i_v] > min_beta)
+                entries.push_back(entry(temp_betas[i_v], i_v));
+        }
+        queue_ = queue_type(compare(), std::move(entries));
+    }
+
+    //returns -1 if there is no candidate left
+    int next(const float* temp_betas,
+            const int *asso_idx,
+            const float min_beta){
+        while(!queue_.empty()){
+            const entry top = queue_.top();
+            queue_.pop();
+            const int i_v = top.second;
+            if(asso_idx[i_v] >= 0)
+                continue;
+            const float beta = temp_betas[i_v];
+            if(beta != top.first){//reduced by soft suppression
+                if(beta > min_beta)
+                    queue_.push(entry(beta, i_v));
+                continue;
+            }
+            return i_v;
+        }
+        return -1;
+    }
+
+private:
+    typedef std::pair<float,int> entry;
+    struct compare{
+        bool operator()(const entry& a, const entry& b) const {
+            if(a.first != b.first)
+                return a.first < b.first;
+            return a.second > b.second;
+        }
+    };
+    typedef std::priority_queue<entry, std::vector<entry>, compare> queue_type;
+    queue_type queue_;
+};
+
+static void select_condensate(
+        const int ref,
         int *asso_idx,
-        int * is_cpoint,
-        int * maxidx,
+        int * is_cpoint){
+    is_cpoint[ref]=1;
+    asso_idx[ref]=ref;
+}
 
-        const int n_vert,
-        const int start_vertex,
-        const int end_vertex,
-        const float min_beta){
-
-    //this needs to be some smart algo here
-    //it will be called N_condensate times at least
-    int ref=-1;
-    float max = min_beta;
-    for(int i_v=start_vertex;i_v<end_vertex;i_v++){
-        float biv = temp_betas[i_v];
-        if(biv > max && asso_idx[i_v] < 0){
-            max=biv;
-            ref=i_v;
+/*
+ * Regular grid over (up to) the first three clustering coordinates of one row split,
+ * used to find the vertices within the radius of a condensation point without
+ * looping over all vertices. Only used if the radius is the only thing that matters
+ * (no soft suppression and no sum, both have infinite range).
+ */
+class condensate_grid {
+public:
+    condensate_grid(const float *d_ccoords,
+            const float *d_dist,
+            const float *temp_betas,
+            const int n_ccoords,
+            const int start_vertex,
+            const int end_vertex,
+            const float radius,
+            const float min_beta){
+
+        n_dims_ = std::min(n_ccoords, 3);
+        n_ccoords_ = n_ccoords;
+        const int n = end_vertex - start_vertex;
+
+        //cells of the size of the largest radius of any candidate
+        float cellsize = 0;
+        for(int i_v=start_vertex;i_v<end_vertex;i_v++){
+            if(temp_betas[i_v] > min_beta)
+                cellsize = std::max(cellsize, d_dist[i_v] * radius);
+        }
+
+        //no more cells than vertices
+        const float max_bins_per_dim = std::max(1.f, std::floor(std::pow((float)n, 1.f/std::max(n_dims_,1))));
+
+        n_cells_ = 1;
+        for(int i_d=0;i_d<n_dims_;i_d++){
+            float min = 0, max = 0;
+            for(int i_v=start_vertex;i_v<end_vertex;i_v++){
+                float x = d_ccoords[I2D(i_v,i_d,n_ccoords)];
+                if(i_v == start_vertex || x < min) min = x;
+                if(i_v == start_vertex || x > max) max = x;
+            }
+            min_[i_d] = min;
+            n_bins_[i_d] = 1;
+            if(cellsize > 0 && std::isfinite(max - min))
+                n_bins_[i_d] = (long)std::min(max_bins_per_dim, std::max(1.f, std::ceil((max - min) / cellsize)));
+            binwidth_[i_d] = n_bins_[i_d] > 1 ? (max - min) / n_bins_[i_d] : 1.f;
+            n_cells_ *= n_bins_[i_d];
         }
 
+        //counting sort of the vertices by cell
+        std::vector<int> cell(n);
+        cell_start_.assign(n_cells_ + 1, 0);
+        for(int i_v=start_vertex;i_v<end_vertex;i_v++){
+            long bins[3];
+            get_bins(d_ccoords + I2D(i_v,0,n_ccoords), bins);
+            cell[i_v-start_vertex] = flat_index(bins);
+            cell_start_[cell[i_v-start_vertex]+1]++;
+        }
+        for(long i_c=0;i_c<n_cells_;i_c++)
+            cell_start_[i_c+1] += cell_start_[i_c];
+        vertices_.resize(n);
+        std::vector<int> fill(cell_start_.begin(), cell_start_.end()-1);
+        for(int i=0;i<n;i++)
+            vertices_[fill[cell[i]]++] = i + start_vertex;
     }
 
-    //if none can be found set ref to -1
-    *maxidx = ref;
-    if(ref>=0){
-        is_cpoint[ref]=1;
-        asso_idx[ref]=ref;
+    //calls f(i_v) for all vertices in the cells overlapping with the box of size 2*radius around ref
+    template<class F>
+    void for_each_in_box(const float *d_ccoords, const int ref, const float radius, F f) const {
+        long lo[3] = {0,0,0}, hi[3] = {0,0,0};
+        for(int i_d=0;i_d<n_dims_;i_d++){
+            float x = d_ccoords[I2D(ref,i_d,n_ccoords_)];
+            lo[i_d] = clamp_bin(i_d, std::floor((x - radius - min_[i_d]) / binwidth_[i_d]));
+            hi[i_d] = clamp_bin(i_d, std::floor((x + radius - min_[i_d]) / binwidth_[i_d]));
+        }
+        long bins[3] = {0,0,0};
+        for(bins[0]=lo[0];bins[0]<=hi[0];bins[0]++)
+        for(bins[1]=lo[1];bins[1]<=hi[1];bins[1]++)
+        for(bins[2]=lo[2];bins[2]<=hi[2];bins[2]++){
+            const long i_c = flat_index(bins);
+            for(int i=cell_start_[i_c];i<cell_start_[i_c+1];i++)
+                f(vertices_[i]);
+        }
+    }
+
+private:
+    long clamp_bin(const int i_d, const float bin) const {
+        if(!(bin > 0)) return 0; //also nan
+        if(bin >= n_bins_[i_d]) return n_bins_[i_d]-1;
+        return (long)bin;
+    }
+    void get_bins(const float * x, long * bins) const {
+        for(int i_d=0;i_d<3;i_d++)
+            bins[i_d] = i_d < n_dims_ ? clamp_bin(i_d, std::floor((x[i_d] - min_[i_d]) / binwidth_[i_d])) : 0;
+    }
+    long flat_index(const long * bins) const {
+        long idx = 0;
+        for(int i_d=0;i_d<n_dims_;i_d++)
+            idx = idx * n_bins_[i_d] + bins[i_d];
+        return idx;
     }
-}
 
+    int n_dims_, n_ccoords_;
+    long n_bins_[3] = {1,1,1};
+    float min_[3] = {0,0,0};
+    float binwidth_[3] = {1,1,1};
+    long n_cells_;
+    std::vector<int> cell_start_;
+    std::vector<int> vertices_;
+};
 
 static float distancesq(const int v_a,
         const int v_b,
@@ -163,6 +308,31 @@ static void check_and_collect(
 
 
 
+//same as check_and_collect without soft suppression and sum, only visits the vertices close by
+static void collect_in_radius(
+
+        const int ref_vertex,
+        const condensate_grid& grid,
+        const float *d_ccoords,
+        const float *d_dist,
+        int *asso_idx,
+        const int n_ccoords,
+        const float radiussq){
+
+    float modradiussq = d_dist[ref_vertex];
+    modradiussq *= modradiussq;// squared, as distsq and radius
+    modradiussq *= radiussq;
+
+    grid.for_each_in_box(d_ccoords, ref_vertex, std::sqrt(modradiussq), [&](const int i_v){
+        if(asso_idx[i_v] < 0 || i_v == ref_vertex){
+            float distsq = distancesq(ref_vertex,i_v,d_ccoords,n_ccoords);
+            if(distsq <= modradiussq){
+                asso_idx[i_v] = ref_vertex;
+            }
+        }
+    });
+}
+
 // CPU specialization
 template<typename dummy>
 struct BuildCondensatesOpFunctor<CPUDevice, dummy> {
@@ -194,60 +364,87 @@ struct BuildCondensatesOpFunctor<CPUDevice, dummy> {
             const bool sum) {
 
 
-        if(sum){
-            copy_to_sum_and_default(d_tosum,temp_tosum,summed,n_vert,n_sumf);
-        }
+        // Row splits are independent and run in parallel, each one only
+        // writes to its own vertices.
+        const int n_rs_v = n_rs - 1;
+        const double avg_vert = n_rs_v > 0 ? (double)n_vert / n_rs_v : 0;
+        const Eigen::TensorOpCost cost(
+                avg_vert * (n_ccoords + n_sumf + 2) * sizeof(float), //loaded
+                avg_vert * (2 * sizeof(int) + n_sumf * sizeof(float)), //stored
+                avg_vert * (n_ccoords + n_sumf + 10) * 10.);           //compute
 
-        for(size_t j_rs=0;j_rs<n_rs-1;j_rs++){
-            const int start_vertex = row_splits[j_rs];
-            const int end_vertex = row_splits[j_rs+1];
-
-            set_defaults(asso_idx,is_cpoint,d_betas,temp_betas,start_vertex,end_vertex,n_vert);
-
-            int ref;
-            get_max_beta(temp_betas,asso_idx,is_cpoint,&ref,n_vert,start_vertex,end_vertex,min_beta);
-            //copy ref back
-            float ref_beta = d_betas[ref];
-            int ncond=0;
-            //copy ref and refBeta from GPU to CPU
-
-            while(ref>=0){
-
-               // if(asso_idx[ref] >=0) continue; //
-               // if(temp_betas[ref] < min_beta)continue;
-                 //probably better to copy here instead of accessing n_vert times in GPU mem
-                ncond++;
-
-                check_and_collect(
-                        ref,
-                        ref_beta,
-                        d_ccoords,
-                        d_betas,
-                        d_dist,
-                        d_tosum,
-                        asso_idx,
-                        temp_betas,
-                        temp_tosum,
-                        summed,
-                        n_vert,
-                        n_ccoords,
-                        n_sumf,
-                        start_vertex,
-                        end_vertex,
-                        radius,
-                        min_beta,
-                        soft,
-                        sum);
-
-                get_max_beta(temp_betas,asso_idx,is_cpoint,&ref,n_vert,start_vertex,end_vertex,min_beta);
-                //copy ref and refBeta from GPU to CPU
-                ref_beta = d_betas[ref];
-            }
+        d.parallelFor(n_rs_v, cost,
+                [&](Eigen::Index first, Eigen::Index last){
 
-            n_condensates[j_rs] = ncond;
+            for(Eigen::Index j_rs=first;j_rs<last;j_rs++){
+                const int start_vertex = row_splits[j_rs];
+                const int end_vertex = row_splits[j_rs+1];
 
+                if(sum){
+                    copy_to_sum_and_default(d_tosum + I2D(start_vertex,0,n_sumf),
+                            temp_tosum + I2D(start_vertex,0,n_sumf),
+                            summed + I2D(start_vertex,0,n_sumf),
+                            end_vertex-start_vertex,n_sumf);
+                }
 
-        }
+                set_defaults(asso_idx,is_cpoint,d_betas,temp_betas,start_vertex,end_vertex,n_vert);
+
+                condensate_candidates candidates(temp_betas,start_vertex,end_vertex,min_beta);
+
+                //without soft suppression and sum, only the vertices within the radius are affected
+                const bool use_grid = !soft && !sum;
+                std::unique_ptr<condensate_grid> grid;
+                if(use_grid)
+                    grid.reset(new condensate_grid(d_ccoords,d_dist,temp_betas,n_ccoords,
+                            start_vertex,end_vertex,std::sqrt(radius),min_beta));
+
+                int ncond=0;
+                int ref = candidates.next(temp_betas,asso_idx,min_beta);
+
+                while(ref>=0){
+
+                    select_condensate(ref,asso_idx,is_cpoint);
+                    ncond++;
+
+                    if(use_grid){
+                        collect_in_radius(
+                                ref,
+                                *grid,
+                                d_ccoords,
+                                d_dist,
+                                asso_idx,
+                                n_ccoords,
+                                radius);
+                    }
+                    else{
+                        check_and_collect(
+                                ref,
+                                d_betas[ref],
+                                d_ccoords,
+                                d_betas,
+                                d_dist,
+                                d_tosum,
+                                asso_idx,
+                                temp_betas,
+                                temp_tosum,
+                                summed,
+                                n_vert,
+                                n_ccoords,
+                                n_sumf,
+                                start_vertex,
+                                end_vertex,
+                                radius,
+                                min_beta,
+                                soft,
+                                sum);
+                    }
+
+                    ref = candidates.next(temp_betas,asso_idx,min_beta);
+                }
+
+                n_condensates[j_rs] = ncond;
+            }
+        });
 
     }
 };
@@ -2,6 +2,7 @@
 #if GOOGLE_CUDA
 #define EIGEN_USE_GPU
 #endif  // GOOGLE_CUDA
+#define EIGEN_USE_THREADS
 
 
 #include "tensorflow/core/framework/op_kernel.h"
@@ -9,6 +10,7 @@
 #include "helpers.h"
 #include <string> //size_t, just for helper function
 #include <cmath>
+#include <algorithm> //upper_bound
 
 #include <iostream> //remove later DEBUG FIXME
 
@@ -62,27 +64,36 @@ void set_defaults(
         int *d_indices,
         float *d_dist,
         const bool tf_compat,
-        const int n_vert,
+        const int i_v,
         const int n_neigh
 ){
-    for(size_t i_v =0 ; i_v < n_vert ; i_v++){
-        for(size_t n = 0; n < n_neigh; n++){
-
-            if(n){
-                if(tf_compat)
-                    d_indices[I2D(i_v,n,n_neigh)] = i_v;
-                else
-                    d_indices[I2D(i_v,n,n_neigh)] = -1;
-            }
-            else{
-                d_indices[I2D(i_v,n,n_neigh)] = i_v;
-            }
-            d_dist[I2D(i_v,n,n_neigh)] = 0;
+    for(size_t n = 0; n < n_neigh; n++){
 
+        if(n){
+            if(tf_compat)
+                d_indices[I2D(i_v,n,n_neigh)] = i_v;
+            else
+                d_indices[I2D(i_v,n,n_neigh)] = -1;
         }
+        else{
+            d_indices[I2D(i_v,n,n_neigh)] = i_v;
+        }
+        d_dist[I2D(i_v,n,n_neigh)] = 0;
+
     }
 }
 
+//finds the row split a vertex belongs to. row splits are sorted, so this is a simple bisection
+int find_row_split(const int i_v, const int* d_row_splits, const int n_rs){
+    const int* upper = std::upper_bound(d_row_splits, d_row_splits + n_rs, i_v);
+    return (int)(upper - d_row_splits) - 1;
+}
+
+/*
+ * processes one vertex only and writes only to the rows of this vertex in
+ * d_indices and d_dist. Therefore, it can be called for different vertices
+ * from different threads without any synchronisation.
+ */
 void select_knn_kernel(
         const float *d_coord,
         const int* d_row_splits,
@@ -94,6 +105,7 @@ void select_knn_kernel(
         const int n_neigh,
         const int n_coords,
 
+        const size_t i_v,
         const int j_rs,
         const bool tf_compat,
         const float max_radius,
@@ -105,73 +117,71 @@ void select_knn_kernel(
     const size_t start_vert = d_row_splits[j_rs];
     const size_t end_vert = d_row_splits[j_rs+1];
 
-    for(size_t i_v = start_vert; i_v < end_vert; i_v ++){
-        if(i_v>=n_vert)
-            return;//this will be a problem with actual RS, just a safety net
+    if(i_v>=n_vert)
+        return;//this will be a problem with actual RS, just a safety net
 
 
+    if(mask_mode != selknn::mm_none){
+        if(mask_logic == selknn::ml_and){
+            if(!d_mask[i_v])
+                return;
+        }
+        else{
+            if(mask_mode == selknn::mm_scat && d_mask[i_v])
+                return;
+            else if(mask_mode == selknn::mm_acc && !d_mask[i_v])
+                return;
+        }
+    }
+
+    //protection against n_vert<n_neigh
+    size_t nvert_in_row = end_vert - start_vert;
+    size_t max_neighbours = n_neigh;
+    //set default to self
+    if(nvert_in_row<n_neigh){
+        max_neighbours=nvert_in_row;
+    }
+
+
+    size_t nfilled=1;
+    size_t maxidx_local=0;
+    float maxdistsq=0;
+
+    for(size_t j_v=start_vert;j_v<end_vert;j_v++){
+        if(i_v == j_v)
+            continue;
+
         if(mask_mode != selknn::mm_none){
             if(mask_logic == selknn::ml_and){
-                if(!d_mask[i_v])
+                if(!d_mask[j_v])
                     continue;
             }
             else{
-                if(mask_mode == selknn::mm_scat && d_mask[i_v])
+                if(mask_mode == selknn::mm_scat && !d_mask[j_v])
                     continue;
-                else if(mask_mode == selknn::mm_acc && !d_mask[i_v])
+                else if(mask_mode == selknn::mm_acc && d_mask[j_v])
                     continue;
             }
         }
 
-        //protection against n_vert<n_neigh
-        size_t nvert_in_row = end_vert - start_vert;
-        size_t max_neighbours = n_neigh;
-        //set default to self
-        if(nvert_in_row<n_neigh){
-            max_neighbours=nvert_in_row;
-        }
-
-
-        size_t nfilled=1;
-        size_t maxidx_local=0;
-        float maxdistsq=0;
-
-        for(size_t j_v=start_vert;j_v<end_vert;j_v++){
-            if(i_v == j_v)
-                continue;
-
-            if(mask_mode != selknn::mm_none){
-                if(mask_logic == selknn::ml_and){
-                    if(!d_mask[j_v])
-                        continue;
-                }
-                else{
-                    if(mask_mode == selknn::mm_scat && !d_mask[j_v])
-                        continue;
-                    else if(mask_mode == selknn::mm_acc && d_mask[j_v])
-                        continue;
-                }
-            }
-
-            //fill up
-            float distsq = calculateDistance(i_v,j_v,d_coord,n_coords);
-            if(nfilled<max_neighbours && (max_radius<=0 || max_radius>=distsq)){
-                d_indices[I2D(i_v,nfilled,n_neigh)] = j_v;
-                d_dist[I2D(i_v,nfilled,n_neigh)] = distsq;
-                if(distsq > maxdistsq){
-                    maxdistsq = distsq;
-                    maxidx_local = nfilled;
-                }
-                nfilled++;
-                continue;
-            }
-            if(distsq < maxdistsq){// automatically applies to max radius
-                //replace former max
-                d_indices[I2D(i_v,maxidx_local,n_neigh)] = j_v;
-                d_dist[I2D(i_v,maxidx_local,n_neigh)] = distsq;
-                //search new max
-                maxidx_local = searchLargestDistance(i_v,d_dist,n_neigh,maxdistsq);
+        //fill up
+        float distsq = calculateDistance(i_v,j_v,d_coord,n_coords);
+        if(nfilled<max_neighbours && (max_radius<=0 || max_radius>=distsq)){
+            d_indices[I2D(i_v,nfilled,n_neigh)] = j_v;
+            d_dist[I2D(i_v,nfilled,n_neigh)] = distsq;
+            if(distsq > maxdistsq){
+                maxdistsq = distsq;
+                maxidx_local = nfilled;
             }
+            nfilled++;
+            continue;
+        }
+        if(distsq < maxdistsq){// automatically applies to max radius
+            //replace former max
+            d_indices[I2D(i_v,maxidx_local,n_neigh)] = j_v;
+            d_dist[I2D(i_v,maxidx_local,n_neigh)] = distsq;
+            //search new max
+            maxidx_local = searchLargestDistance(i_v,d_dist,n_neigh,maxdistsq);
         }
     }
 
@@ -199,30 +209,63 @@ struct SelectKnnOpFunctor<CPUDevice, dummy> {
             selknn::mask_logic_en mask_logic) {
 
 
-        set_defaults(d_indices,
-                d_dist,
-                tf_compat,
-                n_vert,
-                n_neigh);
-        //really no buffering at all here
-
-        for(size_t j_rs=0;j_rs<n_rs-1;j_rs++){
-            select_knn_kernel(d_coord,
-                    d_row_splits,
-                    d_mask,
-                    d_indices,
-                    d_dist,
-
-                    n_vert,
-                    n_neigh,
-                    n_coords,
-
-                    j_rs,
-                    tf_compat,
-                    max_radius,
-                    mask_mode,
-                    mask_logic);
+        if(n_rs < 2){//no row splits, just defaults
+            for(size_t i_v = 0; i_v < n_vert; i_v++)
+                set_defaults(d_indices, d_dist, tf_compat, i_v, n_neigh);
+            return;
         }
+
+        /*
+         * Vertices are sharded over the intra-op thread pool, independent of the row split
+         * they belong to. Each vertex only writes its own output rows, so no locking is needed.
+         * The cost estimate is based on the average row split size and lets
+         * Eigen decide on the block size (and to stay serial for small inputs).
+         */
+        const double avg_vert_in_row = (double)d_row_splits[n_rs-1] / (double)(n_rs-1);
+        const Eigen::TensorOpCost cost(
+                avg_vert_in_row * n_coords * sizeof(float), //loaded
+                n_neigh * (sizeof(int) + sizeof(float)),    //stored
+                avg_vert_in_row * (3. * n_coords + 2.) );    //compute
+
+        d.parallelFor(n_vert, cost,
+                [&](Eigen::Index first, Eigen::Index last){
+
+            //row splits are sorted, only search once per shard
+            int j_rs = find_row_split(first, d_row_splits, n_rs);
+
+            for(Eigen::Index i_v = first; i_v < last; i_v++){
+
+                set_defaults(d_indices,
+                        d_dist,
+                        tf_compat,
+                        i_v,
+                        n_neigh);
+
+                if(i_v < d_row_splits[0] || i_v >= d_row_splits[n_rs-1])
+                    continue; //not covered by any row split
+
+                //stops at n_rs-2 at the latest, as i_v < d_row_splits[n_rs-1]
+                while(i_v >= d_row_splits[j_rs+1])
+                    j_rs++;
+
+                select_knn_kernel(d_coord,
+                        d_row_splits,
+                        d_mask,
+                        d_indices,
+                        d_dist,
+
+                        n_vert,
+                        n_neigh,
+                        n_coords,
+
+                        i_v,
+                        j_rs,
+                        tf_compat,
+                        max_radius,
+                        mask_mode,
+                        mask_logic);
+            }
+        });
     }
 };
 
@@ -0,0 +1,115 @@
+'''
+Benchmarks the multi-threaded CPU path of AccumulateKnn and its gradient.
+
+Runs the op (mean and max) and its gradient on CPU for a few sizes typical
+for RaggedGravNet / DistanceWeightedMessagePassing layers with an increasing
+number of intra-op threads. The number of threads can only be set before
+tensorflow is initialised, therefore each point is run in a separate process.
+The outputs and gradients of all runs are compared to the single-thread
+result, which needs to be identical.
+
+usage: python3 test_accumulate_knn_cpu_scaling.py [max threads]
+'''
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+# vertices, neighbours, features
+CONFIGS = [(20000, 16, 32),
+           (20000, 64, 64),
+           (100000, 40, 32)]
+N_ITERS = 10
+
+
+def createData(nvert, nneigh, nfeat):
+    np.random.seed(42)
+    features = np.random.rand(nvert, nfeat).astype('float32') - 0.5
+    distances = np.random.rand(nvert, nneigh).astype('float32')
+    distances[:, 0] = 0.
+    # self as first neighbour, then unique neighbours, some rows padded with -1
+    offsets = np.random.choice(np.arange(1, nvert), nneigh - 1, replace=False)
+    indices = np.concatenate([np.zeros((1,), dtype='int64'), offsets])[np.newaxis, :] + np.arange(nvert)[:, np.newaxis]
+    indices = (indices % nvert).astype('int32')
+    npad = np.random.randint(0, nneigh // 2, size=nvert)
+    npad[np.random.rand(nvert) < 0.8] = 0
+    indices[np.arange(nneigh)[np.newaxis, :] >= (nneigh - npad)[:, np.newaxis]] = -1
+    grad = np.random.rand(nvert, 2 * nfeat).astype('float32')
+    return distances, features, indices, grad
+
+
+def run_single(nthreads, outfile):
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(nthreads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from accknn_op import AccumulateKnn
+
+    results = {}
+    for i_c, (nvert, nneigh, nfeat) in enumerate(CONFIGS):
+        distances, features, indices, grad = [tf.constant(a) for a in createData(nvert, nneigh, nfeat)]
+
+        def forward_and_grad():
+            with tf.GradientTape() as tape:
+                tape.watch([distances, features])
+                out, _ = AccumulateKnn(distances=distances, features=features, indices=indices)
+            dist_grad, feat_grad = tape.gradient(out, [distances, features], output_gradients=grad)
+            return out, dist_grad, feat_grad
+
+        with tf.device('/cpu:0'):
+            forward_and_grad() #warm up
+            t0 = time.time()
+            for _ in range(N_ITERS):
+                out, _ = AccumulateKnn(distances=distances, features=features, indices=indices)
+            fwd_time = (time.time()-t0)/N_ITERS
+            t0 = time.time()
+            for _ in range(N_ITERS):
+                out, dist_grad, feat_grad = forward_and_grad()
+            fwd_bwd_time = (time.time()-t0)/N_ITERS
+
+        results['out_'+str(i_c)] = out.numpy()
+        results['dist_grad_'+str(i_c)] = dist_grad.numpy()
+        results['feat_grad_'+str(i_c)] = feat_grad.numpy()
+        results['fwd_time_'+str(i_c)] = fwd_time
+        results['bwd_time_'+str(i_c)] = fwd_bwd_time - fwd_time
+
+    np.savez(outfile, **results)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--single':
+        run_single(int(sys.argv[2]), sys.argv[3])
+        exit()
+
+    max_threads = os.cpu_count()
+    if len(sys.argv) > 1:
+        max_threads = int(sys.argv[1])
+
+    nthreads_list = [1]
+    while nthreads_list[-1]*2 <= max_threads:
+        nthreads_list.append(nthreads_list[-1]*2)
+    if nthreads_list[-1] != max_threads:
+        nthreads_list.append(max_threads)
+
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    for nthreads in nthreads_list:
+        outfile = os.path.join(tmpdir, 'accknn_'+str(nthreads)+'.npz')
+        subprocess.check_call([sys.executable, __file__, '--single', str(nthreads), outfile])
+        results[nthreads] = np.load(outfile)
+
+    ref = results[1]
+    for i_c, (nvert, nneigh, nfeat) in enumerate(CONFIGS):
+        print('V', nvert, 'K', nneigh, 'F', nfeat)
+        print('threads', 'fwd [s]', 'speedup', 'grad [s]', 'speedup', sep='\t')
+        for nthreads in nthreads_list:
+            res = results[nthreads]
+            for key in ['out_', 'dist_grad_', 'feat_grad_']:
+                assert np.all(res[key+str(i_c)] == ref[key+str(i_c)]), key+'differs for '+str(nthreads)+' threads'
+            fwd, bwd = res['fwd_time_'+str(i_c)], res['bwd_time_'+str(i_c)]
+            print(nthreads, '%.5f' % fwd, '%.2f' % (ref['fwd_time_'+str(i_c)]/fwd),
+                  '%.5f' % bwd, '%.2f' % (ref['bwd_time_'+str(i_c)]/bwd), sep='\t')
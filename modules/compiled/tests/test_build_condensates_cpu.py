@@ -0,0 +1,110 @@
+'''
+Compares the CPU BuildCondensates op to a simple python implementation of the greedy
+algorithm for several row splits and numbers of clustering coordinates: without soft
+suppression and sum (spatial grid), and with soft suppression and/or sum (candidate
+queue with lazy updates and per row split sum buffers).
+'''
+
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from condensate_op import BuildCondensates
+
+
+def build_condensates_reference(ccoords, betas, dist, row_splits, radius, min_beta, soft=False, tosum=None):
+    '''
+    same arithmetic as the kernel in float32, the highest (suppressed) beta first,
+    lowest index first for equal betas
+    '''
+    radiussq = np.float32(radius) * np.float32(radius)
+    asso = np.zeros(len(betas), dtype='int32')
+    is_cpoint = np.zeros(len(betas), dtype='int32')
+    temp_betas = betas.astype('float32').copy()
+    summed = None
+    if tosum is not None:
+        temp_tosum = tosum.astype('float32').copy()
+        summed = np.zeros_like(temp_tosum)
+    n_cond = []
+    for start, end in zip(row_splits[:-1], row_splits[1:]):
+        asso[start:end] = -start - 1
+        vertices = np.arange(start, end)
+        ncond = 0
+        while True:
+            candidates = np.logical_and(asso[start:end] < 0, temp_betas[start:end] > min_beta)
+            if not np.any(candidates):
+                break
+            ref = start + int(np.argmax(np.where(candidates, temp_betas[start:end], -np.inf)))
+            ncond += 1
+            is_cpoint[ref] = 1
+            asso[ref] = ref
+            modradiussq = np.float32(dist[ref] * dist[ref]) * radiussq
+
+            sel = vertices[np.logical_or(asso[start:end] < 0, vertices == ref)]
+            distsq = np.zeros(len(sel), dtype='float32')
+            for i in range(ccoords.shape[1]):
+                distsq += (ccoords[ref, i] - ccoords[sel, i]) ** 2
+            prob = np.exp(-distsq.astype('float64') / (2. * np.float64(modradiussq))).astype('float32')
+            if soft:
+                temp_betas[sel] = temp_betas[sel] - prob * betas[ref]
+            asso[sel[distsq <= modradiussq]] = ref
+            if tosum is not None:
+                tmpfeat = temp_tosum[sel]
+                contrib = np.minimum(prob[:, np.newaxis] * tosum[sel], tmpfeat)
+                contrib = np.where(tmpfeat > 0, contrib, np.float32(0.))
+                # summed in vertex order, as in the kernel
+                summed[ref] = np.add.accumulate(contrib, axis=0, dtype='float32')[-1]
+                temp_tosum[sel] = tmpfeat - contrib
+        n_cond.append(ncond)
+    return asso, is_cpoint, np.array(n_cond, dtype='int32'), summed
+
+
+def create_data(ncoords, nvert=3000, nsum=2):
+    np.random.seed(ncoords)
+    ccoords = (np.random.rand(nvert, ncoords) * 5.).astype('float32')
+    betas = np.random.rand(nvert).astype('float32')
+    betas[::7] = betas[1::7][:len(betas[::7])]  # some equal betas
+    dist = np.random.uniform(0.5, 2., nvert).astype('float32')
+    tosum = np.random.uniform(0.1, 1., (nvert, nsum)).astype('float32')
+    row_splits = np.array([0, 1000, 1000, 2200, nvert], dtype='int32')
+    return ccoords, betas, dist, tosum, row_splits
+
+
+class BuildCondensatesCPUTestCases(unittest.TestCase):
+
+    def compare(self, soft, dosum, radius=0.4, min_beta=0.2):
+        for ncoords in [2, 3, 5]:
+            ccoords, betas, dist, tosum, row_splits = create_data(ncoords)
+
+            with tf.device('/cpu:0'):
+                out = BuildCondensates(tf.constant(ccoords), tf.constant(betas[:, np.newaxis]),
+                                       tf.constant(row_splits), radius=radius, min_beta=min_beta,
+                                       dist=tf.constant(dist[:, np.newaxis]),
+                                       tosum=tf.constant(tosum) if dosum else None,
+                                       soft=soft)
+            asso, is_cpoint, n_cond = out[:3]
+
+            ref_asso, ref_is_cpoint, ref_n_cond, ref_summed = build_condensates_reference(
+                ccoords, betas, dist, row_splits, radius=radius, min_beta=min_beta,
+                soft=soft, tosum=tosum if dosum else None)
+            self.assertTrue(np.all(asso.numpy() == ref_asso))
+            self.assertTrue(np.all(is_cpoint.numpy() == ref_is_cpoint))
+            self.assertTrue(np.all(n_cond.numpy() == ref_n_cond))
+            if dosum:
+                self.assertTrue(np.allclose(out[3].numpy(), ref_summed, rtol=1e-5, atol=1e-6))
+
+    def test_against_reference(self):
+        self.compare(soft=False, dosum=False)
+
+    def test_soft_against_reference(self):
+        self.compare(soft=True, dosum=False)
+
+    def test_sum_against_reference(self):
+        self.compare(soft=False, dosum=True)
+
+    def test_soft_sum_against_reference(self):
+        self.compare(soft=True, dosum=True, min_beta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''
+Tests the kNN graph cache shared by KNN layers (use_graph_cache=True):
+a layer with smaller or equal K on the same coordinate and row split tensors
+reuses the result of a previous one, and the selected neighbours are the same
+as the ones of a direct query (the order can differ).
+'''
+
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from GravNetLayersRagged import KNN, knn_graph_cache
+
+
+def create_inputs(nvert=4000, ncoords=3, seed=0):
+    np.random.seed(seed)
+    coords = tf.constant(np.random.rand(nvert, ncoords).astype('float32'))
+    row_splits = tf.constant(np.array([0, nvert // 3, nvert], dtype='int32'))
+    return coords, row_splits
+
+
+class KnnGraphCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        knn_graph_cache.clear()
+
+    def test_truncation(self):
+        coords, row_splits = create_inputs()
+        hits, misses = knn_graph_cache.hits, knn_graph_cache.misses
+
+        KNN(K=32, radius=0.5, use_graph_cache=True)([coords, row_splits])
+        idx, dist = KNN(K=8, radius=0.5, use_graph_cache=True)([coords, row_splits])
+        self.assertEqual(knn_graph_cache.hits - hits, 1)
+        self.assertEqual(knn_graph_cache.misses - misses, 1)
+
+        ref_idx, ref_dist = KNN(K=8, radius=0.5)([coords, row_splits])
+        self.assertTrue(np.all(idx.numpy()[:, 0] == np.arange(idx.shape[0])))
+        self.assertTrue(np.all(np.sort(idx.numpy(), axis=1) == np.sort(ref_idx.numpy(), axis=1)))
+        self.assertTrue(np.allclose(np.sort(dist.numpy(), axis=1), np.sort(ref_dist.numpy(), axis=1)))
+
+    def test_no_reuse(self):
+        coords, row_splits = create_inputs()
+        KNN(K=8, radius=0.5, use_graph_cache=True)([coords, row_splits])
+        misses = knn_graph_cache.misses
+        # larger K, different radius, different (but equal) tensor
+        KNN(K=16, radius=0.5, use_graph_cache=True)([coords, row_splits])
+        KNN(K=8, radius=0.4, use_graph_cache=True)([coords, row_splits])
+        KNN(K=8, radius=0.5, use_graph_cache=True)([tf.identity(coords), row_splits])
+        self.assertEqual(knn_graph_cache.misses - misses, 3)
+
+    def test_tf_function(self):
+        coords, row_splits = create_inputs()
+        knn_a = KNN(K=16, use_graph_cache=True)
+        knn_b = KNN(K=4, use_graph_cache=True)
+
+        @tf.function
+        def two_knn(coords, row_splits):
+            idx_a, _ = knn_a([coords, row_splits])
+            idx_b, _ = knn_b([coords, row_splits])
+            return idx_a, idx_b
+
+        idx_a, idx_b = two_knn(coords, row_splits)
+        self.assertTrue(np.all(idx_a.numpy()[:, 0] == idx_b.numpy()[:, 0]))
+        graph = two_knn.get_concrete_function(coords, row_splits).graph
+        n_knn_ops = len([op for op in graph.get_operations() if op.type == 'BinnedSelectKnn'])
+        self.assertEqual(n_knn_ops, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+'''
+Compares the kNN-truncated repulsive potential of Basic_OC_per_sample
+(knn_repulsion_k > 0) to the dense version. The difference needs to
+decrease with the number of neighbours and vanish once all vertices
+are neighbours. The neighbour search only runs for the condensation
+points (BinnedSelectKnnQuery).
+'''
+
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from object_condensation import Basic_OC_per_sample
+from binned_select_knn_op import BinnedSelectKnn
+from binned_select_knn_query_op import BinnedSelectKnnQuery
+
+
+def create_event(nvert=2000, nobj=40, ncoords=3, seed=0):
+    np.random.seed(seed)
+    truth_idx = np.random.randint(-1, nobj, size=(nvert, 1)).astype('int32')
+    # objects are clustered around a centre, noise is uniform
+    centres = np.random.rand(nobj, ncoords).astype('float32')
+    x = np.random.rand(nvert, ncoords).astype('float32')
+    isobj = truth_idx[:, 0] >= 0
+    x[isobj] = centres[truth_idx[isobj, 0]] + 0.05 * np.random.randn(np.sum(isobj), ncoords).astype('float32')
+    beta = np.random.rand(nvert, 1).astype('float32') * 0.99
+    d = 0.1 + 0.1 * np.random.rand(nvert, 1).astype('float32')
+    pll = np.random.rand(nvert, 1).astype('float32')
+    object_weight = np.ones((nvert, 1), dtype='float32')
+    is_spectator = np.zeros((nvert, 1), dtype='float32')
+    return [tf.constant(a) for a in [beta, x, d, pll, truth_idx, object_weight, is_spectator]]
+
+
+def make_oc(event, knn_repulsion_k=-1, knn_repulsion_radius=-1.):
+    oc = Basic_OC_per_sample(q_min=0.1, s_b=1., use_mean_x=0.,
+                             knn_repulsion_k=knn_repulsion_k,
+                             knn_repulsion_radius=knn_repulsion_radius)
+    oc.set_input(*event)
+    return oc
+
+
+def v_rep_k(event, knn_repulsion_k=-1, knn_repulsion_radius=-1.):
+    return make_oc(event, knn_repulsion_k, knn_repulsion_radius).V_rep_k().numpy()
+
+
+class KnnRepulsionTestCases(unittest.TestCase):
+
+    def test_converges_to_dense(self):
+        event = create_event()
+        nvert = event[0].shape[0]
+        dense = v_rep_k(event)
+
+        reldiffs = []
+        for K in [8, 32, 128, 512, nvert]:
+            knn = v_rep_k(event, knn_repulsion_k=K)
+            self.assertEqual(knn.shape, dense.shape)
+            # only neighbours are dropped, the potential can only decrease
+            self.assertTrue(np.all(knn <= dense * (1. + 1e-4) + 1e-6))
+            reldiffs.append(np.sum(np.abs(dense - knn)) / np.sum(np.abs(dense)))
+            print('K', K, 'relative difference', reldiffs[-1])
+
+        for i in range(len(reldiffs) - 1):
+            self.assertLessEqual(reldiffs[i + 1], reldiffs[i] + 1e-6)
+        self.assertLess(reldiffs[-1], 1e-4)
+
+    def test_radius(self):
+        event = create_event()
+        nvert = event[0].shape[0]
+        dense = v_rep_k(event)
+        all_in_radius = v_rep_k(event, knn_repulsion_k=nvert, knn_repulsion_radius=10.)
+        self.assertTrue(np.allclose(all_in_radius, dense, rtol=1e-4, atol=1e-6))
+        small_radius = v_rep_k(event, knn_repulsion_k=nvert, knn_repulsion_radius=0.05)
+        self.assertTrue(np.all(small_radius <= all_in_radius * (1. + 1e-4) + 1e-6))
+
+    def test_neighbours_of_condensation_points_only(self):
+        event = create_event()
+        nvert = event[0].shape[0]
+        oc = make_oc(event, knn_repulsion_k=16, knn_repulsion_radius=0.2)
+        nidx = oc._rep_neighbours_k().numpy()
+        n_obj = oc.alpha_v_k.shape[0]
+        self.assertEqual(nidx.shape, (n_obj, 16))
+        self.assertNotEqual(nidx.shape[0], nvert)
+        self.assertTrue(np.all(nidx[:, 0] == oc.alpha_v_k.numpy()))
+
+    def test_query_search(self):
+        event = create_event()
+        x = event[1]
+        row_splits = tf.constant([0, 700, x.shape[0]], dtype='int32')
+        query = tf.constant(np.random.choice(x.shape[0], 50, replace=False).astype('int32'))
+        ref_idx, ref_dist = BinnedSelectKnn(32, x, row_splits)
+        ref_idx, ref_dist = tf.gather(ref_idx, query).numpy(), tf.gather(ref_dist, query).numpy()
+
+        idx, dist = BinnedSelectKnnQuery(32, x, row_splits, query)
+        self.assertTrue(np.all(np.sort(idx.numpy(), axis=1) == np.sort(ref_idx, axis=1)))
+        self.assertTrue(np.allclose(np.sort(dist.numpy(), axis=1), np.sort(ref_dist, axis=1)))
+
+        # the radius is applied in the search, not afterwards
+        idx, dist = BinnedSelectKnnQuery(32, x, row_splits, query, max_radius=0.05)
+        ref_in_radius = np.where(ref_dist > 0.05 ** 2, -1, ref_idx)
+        self.assertTrue(np.all(np.sort(idx.numpy(), axis=1) == np.sort(ref_in_radius, axis=1)))
+        self.assertTrue(np.all(dist.numpy() <= 0.05 ** 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
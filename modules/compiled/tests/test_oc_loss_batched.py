@@ -0,0 +1,57 @@
+'''
+Compares OC_loss with batched=True (all row splits in one pass) to the
+default loop over row splits, eagerly and inside a tf.function.
+'''
+
+import unittest
+import numpy as np
+import tensorflow as tf
+
+from object_condensation import OC_loss
+
+
+def create_batch(nvert_per_rs=[300, 500, 200, 400], nobj=10, seed=0):
+    np.random.seed(seed)
+    nvert = sum(nvert_per_rs)
+    rs = np.cumsum([0] + nvert_per_rs).astype('int32')
+    # truth indices restart in each row split on purpose
+    truth_idx = np.concatenate([np.random.randint(-1, nobj, size=(n, 1)) for n in nvert_per_rs]).astype('int32')
+    x = np.random.rand(nvert, 3).astype('float32')
+    beta = np.random.rand(nvert, 1).astype('float32') * 0.99
+    d = 0.1 + np.random.rand(nvert, 1).astype('float32')
+    pll = np.random.rand(nvert, 2).astype('float32')
+    object_weight = np.random.rand(nvert, 1).astype('float32')
+    is_spectator = (np.random.rand(nvert, 1) < 0.1).astype('float32')
+    return dict(beta=beta, x=x, d=d, pll=pll, truth_idx=truth_idx, object_weight=object_weight,
+                is_spectator_weight=is_spectator, rs=rs)
+
+
+class BatchedOCLossTestCases(unittest.TestCase):
+
+    def compare(self, **kwargs):
+        inputs = {k: tf.constant(v) for k, v in create_batch().items()}
+        ref = OC_loss(q_min=0.1, s_b=1., use_mean_x=0.5, **kwargs)(**inputs)
+        batched_loss = OC_loss(batched=True, q_min=0.1, s_b=1., use_mean_x=0.5, **kwargs)
+        out = batched_loss(**inputs)
+        graph_out = tf.function(lambda inputs: batched_loss(**inputs))(inputs)
+        for r, o, g in zip(ref, out, graph_out):
+            self.assertTrue(np.allclose(r.numpy(), o.numpy(), rtol=1e-4, atol=1e-6), (r, o))
+            self.assertTrue(np.allclose(r.numpy(), g.numpy(), rtol=1e-4, atol=1e-6), (r, g))
+
+    def test_same_as_loop(self):
+        self.compare()
+
+    def test_same_as_loop_knn_repulsion(self):
+        self.compare(knn_repulsion_k=64)
+
+    def test_no_objects(self):
+        inputs = create_batch()
+        inputs['truth_idx'] = inputs['truth_idx'] * 0 - 1
+        inputs = {k: tf.constant(v) for k, v in inputs.items()}
+        out = tf.function(lambda inputs: OC_loss(batched=True, q_min=0.1, s_b=1., use_mean_x=0.)(**inputs))(inputs)
+        for o in out:
+            self.assertTrue(np.all(np.isfinite(o.numpy())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Benchmarks the multi-threaded CPU path of SelectKnn.
+
+Uses the same inputs as test_select_knn.py (4000 vertices, 4 coordinates,
+two row splits, K=200, max_radius=1) and runs the op on CPU with an
+increasing number of intra-op threads. The number of threads can only be
+set before tensorflow is initialised, therefore each point is run in a
+separate process. The outputs of all runs are compared to the single-thread
+result, which needs to be identical.
+
+usage: python3 test_select_knn_cpu_scaling.py [max threads]
+'''
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+N_VERT = 4000
+N_COORDS = 4
+K = 200
+N_ITERS = 20
+
+
+def createData(nvert,ncoords):
+    np.random.seed(42)
+    coords = np.random.rand(nvert,ncoords).astype('float32')
+    row_splits = np.array([0,  nvert//2, nvert], dtype='int32')
+    return coords, row_splits
+
+
+def run_single(nthreads, outfile):
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(nthreads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from select_knn_op import SelectKnn
+
+    coords, row_splits = createData(N_VERT, N_COORDS)
+    coords = tf.constant(coords)
+    row_splits = tf.constant(row_splits)
+
+    with tf.device('/cpu:0'):
+        idx, dist = SelectKnn(K = K, coords=coords,  row_splits=row_splits, max_radius=1., tf_compatible=True)#warm up
+        t0 = time.time()
+        for _ in range(N_ITERS):
+            idx, dist = SelectKnn(K = K, coords=coords,  row_splits=row_splits, max_radius=1., tf_compatible=True)
+        c_time = (time.time()-t0)/N_ITERS
+
+    np.savez(outfile, idx=idx.numpy(), dist=dist.numpy(), time=c_time)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--single':
+        run_single(int(sys.argv[2]), sys.argv[3])
+        exit()
+
+    max_threads = os.cpu_count()
+    if len(sys.argv) > 1:
+        max_threads = int(sys.argv[1])
+
+    nthreads_list = [1]
+    while nthreads_list[-1]*2 <= max_threads:
+        nthreads_list.append(nthreads_list[-1]*2)
+    if nthreads_list[-1] != max_threads:
+        nthreads_list.append(max_threads)
+
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    for nthreads in nthreads_list:
+        outfile = os.path.join(tmpdir, 'sknn_'+str(nthreads)+'.npz')
+        subprocess.check_call([sys.executable, __file__, '--single', str(nthreads), outfile])
+        results[nthreads] = np.load(outfile)
+
+    ref = results[1]
+    print('threads', 'time [s]', 'speedup', sep='\t')
+    for nthreads in nthreads_list:
+        res = results[nthreads]
+        assert np.all(res['idx'] == ref['idx']), 'indices differ for '+str(nthreads)+' threads'
+        assert np.all(res['dist'] == ref['dist']), 'distances differ for '+str(nthreads)+' threads'
+        print(nthreads, '%.5f' % res['time'], '%.2f' % (ref['time']/res['time']), sep='\t')
@@ -44,8 +44,51 @@ def deltaPhi(a,b):
     
 ######## helper classes ###########
 
+class BranchCache(object):
+    def __init__(self, tree, entry_start=None, entry_stop=None):
+        '''
+        Reads branches of an (uproot3) tree and keeps them in memory as awkward1 arrays,
+        such that every branch is only read once, also if several collections use it.
+        
+        Only the entries (events) in [entry_start, entry_stop) are read.
+        '''
+        self.tree = tree
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self._arrays = {}
+        
+    def prefetch(self, labels):
+        '''
+        reads all labels that are not cached yet in one go
+        '''
+        missing = [l for l in labels if l not in self._arrays]
+        if not len(missing):
+            return
+        arrays = self.tree.arrays(missing, namedecode='utf-8',
+                                  entrystart=self.entry_start, entrystop=self.entry_stop)
+        for l in missing:
+            self._arrays[l] = ak1.from_awkward0(arrays[l])
+            
+    def __getitem__(self, label):
+        if not label in self._arrays:
+            self.prefetch([label])
+        return self._arrays[label]
+    
+    def __contains__(self, label):
+        return label in self._arrays
+    
+    def clear(self):
+        self._arrays = {}
+        
+
 class CollectionBase(object):
-    def __init__(self, tree):
+    
+    #branches that are read at once when the collection is created, others are read on demand.
+    #only list branches that are always read: one missing branch makes the whole prefetch fail.
+    #can be a property if it depends on the configuration
+    required_branches = []
+    
+    def __init__(self, tree, entry_start=None, entry_stop=None):
         '''
         Always use _readArray, not direct uproot to avoid compatibility issues
         
@@ -54,6 +97,9 @@ class CollectionBase(object):
           - needs to include call to _readSplits(self,tree,splitlabel)
         - _assignTruth(self,tree)
         
+        tree can be an uproot tree or a BranchCache. Pass the same BranchCache to 
+        several collections to share the branches between them (entry_start and entry_stop
+        are then taken from the cache).
         '''
 
         self.splitIdx=None
@@ -61,6 +107,10 @@ class CollectionBase(object):
         self.truth={}
         self.featurenames=[]
         
+        if not isinstance(tree, BranchCache):
+            tree = BranchCache(tree, entry_start, entry_stop)
+        tree.prefetch(self.required_branches)
+        
         self._readTree(tree)
         self._assignTruth(tree)
 
@@ -71,7 +121,7 @@ class CollectionBase(object):
         pass
     
     def _readSplits(self, tree, splitlabel):
-        split = ak1.from_awkward0(tree[splitlabel].array())
+        split = self._readArray(tree, splitlabel)
         self.splitIdx= split < 0
     
     def _splitJaggedArray(self, jagged):
@@ -85,7 +135,7 @@ class CollectionBase(object):
     def _assignTruthByIndexAndSplit(self, tree, label, indices, null=0):
         sc = label
         if type(label) is str:
-            sc = ak1.from_awkward0(tree[label].array())
+            sc = self._readArray(tree, label)
         vals = sc[indices]
         vals = ak1.where(indices<0, ak1.zeros_like(vals)+null, vals)
         ja = self._splitJaggedArray(vals)
@@ -115,8 +165,8 @@ class CollectionBase(object):
         return self._splitJaggedArray(obs)
 
     def _readArray(self, tree, label):#for uproot3/4 ak0 to ak1 transition period
-        arr = ak1.from_awkward0(tree[label].array())
-        return arr
+        #tree is a BranchCache, that does the conversion
+        return tree[label]
     
     def _checkshapes(self, a, b):
         assert len(a) == len(b)
@@ -228,6 +278,32 @@ class CollectionBase(object):
     
     
 class RecHitCollection(CollectionBase):
+    
+    feature_branches = [
+        "RecHitHGC_energy", "RecHitHGC_time", 
+        "RecHitHGC_x", "RecHitHGC_y", "RecHitHGC_z", "RecHitHGC_hitr"
+        ]
+    
+    truth_branches = [
+        "RecHitHGC_BestMergedSimClusterIdx",
+        "MergedSimCluster_isTrainable", "MergedSimCluster_pdgId", 
+        "MergedSimCluster_boundaryEnergy", "MergedSimCluster_recEnergy",
+        "MergedSimCluster_impactPoint_x", "MergedSimCluster_impactPoint_y",
+        "MergedSimCluster_impactPoint_z", "MergedSimCluster_impactPoint_t"
+        ]
+    
+    truth_branches_cp_plus_pu = [
+        "RecHitHGC_BestSimClusterIdx", "SimCluster_CaloPartIdx",
+        "CaloPart_eventId", "CaloPart_bunchCrossing",
+        "CaloPart_pdgId", "CaloPart_energy", "CaloPart_pt"
+        ]
+    
+    @property
+    def required_branches(self):
+        if self.cp_plus_pu_mode:
+            return self.feature_branches + self.truth_branches_cp_plus_pu
+        return self.feature_branches + self.truth_branches
+    
     def __init__(self, use_true_muon_momentum=False, 
                  cp_plus_pu_mode=False,
                  cp_plus_pu_mode_reduce=False,
@@ -292,43 +368,13 @@ class RecHitCollection(CollectionBase):
         #done
     
     def _createSpectators(self, tree):
-        starttime = time.time()
+        '''
+        The spectator distance used to be computed per shower with find_pcas. With the scipy
+        versions in use, cdist does not accept V= for the mahalanobis metric, find_pcas raised
+        for every shower and the distance was 0 for all hits. It is filled with 0 directly.
+        '''
         recHitX = self._readAndSplit(tree,"RecHitHGC_x")
-        recHitY = self._readAndSplit(tree,"RecHitHGC_y")
-        recHitZ = self._readAndSplit(tree,"RecHitHGC_z")
-        recHitSimClusIdx = self._readAndSplit(tree,"RecHitHGC_BestMergedSimClusterIdx")
-        
-        #Define spectators 
-        recHit_df_events = [pd.DataFrame({"recHitX":recHitX[i],
-                                  "recHitY":recHitY[i],
-                                  "recHitZ":recHitZ[i],
-                                  "recHitSimClusIdx":recHitSimClusIdx[i]
-                                  }) for i in range(len(recHitX))] 
-         
-        for ievent in range(len(recHit_df_events)):
-            df_event = recHit_df_events[ievent]
-            unique_shower_idx = np.unique(df_event['recHitSimClusIdx'])
-            df_event['spectator_distance'] = 0. #
-            df_event['recHitSimClus_nHits'] =  df_event.groupby('recHitSimClusIdx').recHitX.transform(len) #adding number of rec hits that are associated to this truth cluster
-            for idx in unique_shower_idx:
-                df_shower = df_event[df_event['recHitSimClusIdx']==idx]
-                x_to_fit = df_shower[['recHitX','recHitY','recHitZ']].to_numpy()
-                spectators_shower_dist = None
-                try:
-                    spectators_shower_dist = find_pcas(x_to_fit,PCA_n=2,min_hits=10)
-                except:
-                    pass
-                if (spectators_shower_dist is not None) : 
-                    spectators_idx = (df_shower.index.tolist())
-                    df_event.loc[spectators_idx,'spectator_distance'] = spectators_shower_dist
-                del df_shower
-            del df_event
-            
-        print('spectators calculated after',time.time()-starttime,'s')
-        recHitSpectatorFlag = ak1.Array([np.expand_dims(recHit_df_events[i]['spectator_distance'].to_numpy(),axis=1)
-                                                       for i in range(len(recHit_df_events))])
-        
-        print('ended spectators after', time.time()-starttime,'s')
+        recHitSpectatorFlag = self._expand(ak1.values_astype(ak1.zeros_like(recHitX), 'float64'))
         return recHitSpectatorFlag   
     
     def _maskNoiseSC(self, tree,noSplitRecHitSimClusIdx):
@@ -518,6 +564,17 @@ class RecHitCollection(CollectionBase):
 
  
 class TrackCollection(CollectionBase):
+    
+    required_branches = [
+        "Track_pt", "Track_eta", "Track_normChiSq",
+        "Track_HGCFront_eta", "Track_HGCFront_phi",
+        "Track_HGCFront_x", "Track_HGCFront_y", "Track_HGCFront_z",
+        "MergedSimCluster_boundaryEnergy", "MergedSimCluster_pdgId",
+        "MergedSimCluster_impactPoint_eta", "MergedSimCluster_impactPoint_phi",
+        "MergedSimCluster_impactPoint_x", "MergedSimCluster_impactPoint_y",
+        "MergedSimCluster_impactPoint_z", "MergedSimCluster_impactPoint_t"
+        ]
+    
     def __init__(self, **kwargs):
         '''
         Guideline: this is more about clarity than performance. 
@@ -688,24 +745,34 @@ class TrainData_NanoML(TrainData):
             return False
         return True
     
-    def convertFromSourceFile(self, filename, weighterobjects, istraining, treename="Events"):
+    def convertFromSourceFile(self, filename, weighterobjects, istraining, treename="Events",
+                              entry_start=None, entry_stop=None):
+        '''
+        entry_start, entry_stop: only convert this range of events
+        '''
         
         fileTimeOut(filename, 10)#10 seconds for eos to recover 
         tree = uproot.open(filename)[treename]
         
+        #every branch is only read once, also if used by both collections
+        branches = BranchCache(tree, entry_start, entry_stop)
         
         rechitcoll = RecHitCollection(use_true_muon_momentum=self.include_tracks,
                                       cp_plus_pu_mode=self.cp_plus_pu_mode,
-                                      tree=tree)
+                                      tree=branches)
         
         #in a similar manner, we can also add tracks from conversions etc here
         if self.include_tracks:
-            trackcoll = TrackCollection(tree=tree)
+            trackcoll = TrackCollection(tree=branches)
             rechitcoll.append(trackcoll)
+        branches.clear()
         
         # adds t_is_unique
         rechitcoll.addUniqueIndices()
         
+        #recorded here, such that it does not need to be read back from the converted arrays
+        self.n_hits = int(sum(len(a) for a in rechitcoll.features))
+        
         # converts to DeepJetCore.SimpleArray
         farr = rechitcoll.getFinalFeaturesSA()
         t = rechitcoll.getFinalTruthDictSA()
@@ -867,16 +934,23 @@ class TrainData_NanoML(TrainData):
     def writeOutPredictionDict(self, dumping_data, outfilename):
         '''
         this function should not be necessary... why break with DJC standards?
+        
+        Writes one group per endcap (see prediction_file.py), such that single endcaps
+        can be read without loading the full file.
+        Returns the name of the written file.
         '''
-        if not str(outfilename).endswith('.bin.gz'):
-            outfilename = os.path.splitext(outfilename)[0] + '.bin.gz'
-
-        with gzip.open(outfilename, 'wb') as f2:
-            pickle.dump(dumping_data, f2)
+        from prediction_file import write_prediction_file, prediction_file_name
+        outfilename = prediction_file_name(outfilename)
+        write_prediction_file(dumping_data, outfilename)
+        return outfilename
 
     def readPredicted(self, predfile):
-        with gzip.open(predfile) as mypicklefile:
-            return pickle.load(mypicklefile)
+        '''
+        reads all endcaps; also reads the old pickled .bin.gz files.
+        Use prediction_file.PredictionFileReader to read endcaps lazily.
+        '''
+        from prediction_file import read_prediction_file
+        return read_prediction_file(predfile)
 
 
 class TrainData_NanoMLTracks(TrainData_NanoML):
@@ -973,7 +1047,7 @@ class TrainData_NanoMLCPPU(TrainData_NanoML):
             
             new_dumping_data.append(o_dicts)
         
-        super(TrainData_NanoMLCPPU, self).writeOutPredictionDict(new_dumping_data, outfilename)
+        return super(TrainData_NanoMLCPPU, self).writeOutPredictionDict(new_dumping_data, outfilename)
         
         
         
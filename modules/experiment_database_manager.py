@@ -17,6 +17,23 @@ class DValueError(ValueError):
 _debug_mode = False
 
 
+def _sanitize_value(value):
+    if type(value) is float:
+        return value if np.isfinite(value) else 0.0
+    return value
+
+
+def _sanitize_column(value):
+    '''
+    Array or list to list of python values with non finite floats set to 0
+    '''
+    if type(value) is np.ndarray:
+        if np.issubdtype(value.dtype, np.floating):
+            value = np.where(np.isfinite(value), value, 0.)
+        return value.tolist()
+    return [_sanitize_value(v) for v in value]
+
+
 class ExperimentDatabaseManager():
     class DataPusherThread(threading.Thread):
         def __init__(self, queue, database_manager_class, is_mysql=False, is_file=False):
@@ -32,78 +49,114 @@ class ExperimentDatabaseManager():
             self.queue = queue
             self.database_manager_object=database_manager_class
 
+            # statistics, read through ExperimentDatabaseManager.get_push_statistics
+            self.stats_lock = threading.Lock()
+            self.pushed_batches = 0
+            self.pushed_rows = 0
+            self.failed_batches = 0
+            self.push_time = 0.
+
+        def _connect(self):
+            if self.is_mysql:
+                return self.database_manager_object.connect_to_mysql()
+            return self.database_manager_object.connect_to_file()
+
+        def _queries(self, data_to_be_pushed):
+            '''
+            Converts the data to (query, rows) pairs for executemany.
+            Consecutive entries with the same table and keys are merged.
+            '''
+            placeholder = '%s' if self.is_mysql else '?'
+            experiment_name = self.database_manager_object.experiment_name
+            queries = []
+            for table_name, data, is_array in data_to_be_pushed:
+                keys = list(data.keys())
+                query = 'INSERT INTO %s (experiment_name%s) VALUES (%s)' % (
+                    table_name, ''.join([', %s' % key for key in keys]), ', '.join([placeholder] * (len(keys) + 1)))
+                if is_array:
+                    columns = [_sanitize_column(data[key]) for key in keys]
+                    rows = [(experiment_name,) + vtuple for vtuple in zip(*columns)]
+                else:
+                    rows = [(experiment_name,) + tuple(_sanitize_value(data[key]) for key in keys)]
+
+                if len(queries) and queries[-1][0] == query:
+                    queries[-1][1].extend(rows)
+                else:
+                    queries.append((query, rows))
+            return queries
+
+        def _is_connection_error(self, e):
+            return self.is_mysql and isinstance(e, (mysql.connector.errors.InterfaceError,
+                                                    mysql.connector.errors.OperationalError))
+
         def run(self):
-            get_new_element = True
+            con, cur = None, None
             data_to_be_pushed = None
             while True:
+                query = None
                 try:
-                    if self.is_mysql:
-                        con, cur = self.database_manager_object.connect_to_mysql()
-                    else:
-                        con, cur = self.database_manager_object.connect_to_file()
-
-                    if get_new_element or data_to_be_pushed is None:
-                        data_to_be_pushed = self.queue.get()  # 3s timeout
-                    else:
-                        get_new_element = True
-
                     if data_to_be_pushed is None:
-                        # End of thread
-                        break
-
-                    for table_name, data, is_array in data_to_be_pushed:
-                        if is_array:
-                            query = 'insert into %s (experiment_name' % table_name
-                            # values_query_section = '(\'%s\'' % (self.experiment_name)
-
-                            values = []
-                            for key, value in data.items():
-                                query += ', %s' % key
-                                values.append(value.tolist() if type(value) is np.ndarray else value)
-                            values = [[(v if np.isfinite(v) else 0) if type(v) is float else v for v in value_array] for
-                                      value_array in values]
-
-                            query += ') values\n'
-                            values_query_section = ['(\'' + self.database_manager_object.experiment_name + '\',' + ','.join(
-                                ['\'' + str(s) + '\'' for s in vtuple]) + ')' for vtuple in zip(*values)]
-                            values_query_section = ',\n'.join(values_query_section)
-
-                            query += values_query_section
-                        else:
-                            query = 'INSERT INTO %s (experiment_name' % table_name
-
-                            values_query_section = '(\'%s\'' % (self.database_manager_object.experiment_name)
-                            for key, value in data.items():
-                                if type(value) is float:
-                                    value = value if np.isfinite(value) else 0.0
-                                query += ', %s' % key
-                                values_query_section += ', \'%s\'' % (value)
-                            #
-                            query += ') VALUES '
-                            query += values_query_section + ')'
-
+                        data_to_be_pushed = self.queue.get()
+                        if data_to_be_pushed is None:
+                            # End of thread
+                            break
+
+                    starttime = time.time()
+                    # one connection for the lifetime of the thread (opened again after connection errors)
+                    if con is None:
+                        con, cur = self._connect()
+
+                    nrows = 0
+                    for query, rows in self._queries(data_to_be_pushed):
                         if _debug_mode:
-                            print(query)
-                        cur.execute(query)
-
+                            print(query, rows)
+                        cur.executemany(query, rows)
+                        nrows += len(rows)
                     con.commit()
-                    con.close()
+
+                    with self.stats_lock:
+                        self.pushed_batches += 1
+                        self.pushed_rows += nrows
+                        self.push_time += time.time() - starttime
+                    data_to_be_pushed = None
 
                 except Exception as e:
-                    if self.is_mysql:
-                        if type(e) == mysql.connector.errors.InterfaceError or type(
-                                mysql.connector.errors.OperationalError):
-                            print("Error connecting to server, will try again in a second")
-                            print(query)
-
-                            time.sleep(1)
-                            if con.is_connected():
-                                con.close()
-                            get_new_element = False
-                            continue
+                    if con is not None:
+                        try:
+                            con.rollback()
+                        except Exception:
+                            pass
+                    if self._is_connection_error(e):
+                        # the whole batch is pushed again with a new connection
+                        print("Error connecting to server, will try again in a second")
+                        print(query)
+                        try:
+                            con.close()
+                        except Exception:
+                            pass
+                        con, cur = None, None
+                        time.sleep(1)
+                        continue
                     print(e.args)
                     print(e)
                     traceback.print_exc()
+                    with self.stats_lock:
+                        self.failed_batches += 1
+                    data_to_be_pushed = None
+
+            if con is not None:
+                con.close()
+
+        def get_statistics(self):
+            with self.stats_lock:
+                return {
+                    'queue_depth': self.queue.qsize(),
+                    'pushed_batches': self.pushed_batches,
+                    'pushed_rows': self.pushed_rows,
+                    'failed_batches': self.failed_batches,
+                    'push_time': self.push_time,
+                    'rows_per_second': self.pushed_rows / self.push_time if self.push_time > 0 else 0.,
+                }
 
 
 
@@ -180,6 +233,19 @@ class ExperimentDatabaseManager():
             self.file_pusher_thread = t
 
 
+    def get_push_statistics(self):
+        '''
+        Returns the number of cached entries not yet handed to the pusher threads and, per pusher
+        thread ('mysql', 'file'): the number of batches waiting in its queue, pushed batches and rows,
+        failed batches, and the throughput (rows per second spent pushing).
+        '''
+        stats = {'cached_entries': self.data_queue.qsize()}
+        if self.has_mysql:
+            stats['mysql'] = self.mysql_pusher_thread.get_statistics()
+        if self.has_file:
+            stats['file'] = self.file_pusher_thread.get_statistics()
+        return stats
+
     def connect_to_mysql(self):
         if not self.has_mysql:
             raise RuntimeError("Not saving to mysql. Try using connect_to_file instead.")
@@ -1,6 +1,8 @@
 import sqlite3
 
 import mysql.connector
+import numpy as np
+import pandas as pd
 import os
 from datetime import datetime, timezone
 import threading
@@ -27,6 +29,7 @@ class ExperimentDatabaseReadingManager():
         self.mysql_credentials = mysql_credentials
 
         self.field_names_cache = dict()
+        self.indexed_tables = set()
 
 
     def connect(self):
@@ -78,50 +81,145 @@ class ExperimentDatabaseReadingManager():
         pass
 
 
-    def get_data(self, table_name, experiment_names=None, field_names=None, condition_string=None):
-        query = "SELECT "
-        if field_names is None:
-            field_names = self.get_field_names(table_name)
-        if len(field_names) == 0:
-            raise ExperimentDatabaseReadingManager.TableDoesNotExistError('Table %s does not exist'%table_name)
+    def ensure_index(self, table_name):
+        '''
+        Creates the experiment_name index on sqlite tables written by older versions. Tables written by
+        ExperimentDatabaseManager on mysql always have it. Read-only files are left as they are.
+        '''
+        if self.is_mysql or table_name in self.indexed_tables:
+            return
+        con, cur = self.connect()
+        try:
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_%s ON %s(experiment_name);' % (table_name, table_name))
+            con.commit()
+        except sqlite3.OperationalError as e:
+            if _debug_mode:
+                print("Could not create index on", table_name, e)
+        finally:
+            con.close()
+        self.indexed_tables.add(table_name)
 
-        query += '%s ' % ','.join(field_names)
+    def _build_query(self, table_name, experiment_names=None, field_names=None, condition_string=None,
+                     conditions=None, params=None):
+        available_field_names = self.get_field_names(table_name)
+        if len(available_field_names) == 0:
+            raise ExperimentDatabaseReadingManager.TableDoesNotExistError('Table %s does not exist'%table_name)
+        if field_names is None:
+            field_names = available_field_names
+        for field_name in field_names:
+            if field_name not in available_field_names:
+                raise ValueError('Field %s does not exist in table %s' % (field_name, table_name))
 
-        query += 'FROM %s ' % table_name
+        placeholder = '%s' if self.is_mysql else '?'
+        query = 'SELECT %s FROM %s' % (','.join(field_names), table_name)
+        clauses = []
+        query_params = []
 
-        where_added = False
         if experiment_names is not None:
-            if type(experiment_names) is list:
-                if len(experiment_names) ==0:
-                    raise RuntimeError("Length of experiment names is zero")
-                query += "WHERE "
-                operands = []
-                for exp in experiment_names:
-                    operands .append("experiment_name='%s'" % exp)
-                query += ' (%s) '% ' OR '.join(operands)
-
-            else:
-                query += "WHERE experiment_name = '%s'" % experiment_names
-            where_added=True
+            if type(experiment_names) is not list:
+                experiment_names = [experiment_names]
+            if len(experiment_names) == 0:
+                raise RuntimeError("Length of experiment names is zero")
+            # IN with one parameter per experiment, can be served from the experiment_name index
+            clauses.append('experiment_name IN (%s)' % ', '.join([placeholder] * len(experiment_names)))
+            query_params += experiment_names
+
+        if conditions is not None:
+            for field_name, value in conditions.items():
+                if field_name not in available_field_names:
+                    raise ValueError('Field %s does not exist in table %s' % (field_name, table_name))
+                if type(value) is list or type(value) is np.ndarray:
+                    clauses.append('%s IN (%s)' % (field_name, ', '.join([placeholder] * len(value))))
+                    query_params += [v.item() if isinstance(v, np.generic) else v for v in value]
+                    continue
+                operator = '='
+                if type(value) is tuple:
+                    operator, value = value
+                    if operator not in ['=', '!=', '<', '<=', '>', '>=']:
+                        raise ValueError('Unknown operator %s' % operator)
+                clauses.append('%s %s %s' % (field_name, operator, placeholder))
+                query_params.append(value.item() if isinstance(value, np.generic) else value)
 
         if condition_string is not None:
-            query += (' AND ' if where_added else ' WHERE ') + condition_string
+            clauses.append('(%s)' % condition_string)
+            if params is not None:
+                query_params += list(params)
+
+        if len(clauses) > 0:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        return query, query_params, field_names
+
+    @staticmethod
+    def _rows_to_dict(rows, field_names, as_numpy):
+        columns = list(zip(*rows))
+        if as_numpy:
+            return {field_name: np.array(column) for field_name, column in zip(field_names, columns)}
+        return {field_name: list(column) for field_name, column in zip(field_names, columns)}
+
+    def get_data(self, table_name, experiment_names=None, field_names=None, condition_string=None,
+                 conditions=None, params=None, as_numpy=False):
+        '''
+        Reads a table, returns a dict field name -> column or None if nothing is found.
+
+        :param experiment_names: experiment name or list of experiment names to read
+        :param field_names: fields to read (default: all)
+        :param condition_string: additional sql condition, can contain placeholders filled from params
+            (%s for mysql, ? for sqlite)
+        :param conditions: dict field name -> value (equality), (operator, value) or list of values
+        :param params: parameters for condition_string
+        :param as_numpy: return numpy arrays instead of lists
+        '''
+        query, query_params, field_names = self._build_query(table_name, experiment_names, field_names,
+                                                             condition_string, conditions, params)
+        if experiment_names is not None:
+            self.ensure_index(table_name)
 
         if _debug_mode:
-            print(query)
+            print(query, query_params)
 
         con, cur = self.connect()
-        cur.execute(query)
+        cur.execute(query, query_params)
         result = cur.fetchall()
         con.close()
 
         if len(result) == 0:
             return None
 
+        return self._rows_to_dict(result, field_names, as_numpy)
+
+    def iterate_data(self, table_name, experiment_names=None, field_names=None, condition_string=None,
+                     conditions=None, params=None, as_numpy=True, page_size=100000):
+        '''
+        Same as get_data but yields the result in pages of at most page_size rows,
+        so large tables do not have to be held in memory at once.
+        '''
+        query, query_params, field_names = self._build_query(table_name, experiment_names, field_names,
+                                                             condition_string, conditions, params)
+        if experiment_names is not None:
+            self.ensure_index(table_name)
 
-        result_as_dict = {}
-        for i, field_name in enumerate(field_names):
-            result_as_dict[field_name] = [x[i] for x in result]
+        if _debug_mode:
+            print(query, query_params)
 
+        con, cur = self.connect()
+        try:
+            cur.execute(query, query_params)
+            while True:
+                rows = cur.fetchmany(page_size)
+                if len(rows) == 0:
+                    break
+                yield self._rows_to_dict(rows, field_names, as_numpy)
+        finally:
+            con.close()
 
-        return result_as_dict
+    def get_data_frame(self, table_name, experiment_names=None, field_names=None, condition_string=None,
+                       conditions=None, params=None):
+        '''
+        Same as get_data but returns a pandas DataFrame (empty if nothing is found)
+        '''
+        data = self.get_data(table_name, experiment_names, field_names, condition_string, conditions, params,
+                             as_numpy=True)
+        if data is None:
+            return pd.DataFrame(columns=self.get_field_names(table_name) if field_names is None else field_names)
+        return pd.DataFrame(data, columns=field_names)
@@ -26,18 +26,20 @@ def download_experiment_to_file(experiment_name, file_path):
 
     for table in tables:
         print("Downloading data from ", table)
-        table_data = reading_manager.get_data(table, experiment_name)
-
-        if table_data is None:
+        found = False
+        # paged, so that large tables are not held in memory at once
+        for table_data in reading_manager.iterate_data(table, experiment_name, as_numpy=True):
+            if not found:
+                print("Gotten keys", table_data.keys())
+                for key in table_data.keys():
+                    print('\t%s is %s' % (key, str(table_data[key].dtype)))
+                found = True
+            table_data.pop('experiment_name')
+
+            file_database.insert_experiment_data(table, table_data)
+
+        if not found:
             print("No data found in table for this experiment, skipping")
-            continue
-
-        print("Gotten keys", table_data.keys())
-        for key in table_data.keys():
-            print('\t%s is %s' % (key, str(type(table_data[key][0]))))
-        table_data.pop('experiment_name')
-
-        file_database.insert_experiment_data(table, table_data)
 
     print("Finishing up writing to file...")
     file_database.close()
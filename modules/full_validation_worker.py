@@ -0,0 +1,47 @@
+'''
+Runs one full validation job of RunningFullValidation (run_in_background=True) in a separate process:
+creates the predictor, clustering and matching objects from the settings in the job file, loads the
+model snapshot on CPU, predicts, clusters, matches and writes the pdf files, and stores the summary
+metrics in the result file of the job for the training process to report.
+
+usage: python3 full_validation_worker.py <job file>
+'''
+
+import os
+import sys
+import json
+
+
+def main(job_file):
+    # keep the GPU for training
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+    with open(job_file) as f:
+        job = json.load(f)
+
+    from callbacks import run_full_validation
+    from hgcal_predictor import HGCalPredictor
+    from OCHits2Showers import OCHits2Showers
+    from ShowersMatcher import ShowersMatcher
+
+    predictor = HGCalPredictor(**job['predictor'])
+    hits2showers = OCHits2Showers(**job['hits2showers'])
+    showers_matcher = ShowersMatcher(**job['showers_matcher'])
+    test_on = [tuple(point) for point in job['test_on']]
+
+    all_data = predictor.predict(model_path=job['model_path'], output_to_file=False)
+    results = run_full_validation(all_data, hits2showers, showers_matcher, test_on,
+                                  job['pdfs_path'], job['batch_idx'])
+
+    # only appears once complete
+    with open(job['result_file'] + '.tmp', 'w') as f:
+        json.dump(results, f)
+    os.replace(job['result_file'] + '.tmp', job['result_file'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -1,5 +1,6 @@
 
 
+import numpy as np
 from DeepJetCore.DataCollection import DataCollection
 from DeepJetCore.dataPipeline import TrainDataGenerator
 from datastructures.TrainData_NanoML import TrainData_NanoML
@@ -8,14 +9,81 @@ import os
 from DeepJetCore.modeltools import load_model
 from datastructures import TrainData_TrackML
 import time
+import queue
+import threading
+
+
+def _is_row_splits_key(k):
+    return k == 'row_splits' or k.endswith('_row_splits')
+
+
+def split_by_row_splits(data_dict, row_splits, metadata_keys=()):
+    '''
+    Splits all arrays in data_dict that have one entry per hit of the whole batch
+    into one dict per event.
+    Row splits in data_dict ('row_splits', '*_row_splits', e.g. of model outputs after a hit
+    selection) are replaced by the per-event row splits, and arrays with one entry per entry of
+    these are split with them. All row splits need to describe the same number of events.
+    Scalars and the keys in metadata_keys are copied to all events. Any other array raises
+    a ValueError, since it cannot be assigned to the events.
+    '''
+    row_splits = np.asarray(row_splits).reshape(-1)
+    n_events = len(row_splits) - 1
+    
+    splits_by_total = {int(row_splits[-1]): row_splits}
+    for k, v in data_dict.items():
+        if not _is_row_splits_key(k):
+            continue
+        rs = np.asarray(v).reshape(-1)
+        if len(rs) - 1 != n_events:
+            raise ValueError('split_by_row_splits: '+k+' has '+str(len(rs) - 1)+' events, expected '+str(n_events))
+        total = int(rs[-1])
+        if total in splits_by_total and not np.array_equal(splits_by_total[total], rs):
+            raise ValueError('split_by_row_splits: '+k+' is ambiguous, other row splits have the same number of entries')
+        splits_by_total[total] = rs
+    
+    out = [dict() for _ in range(n_events)]
+    for k, v in data_dict.items():
+        if _is_row_splits_key(k):
+            v = np.asarray(v)
+            rs = v.reshape(-1)
+            for i, d in enumerate(out):
+                d[k] = np.array([0, rs[i + 1] - rs[i]], dtype=v.dtype).reshape((-1,) + v.shape[1:])
+        elif k in metadata_keys or not hasattr(v, 'shape') or not len(v.shape):
+            for d in out:
+                d[k] = v
+        elif v.shape[0] in splits_by_total:
+            rs = splits_by_total[v.shape[0]]
+            for i, d in enumerate(out):
+                d[k] = v[rs[i]:rs[i + 1]]
+        else:
+            raise ValueError('split_by_row_splits: '+k+' with shape '+str(v.shape)
+                             +' does not match any row splits, cannot split it per event')
+    return out
+
 
 class HGCalPredictor():
-    def __init__(self, input_source_files_list, training_data_collection, predict_dir, unbuffered=False, model_path=None, max_files=4, inputdir=None):
+    def __init__(self, input_source_files_list, training_data_collection, predict_dir, unbuffered=False, model_path=None, max_files=4, inputdir=None,
+                 max_hits_per_batch=-1):
+        '''
+        max_hits_per_batch: if > 1, several endcaps are packed into one model call up to this
+                            number of hits (endcaps larger than this are still processed alone).
+                            The predictions are split back per endcap using the row splits.
+        '''
+        self.config = {'input_source_files_list': input_source_files_list,
+                       'training_data_collection': training_data_collection,
+                       'predict_dir': predict_dir,
+                       'unbuffered': unbuffered,
+                       'model_path': model_path,
+                       'max_files': max_files,
+                       'inputdir': inputdir,
+                       'max_hits_per_batch': max_hits_per_batch}
         self.input_data_files = []
         self.inputdir = None
         self.predict_dir = predict_dir
         self.unbuffered=unbuffered
         self.max_files = max_files
+        self.max_hits_per_batch = max_hits_per_batch
         print("Using HGCal predictor class")
 
         ## prepare input lists for different file formats
@@ -52,7 +120,122 @@ class HGCalPredictor():
             self.input_data_files = self.input_data_files[0:min(max_files, len(self.input_data_files))]
         
 
-    def predict(self, model=None, model_path=None, output_to_file=True):
+    def get_config(self):
+        '''
+        the constructor arguments (file list, data collection, paths), e.g. to create the same
+        predictor in another process without pickling the data collection
+        '''
+        return dict(self.config)
+
+    def _load(self, inputfile):
+        '''
+        reads or converts one input file, returns the filled train data object
+        '''
+        use_inputdir = self.inputdir
+        if inputfile[0] == "/":
+            use_inputdir = ""
+
+        print('predicting ', use_inputdir +'/' + inputfile)
+
+        td = self.dc.dataclass()
+
+        #also allows for inheriting classes now, like with tracks or special PU
+        if not isinstance(td, TrainData_NanoML)  and type(td) is not TrainData_TrackML:
+            raise RuntimeError("TODO: make sure this works for other traindata formats")
+
+        if inputfile[-5:] == 'djctd':
+            if self.unbuffered:
+                td.readFromFile(use_inputdir + "/" + inputfile)
+            else:
+                td.readFromFileBuffered(use_inputdir + "/" + inputfile)
+        else:
+            print('converting ' + inputfile)
+            td.readFromSourceFile(use_inputdir + "/" + inputfile, self.dc.weighterobjects, istraining=False)
+        return td
+
+    def _infer(self, model, td):
+        '''
+        runs the model on all endcaps in td, returns one [features, truth, predictions] entry per endcap
+        '''
+        gen = TrainDataGenerator()
+        # batch size 1: one endcap per batch. Otherwise the batch size is the maximum number of hits
+        # and the endcaps are split again using the row splits
+        batched = self.max_hits_per_batch > 1
+        gen.setBatchSize(self.max_hits_per_batch if batched else 1)
+        gen.setSquaredElementsLimit(False)
+        gen.setSkipTooLargeBatches(False)
+        gen.setBuffer(td)
+
+        num_steps = gen.getNBatches()
+        generator = gen.feedNumpyData()
+
+        dumping_data = []
+
+        for _ in range(num_steps):
+            data_in = next(generator)
+            predictions_dict = model(data_in[0])
+            for k in predictions_dict.keys():
+                predictions_dict[k] = predictions_dict[k].numpy()
+            features_dict = td.createFeatureDict(data_in[0])
+            truth_dict = td.createTruthDict(data_in[0])
+
+            if batched:
+                row_splits = data_in[0][1]
+                dumping_data += [list(e) for e in zip(split_by_row_splits(features_dict, row_splits),
+                                                      split_by_row_splits(truth_dict, row_splits),
+                                                      split_by_row_splits(predictions_dict, row_splits))]
+            else:
+                dumping_data.append([features_dict, truth_dict, predictions_dict])
+
+        td.clear()
+        gen.clear()
+        return dumping_data
+
+    def _write(self, td, dumping_data, outfilename):
+        '''
+        writes the predictions of one input file, returns the final output file name
+        '''
+        written = td.writeOutPredictionDict(dumping_data, self.predict_dir + "/" + outfilename)
+        if written is not None: # the data format decides on the final file name
+            outfilename = os.path.basename(written)
+        return outfilename
+
+    def _loader(self, load_queue, stop):
+        # runs in a background thread, the queue size limits how many files are held in memory
+        for inputfile in self.input_data_files:
+            if stop.is_set():
+                break
+            try:
+                t0 = time.time()
+                td = self._load(inputfile)
+                load_queue.put((inputfile, td, time.time() - t0, None))
+            except Exception as e:
+                load_queue.put((inputfile, None, 0., e))
+                return
+        load_queue.put(None)
+
+    def _writer(self, write_queue, outputs, timing, errors):
+        # runs in a background thread
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            idx, td, dumping_data, outfilename = item
+            if errors:  # only drain the queue
+                continue
+            try:
+                t0 = time.time()
+                outputs[idx] = self._write(td, dumping_data, outfilename)
+                timing['write'] += time.time() - t0
+            except Exception as e:
+                errors.append(e)
+
+    def predict(self, model=None, model_path=None, output_to_file=True, pipelined=True, queue_size=1):
+        '''
+        pipelined: load/convert the next input file and write out the previous one in background
+                   threads while the model runs on the current one. queue_size sets how many files
+                   can be waiting in each queue.
+        '''
         if model_path==None:
             model_path = self.model_path
 
@@ -62,72 +245,91 @@ class HGCalPredictor():
 
         assert model_path is not None or model is not None
 
-        outputs = []
         if output_to_file:
             os.system('mkdir -p ' + self.predict_dir)
 
         if model is None:
             model = load_model(model_path)
 
+        outputs = [None] * len(self.input_data_files)
+        timing = {'load': 0., 'infer': 0., 'write': 0.}
+        n_endcaps = 0
+        errors = []
         all_data = []
-        for inputfile in self.input_data_files:
+        starttime = time.time()
 
-            use_inputdir = self.inputdir
-            if inputfile[0] == "/":
-                use_inputdir = ""
-            outfilename = "pred_" + os.path.basename(inputfile)
-            
-            print('predicting ', use_inputdir +'/' + inputfile)
+        stop = threading.Event()
+        load_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        if pipelined:
+            loader = threading.Thread(target=self._loader, args=(load_queue, stop), daemon=True)
+            writer = threading.Thread(target=self._writer, args=(write_queue, outputs, timing, errors), daemon=True)
+            loader.start()
+            writer.start()
 
-            td = self.dc.dataclass()
+        def next_input(i):
+            if pipelined:
+                return load_queue.get()
+            if i >= len(self.input_data_files):
+                return None
+            t0 = time.time()
+            td = self._load(self.input_data_files[i])
+            return self.input_data_files[i], td, time.time() - t0, None
 
-            #also allows for inheriting classes now, like with tracks or special PU
-            if not isinstance(td, TrainData_NanoML)  and type(td) is not TrainData_TrackML:
-                raise RuntimeError("TODO: make sure this works for other traindata formats")
+        try:
+            idx = 0
+            while True:
+                item = next_input(idx)
+                if item is None:
+                    break
+                inputfile, td, load_time, error = item
+                if error is not None:
+                    raise error
+                timing['load'] += load_time
 
-            if inputfile[-5:] == 'djctd':
-                if self.unbuffered:
-                    td.readFromFile(use_inputdir + "/" + inputfile)
+                thistime = time.time()
+                dumping_data = self._infer(model, td)
+                infer_time = time.time() - thistime
+                timing['infer'] += infer_time
+                n_endcaps += len(dumping_data)
+                print('took approx',infer_time/max(len(dumping_data), 1),'s per endcap (also includes dict building)')
+
+                outfilename = "pred_" + os.path.basename(inputfile)
+                outfilename = os.path.splitext(outfilename)[0] + '.bin.gz'
+                outputs[idx] = outfilename
+                if output_to_file:
+                    if pipelined:
+                        if errors:
+                            raise errors[0]
+                        write_queue.put((idx, td, dumping_data, outfilename))
+                    else:
+                        t0 = time.time()
+                        outputs[idx] = self._write(td, dumping_data, outfilename)
+                        timing['write'] += time.time() - t0
                 else:
-                    td.readFromFileBuffered(use_inputdir + "/" + inputfile)
-            else:
-                print('converting ' + inputfile)
-                td.readFromSourceFile(use_inputdir + "/" + inputfile, self.dc.weighterobjects, istraining=False)
-
-            gen = TrainDataGenerator()
-            # the batch size must be one otherwise we need to play tricks with the row splits later on
-            gen.setBatchSize(1)
-            gen.setSquaredElementsLimit(False)
-            gen.setSkipTooLargeBatches(False)
-            gen.setBuffer(td)
-
-            num_steps = gen.getNBatches()
-            generator = gen.feedNumpyData()
-
-            dumping_data = []
-
-            thistime = time.time()
-            for _ in range(num_steps):
-                data_in = next(generator)
-                predictions_dict = model(data_in[0])
-                for k in predictions_dict.keys():
-                    predictions_dict[k] = predictions_dict[k].numpy()
-                features_dict = td.createFeatureDict(data_in[0])
-                truth_dict = td.createTruthDict(data_in[0])
-                
-                dumping_data.append([features_dict, truth_dict, predictions_dict])
-                
-            totaltime = time.time() - thistime
-            print('took approx',totaltime/num_steps,'s per endcap (also includes dict building)')
-
-            td.clear()
-            gen.clear()
-            outfilename = os.path.splitext(outfilename)[0] + '.bin.gz'
-            if output_to_file:
-                td.writeOutPredictionDict(dumping_data, self.predict_dir + "/" + outfilename)
-            outputs.append(outfilename)
-            if not output_to_file:
-                all_data.append(dumping_data)
+                    all_data.append(dumping_data)
+                idx += 1
+        finally:
+            if pipelined:
+                stop.set()
+                # unblock the loader if it is waiting for a free slot
+                while loader.is_alive():
+                    try:
+                        load_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                write_queue.put(None)
+                writer.join()
+
+        if errors:
+            raise errors[0]
+
+        totaltime = time.time() - starttime
+        print('predicted', n_endcaps, 'endcaps from', len(outputs), 'files in', round(totaltime, 1), 's')
+        print('  loading/converting:', round(timing['load'], 1), 's' + (' (background)' if pipelined else ''))
+        print('  inference:', round(timing['infer'], 1), 's, approx', timing['infer']/max(n_endcaps, 1), 's per endcap (also includes dict building)')
+        if output_to_file:
+            print('  writing:', round(timing['write'], 1), 's' + (' (background)' if pipelined else ''))
 
         if output_to_file:
             with open(self.predict_dir + "/outfiles.txt", "w") as f:
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+def grouped_sum(group_idx, values, n_groups):
+    '''
+    sum of values per group, group_idx must be in [0, n_groups)
+    '''
+    return np.bincount(group_idx, weights=values, minlength=n_groups)[:n_groups]
+
+
+def grouped_quantiles(group_idx, values, quantiles, n_groups, empty_value=np.nan):
+    '''
+    quantiles of the values per group with linear interpolation (same as np.quantile per group),
+    computed with one sort for all groups.
+
+    :return: array with shape [len(quantiles), n_groups], empty_value for groups without values
+    '''
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype=float))
+    order = np.lexsort((values, group_idx))
+    sorted_values = values[order].astype(float)
+    counts = np.bincount(group_idx, minlength=n_groups)[:n_groups]
+    starts = np.cumsum(counts) - counts
+
+    result = np.full((len(quantiles), n_groups), empty_value, dtype=float)
+    filled = counts > 0
+    for i, q in enumerate(quantiles):
+        pos = q * (counts[filled] - 1)
+        low = np.floor(pos).astype(np.int64)
+        high = np.minimum(low + 1, counts[filled] - 1)
+        frac = pos - low
+        v_low = sorted_values[starts[filled] + low]
+        v_high = sorted_values[starts[filled] + high]
+        result[i, filled] = v_low + (v_high - v_low) * frac
+    return result
+
+
+class Binning():
+    def __init__(self, x_values, bins):
+        """
+        Bin index of every value, computed once with np.digitize and shared by all statistics
+        that are binned in the same variable. Bins are [low, high) like the per-bin masks of the
+        plots. Values outside of the bins (and NaN) are ignored.
+
+        :param x_values: values of the binning variable, shape [N] (or [N, 1])
+        :param bins: bin edges, increasing
+        """
+        self.x_values = np.asarray(x_values).reshape(-1)
+        self.bins = np.asarray(bins)
+        self.n_bins = len(self.bins) - 1
+
+        idx = np.digitize(self.x_values, self.bins, right=False) - 1
+        self.valid = np.logical_and(idx >= 0, idx < self.n_bins)
+        self.idx = idx[self.valid]
+        self.count = np.bincount(self.idx, minlength=self.n_bins)[:self.n_bins]
+
+        self._histogram = None
+        self._open_lower_edge = None
+
+    def with_open_lower_edge(self):
+        """
+        The same binning with bins (low, high), i.e. without the values exactly at the lower edge.
+        """
+        if self._open_lower_edge is None:
+            binning = Binning.__new__(Binning)
+            binning.__dict__.update(self.__dict__)
+            at_lower_edge = self.x_values[self.valid] == self.bins[self.idx]
+            binning.valid = self.valid.copy()
+            binning.valid[self.valid] = np.logical_not(at_lower_edge)
+            binning.idx = self.idx[np.logical_not(at_lower_edge)]
+            binning.count = np.bincount(binning.idx, minlength=self.n_bins)[:self.n_bins]
+            binning._open_lower_edge = binning
+            binning._parent = self
+            self._open_lower_edge = binning
+        return self._open_lower_edge
+
+    def histogram(self):
+        """
+        Same as np.histogram(x_values, bins)[0], the last bin includes its upper edge.
+        """
+        parent = getattr(self, '_parent', None)
+        if parent is not None:
+            return parent.histogram()
+        if self._histogram is None:
+            self._histogram = self.count + np.array(
+                [0] * (self.n_bins - 1) + [np.sum(self.x_values == self.bins[-1])], dtype=self.count.dtype)
+        return self._histogram
+
+    def _select(self, values):
+        return np.asarray(values).reshape(-1)[self.valid].astype(float)
+
+    def sum(self, values):
+        return grouped_sum(self.idx, self._select(values), self.n_bins)
+
+    def mean(self, y_values):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum(y_values) / self.count
+
+    def weighted_mean(self, y_values, weights=None):
+        if weights is None:
+            return self.mean(y_values)
+        weights = self._select(weights)
+        y_values = self._select(y_values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return grouped_sum(self.idx, y_values * weights, self.n_bins) / grouped_sum(self.idx, weights, self.n_bins)
+
+    def efficiency_error(self, efficiency):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(efficiency * (1 - efficiency) / self.count)
+
+    def relative_error(self, values):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return values / np.sqrt(self.count.astype(float))
+
+    def relative_std(self, y_values):
+        """
+        standard deviation divided by the mean per bin
+        """
+        mean = self.mean(y_values)
+        y_values = self._select(y_values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(grouped_sum(self.idx, (y_values - mean[self.idx]) ** 2, self.n_bins) / self.count) / mean
+
+    def relative_rms(self, y_values, weights=None):
+        """
+        weighted rms of (y - mean) / mean per bin, the mean is not weighted
+        """
+        mean = self.mean(y_values)
+        y_values = self._select(y_values)
+        weights = np.ones_like(y_values) if weights is None else self._select(weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relvar = (y_values - mean[self.idx]) / mean[self.idx]
+            return np.sqrt(grouped_sum(self.idx, weights * relvar ** 2, self.n_bins)
+                           / grouped_sum(self.idx, weights, self.n_bins))
+
+    def quantiles(self, y_values, quantiles):
+        """
+        :return: array with shape [len(quantiles), n_bins], NaN for empty bins
+        """
+        return grouped_quantiles(self.idx, self._select(y_values), quantiles, self.n_bins)
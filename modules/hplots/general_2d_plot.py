@@ -1,8 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from hplots.binning import Binning
+
 
 class General2dBinningPlot():
+    # bins are [low, high) if False, (low, high) if True
+    open_lower_edge = False
+
     def __init__(self, bins, x_label='x-axis', y_label='y-axis', title='', y_label_hist='Histogram (fraction)', histogram_log=True, histogram_fraction=True,
                  yscale='linear'):
         self.models_data = list()
@@ -22,49 +27,37 @@ class General2dBinningPlot():
         # self.e_bins = [0, 1., 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,16,18, 20, 25, 30, 40, 50, 60, 70, 80, 90, 100, 120,140,160,180,200]
 
 
-    def _compute(self, x_values, y_values, weights=None):
-        e_bins = self.e_bins
-        e_bins_n = np.array(e_bins)
-        e_bins_n = (e_bins_n - e_bins_n.min()) / (e_bins_n.max() - e_bins_n.min())
-
-        centers = []
-        mean = []
-
-        lows = []
-        highs = []
-
-        if weights is None:
-            weights = np.ones_like(y_values)
-
-        for i in range(len(e_bins) - 1):
-            l = e_bins[i]
-            h = e_bins[i + 1]
-
-
-            filter = np.argwhere(np.logical_and(x_values >= l, x_values < h))
-            filtered_y_values = y_values[filter].astype(float)
-            filtered_weights = weights[filter].astype(float)
-
-            m = np.sum(filtered_y_values*filtered_weights)/np.sum(filtered_weights)
-            mean.append(m)
-            # print(np.sum(filtered_found), len(filtered_found), m, l, h)
-            lows.append(l)
-            highs.append(h)
-
-
-        hist_values, _ = np.histogram(x_values, bins=e_bins)
-        # hist_values = (hist_values / (e_bins_n[1:] - e_bins_n[:-1])).tolist()
-        # hist_values = (hist_values / np.sum(hist_values))
-
+    def _get_binning(self, x_values, binning=None):
+        """
+        :param binning: Binning of x_values in self.e_bins that can be shared with other plots, built if None
+        """
+        if binning is None:
+            binning = Binning(x_values, self.e_bins)
+        elif not np.array_equal(binning.bins, self.e_bins):
+            raise ValueError("binning has different bins than the plot")
+        if self.open_lower_edge:
+            binning = binning.with_open_lower_edge()
+        return binning
+
+    def _make_processed_data(self, hist_values, mean, error=None):
         processed_data = dict()
-        processed_data['bin_lower_energy'] = np.array(lows)
-        processed_data['bin_upper_energy'] = np.array(highs)
+        processed_data['bin_lower_energy'] = np.array(self.e_bins[:-1])
+        processed_data['bin_upper_energy'] = np.array(self.e_bins[1:])
         processed_data['hist_values'] = hist_values
-        processed_data['mean'] = np.array(mean)
-
+        processed_data['mean'] = mean
+        if error is not None:
+            processed_data['error'] = error
         return processed_data
 
-    def add_raw_values(self, x_values, y_values, tags={}, weights=None):
+    def _compute(self, x_values, y_values, weights=None, binning=None):
+        binning = self._get_binning(x_values, binning)
+        return self._make_processed_data(binning.histogram(), binning.weighted_mean(y_values, weights))
+
+    def add_raw_values(self, x_values, y_values, tags={}, weights=None, binning=None):
+        """
+        :param binning: optional Binning of x_values in the bins of this plot (see hplots.binning), such that
+                        the bin indices are only computed once for all plots with the same x values
+        """
         if type(x_values) is not np.ndarray:
             raise ValueError("x values has to be numpy array")
         if type(y_values) is not np.ndarray:
@@ -75,7 +68,7 @@ class General2dBinningPlot():
 
 
 
-        data = self._compute(x_values, y_values, weights=weights)
+        data = self._compute(x_values, y_values, weights=weights, binning=binning)
         data['tags'] = tags
         self.models_data.append(data)
 
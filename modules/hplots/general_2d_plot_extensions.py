@@ -30,49 +30,10 @@ class EffFakeRatePlot(General2dBinningPlot):
                  x_label='Num hits', y_label='Reconstruction efficiency', title='Efficiency comparison', y_label_hist='Histogram (fraction)',histogram_log=False):
         super().__init__(bins, x_label, y_label, title, y_label_hist, histogram_log=histogram_log)
 
-    def _compute(self, x_values, y_values, weights=None):
-        e_bins = self.e_bins
-        e_bins_n = np.array(e_bins)
-        e_bins_n = (e_bins_n - e_bins_n.min()) / (e_bins_n.max() - e_bins_n.min())
-
-        centers = []
-        mean = []
-        error = []
-
-        lows = []
-        highs = []
-
-        if weights is None:
-            weights = np.ones_like(y_values)
-
-
-        for i in range(len(e_bins) - 1):
-            l = e_bins[i]
-            h = e_bins[i + 1]
-
-
-            filter = np.argwhere(np.logical_and(x_values >= l, x_values < h))
-            filtered_y_values = y_values[filter].astype(float)
-            filtered_weights = weights[filter].astype(float)
-            m = np.sum(filtered_y_values*filtered_weights)/np.sum(filtered_weights)
-            mean.append(m)
-            # print(np.sum(filtered_found), len(filtered_found), m, l, h)
-            lows.append(l)
-            highs.append(h)
-            error.append(np.sqrt(m * (1 - m) / len(filtered_y_values)))
-
-        hist_values, _ = np.histogram(x_values, bins=e_bins)
-        # hist_values = (hist_values / (e_bins_n[1:] - e_bins_n[:-1])).tolist()
-        # hist_values = (hist_values / np.sum(hist_values))
-
-        processed_data = dict()
-        processed_data['bin_lower_energy'] = np.array(lows)
-        processed_data['bin_upper_energy'] = np.array(highs)
-        processed_data['hist_values'] = hist_values
-        processed_data['mean'] = np.array(mean)
-        processed_data['error'] = np.array(error)
-
-        return processed_data
+    def _compute(self, x_values, y_values, weights=None, binning=None):
+        binning = self._get_binning(x_values, binning)
+        mean = binning.weighted_mean(y_values, weights)
+        return self._make_processed_data(binning.histogram(), mean, error=binning.efficiency_error(mean))
 
 
 class EfficiencyFoTruthEnergyPlot(EffFakeRatePlot):
@@ -117,50 +78,12 @@ class EnergyFoundFoTruthEnergyPlot(General2dBinningPlot):
                  histogram_fraction=True, histogram_log=False):
         super().__init__(bins, x_label, y_label, title, y_label_hist, histogram_fraction=histogram_fraction, histogram_log=histogram_log)
 
-    def _compute(self, x_values, y_values, weights=None):
-        e_bins = self.e_bins
-        e_bins_n = np.array(e_bins)
-        e_bins_n = (e_bins_n - e_bins_n.min()) / (e_bins_n.max() - e_bins_n.min())
-
-        centers = []
-        mean = []
-
-        lows = []
-        highs = []
-
-        hist_values = []
-
-        for i in range(len(e_bins) - 1):
-            l = e_bins[i]
-            h = e_bins[i + 1]
-
-
-            filter = np.argwhere(np.logical_and(x_values >= l, x_values < h))
-            filtered_y_values = y_values[filter].astype(float)
-            filtered_x_values = x_values[filter].astype(float)
-
-            hist_values.append(np.sum(filtered_x_values))
-
-
-            m = np.sum(filtered_y_values) / np.sum(filtered_x_values)
-
-            mean.append(m)
-            lows.append(l)
-            highs.append(h)
-
-
-        # hist_values, _ = np.histogram(x_values, bins=e_bins)
-        hist_values = np.array(hist_values)
-        # hist_values = (hist_values / (e_bins_n[1:] - e_bins_n[:-1])).tolist()
-        # hist_values = (hist_values / np.sum(hist_values))
-
-        processed_data = dict()
-        processed_data['bin_lower_energy'] = np.array(lows)
-        processed_data['bin_upper_energy'] = np.array(highs)
-        processed_data['hist_values'] = hist_values
-        processed_data['mean'] = np.array(mean)
-
-        return processed_data
+    def _compute(self, x_values, y_values, weights=None, binning=None):
+        binning = self._get_binning(x_values, binning)
+        hist_values = binning.sum(x_values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = binning.sum(y_values) / hist_values
+        return self._make_processed_data(hist_values, mean)
 
 
     @classmethod
@@ -247,49 +170,10 @@ class ResponseFoEnergyPlot(General2dBinningPlot):
         if return_fig:
             return fig
 
-    def _compute(self, x_values, y_values, weights=None):
-        e_bins = self.e_bins
-        e_bins_n = np.array(e_bins)
-        e_bins_n = (e_bins_n - e_bins_n.min()) / (e_bins_n.max() - e_bins_n.min())
-
-        centers = []
-        mean = []
-        error = []
-
-        lows = []
-        highs = []
-
-        if weights is None:
-            weights = np.ones_like(y_values)
-
-        for i in range(len(e_bins) - 1):
-            l = e_bins[i]
-            h = e_bins[i + 1]
-
-
-            filter = np.argwhere(np.logical_and(x_values >= l, x_values < h))
-            filtered_y_values = y_values[filter].astype(float)
-            filtered_weights = weights[filter].astype(float)
-
-            m = np.sum(filtered_y_values*filtered_weights)/np.sum(filtered_weights)
-            mean.append(m)
-            # print(np.sum(filtered_found), len(filtered_found), m, l, h)
-            lows.append(l)
-            highs.append(h)
-            error.append(m / np.sqrt(float(len(filtered_y_values))))
-
-        hist_values, _ = np.histogram(x_values, bins=e_bins)
-        # hist_values = (hist_values / (e_bins_n[1:] - e_bins_n[:-1])).tolist()
-        # hist_values = (hist_values / np.sum(hist_values))
-
-        processed_data = dict()
-        processed_data['bin_lower_energy'] = np.array(lows)
-        processed_data['bin_upper_energy'] = np.array(highs)
-        processed_data['hist_values'] = hist_values
-        processed_data['mean'] = np.array(mean)
-        processed_data['error'] = np.array(error)
-
-        return processed_data
+    def _compute(self, x_values, y_values, weights=None, binning=None):
+        binning = self._get_binning(x_values, binning)
+        mean = binning.weighted_mean(y_values, weights)
+        return self._make_processed_data(binning.histogram(), mean, error=binning.relative_error(mean))
 
 
 class ResponseFoLocalShowerEnergyFractionPlot(ResponseFoEnergyPlot):
@@ -323,47 +207,13 @@ class ResolutionFoEnergyPlot(General2dBinningPlot):
                  , histogram_log=True):
         super().__init__(bins, x_label, y_label, title, y_label_hist,histogram_log=histogram_log)
 
-    def _compute(self, x_values, y_values, weights=None):
-        e_bins = self.e_bins
-        e_bins_n = np.array(e_bins)
-        e_bins_n = (e_bins_n - e_bins_n.min()) / (e_bins_n.max() - e_bins_n.min())
-
-        centers = []
-        mean = []
-
-        lows = []
-        highs = []
-        error = []
-
-        for i in range(len(e_bins) - 1):
-            l = e_bins[i]
-            h = e_bins[i + 1]
-
-            filter = np.argwhere(np.logical_and(x_values > l, x_values < h))
-            filtered_y_values = y_values[filter].astype(np.float)
-
-            m = np.mean(filtered_y_values)
-            m = (np.std(filtered_y_values - m) / m)
-            mean.append(m)
-            # print(np.sum(filtered_found), len(filtered_found), m, l, h)
-            lows.append(l)
-            highs.append(h)
-            error.append(m / np.sqrt(float(len(filtered_y_values))))
-
-
-
-        hist_values, _ = np.histogram(x_values, bins=e_bins)
-        # hist_values = (hist_values / (e_bins_n[1:] - e_bins_n[:-1])).tolist()
-        # hist_values = (hist_values / np.sum(hist_values))
-
-        processed_data = dict()
-        processed_data['bin_lower_energy'] = np.array(lows)
-        processed_data['bin_upper_energy'] = np.array(highs)
-        processed_data['hist_values'] = hist_values
-        processed_data['mean'] = np.array(mean)
-        processed_data['error'] = np.array(error)
+    # bins are (low, high)
+    open_lower_edge = True
 
-        return processed_data
+    def _compute(self, x_values, y_values, weights=None, binning=None):
+        binning = self._get_binning(x_values, binning)
+        mean = binning.relative_std(y_values)
+        return self._make_processed_data(binning.histogram(), mean, error=binning.relative_error(mean))
 
 
 class ResolutionFoLocalShowerEnergyFraction(ResolutionFoEnergyPlot):
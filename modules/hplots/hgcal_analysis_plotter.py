@@ -9,6 +9,7 @@ from hplots.general_2d_plot_extensions_2 import EfficiencyFakeRatePlot, Response
 from hplots.general_hist_extensions import ResponseHisto, Multi4HistEnergy
 from hplots.general_hist_plot import GeneralHistogramPlot
 from hplots.general_graph_plot import GeneralGraphPlot
+from hplots.binning import Binning
 import hplots.utils as utils
 
 def eta_transform(eta):
@@ -25,6 +26,7 @@ class HGCalAnalysisPlotter:
         self.energy_res_bins = np.linspace(-1,1,50)
         self.energy_res_estimator_bins = np.linspace(0.,0.75,50)
         self.quantiles_res_plot = [0.25,0.75]
+        self._binnings = {}
 
     def set_energy_bins(self, energy_bins):
         self.energy_bins = energy_bins
@@ -38,6 +40,16 @@ class HGCalAnalysisPlotter:
     def set_pt_bins(self, pt_bins):
         self.pt_bins = pt_bins
 
+    def _binning(self, key, x_values, bins):
+        """
+        Binning of x_values shared by all plots of the same variable and selection (key) with the same bins,
+        the bin indices are only computed once per process()
+        """
+        cache_key = (key, tuple(np.asarray(bins).tolist()))
+        if cache_key not in self._binnings:
+            self._binnings[cache_key] = Binning(x_values, bins)
+        return self._binnings[cache_key]
+
     def set_quantiles_res_plot(self, quantiles):
         self.quantiles_res_plot = quantiles
 
@@ -76,23 +88,27 @@ class HGCalAnalysisPlotter:
 
         # Efficiency fo true energy
         plot = EfficiencyFakeRatePlot(bins=self.energy_bins, x_label='True Energy [GeV]', y_label='Efficiency')
-        plot.add_raw_values(self.showers_dataframe['truthHitAssignedEnergies'][filter_has_truth].to_numpy(), found)
+        x = self.showers_dataframe['truthHitAssignedEnergies'][filter_has_truth].to_numpy()
+        plot.add_raw_values(x, found, binning=self._binning('truth_energy/has_truth', x, self.energy_bins))
         self.pdf_efficiency.savefig(plot.draw())
 
         # Efficiency fo pT
         plot = EfficiencyFakeRatePlot(bins=self.pt_bins, x_label='pT [GeV]', y_label='Efficiency')
-        plot.add_raw_values(self.showers_dataframe['truth_pt'][filter_has_truth].to_numpy(), found)
+        x = self.showers_dataframe['truth_pt'][filter_has_truth].to_numpy()
+        plot.add_raw_values(x, found, binning=self._binning('truth_pt/has_truth', x, self.pt_bins))
         self.pdf_efficiency.savefig(plot.draw())
 
         # Efficiency fo local shower energy fraction
         plot = EfficiencyFakeRatePlot(bins=self.local_shower_fraction_bins, x_label='Local shower energy fraction', y_label='Efficiency')
         x = self.showers_dataframe['truth_local_shower_energy_fraction'][filter_has_truth].to_numpy()
-        plot.add_raw_values(self.showers_dataframe['truth_local_shower_energy_fraction'][filter_has_truth].to_numpy(), found)
+        plot.add_raw_values(x, found, binning=self._binning('truth_local_shower_energy_fraction/has_truth', x,
+                                                            self.local_shower_fraction_bins))
         self.pdf_efficiency.savefig(plot.draw())
 
         # Efficiency fo eta
         plot = EfficiencyFakeRatePlot(bins=self.eta_bins, x_label='$|\\eta_{true}|$', y_label='Efficiency')
-        plot.add_raw_values(eta_transform(self.showers_dataframe['truthHitAssignedEta'][filter_has_truth].to_numpy()), found)
+        x = eta_transform(self.showers_dataframe['truthHitAssignedEta'][filter_has_truth].to_numpy())
+        plot.add_raw_values(x, found, binning=self._binning('truth_abs_eta/has_truth', x, self.eta_bins))
         self.pdf_efficiency.savefig(plot.draw())
 
     def _make_fake_rate_plots(self):
@@ -101,18 +117,20 @@ class HGCalAnalysisPlotter:
 
         # Efficiency fo true energy
         plot = EfficiencyFakeRatePlot(bins=self.energy_bins, x_label='Pred Energy [GeV]', y_label='Fake rate')
-        plot.add_raw_values(self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy(), fake)
+        x = self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy()
+        plot.add_raw_values(x, fake, binning=self._binning('pred_energy/has_pred', x, self.energy_bins))
         self.pdf_fake_rate.savefig(plot.draw())
 
         # Fake rate fo pT
         plot = EfficiencyFakeRatePlot(bins=self.pt_bins, x_label='pT [GeV]', y_label='Fake rate')
-        plot.add_raw_values(self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy(), fake)
+        x = self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy()
+        plot.add_raw_values(x, fake, binning=self._binning('pred_energy/has_pred', x, self.pt_bins))
         self.pdf_fake_rate.savefig(plot.draw())
 
         # Fake rate fo eta
         plot = EfficiencyFakeRatePlot(bins=self.eta_bins, x_label='$|\\eta_{true}|$', y_label='Fake rate')
-        plot.add_raw_values(
-            eta_transform(self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy()), fake)
+        x = eta_transform(self.showers_dataframe['pred_energy'][filter_has_pred].to_numpy())
+        plot.add_raw_values(x, fake, binning=self._binning('abs_pred_energy/has_pred', x, self.eta_bins))
         self.pdf_fake_rate.savefig(plot.draw())
 
     def _make_resolution_plots(self):
@@ -124,25 +142,28 @@ class HGCalAnalysisPlotter:
 
         # Resolution fo true energy
         plot = ResolutionPlot(bins=self.energy_bins, x_label='True Energy [GeV]', y_label='Resolution')
-        plot.add_raw_values(self.showers_dataframe['truthHitAssignedEnergies'][filter].to_numpy(), response)
+        x = self.showers_dataframe['truthHitAssignedEnergies'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_energy/matched', x, self.energy_bins))
         self.pdf_resolution.savefig(plot.draw())
 
         # Resolution fo pT
         plot = ResolutionPlot(bins=self.pt_bins, x_label='pT [GeV]', y_label='Resolution')
-        plot.add_raw_values(self.showers_dataframe['truth_pt'][filter].to_numpy(), response)
+        x = self.showers_dataframe['truth_pt'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_pt/matched', x, self.pt_bins))
         self.pdf_resolution.savefig(plot.draw())
 
         # Resolution fo local shower energy fraction
         plot = ResolutionPlot(bins=self.local_shower_fraction_bins, x_label='Local shower energy fraction',
                                       y_label='Resolution')
-        plot.add_raw_values(self.showers_dataframe['truth_local_shower_energy_fraction'][filter].to_numpy(),
-                            response)
+        x = self.showers_dataframe['truth_local_shower_energy_fraction'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_local_shower_energy_fraction/matched', x,
+                                                               self.local_shower_fraction_bins))
         self.pdf_resolution.savefig(plot.draw())
 
         # Resolution fo e other
         plot = ResolutionPlot(bins=self.energy_bins, x_label='$E_{other}$ [GeV]', y_label='Resolution')
-        plot.add_raw_values(self.showers_dataframe['truth_e_other'][filter].to_numpy(),
-                            response)
+        x = self.showers_dataframe['truth_e_other'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_e_other/matched', x, self.energy_bins))
         self.pdf_resolution.savefig(plot.draw())
 
     def _make_resolution_estimator_plots(self):
@@ -192,31 +213,34 @@ class HGCalAnalysisPlotter:
 
         # Response fo true energy
         plot = ResponsePlot(bins=self.energy_bins, x_label='True Energy [GeV]', y_label='Response')
-        plot.add_raw_values(self.showers_dataframe['truthHitAssignedEnergies'][filter].to_numpy(), response)
+        x = self.showers_dataframe['truthHitAssignedEnergies'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_energy/matched', x, self.energy_bins))
         self.pdf_response.savefig(plot.draw())
 
         # Response fo pT
         plot = ResponsePlot(bins=self.pt_bins, x_label='pT [GeV]', y_label='Response')
-        plot.add_raw_values(self.showers_dataframe['truth_pt'][filter].to_numpy(), response)
+        x = self.showers_dataframe['truth_pt'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_pt/matched', x, self.pt_bins))
         self.pdf_response.savefig(plot.draw())
 
         # Response fo local shower energy fraction
         plot = ResponsePlot(bins=self.local_shower_fraction_bins, x_label='Local shower energy fraction',
                                       y_label='Response')
-        plot.add_raw_values(self.showers_dataframe['truth_local_shower_energy_fraction'][filter].to_numpy(),
-                            response)
+        x = self.showers_dataframe['truth_local_shower_energy_fraction'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_local_shower_energy_fraction/matched', x,
+                                                               self.local_shower_fraction_bins))
         self.pdf_response.savefig(plot.draw())
 
         # Response fo eta
         plot = ResponsePlot(bins=self.eta_bins, x_label='$|\\eta_{true}|$', y_label='Response')
-        plot.add_raw_values(eta_transform(self.showers_dataframe['truthHitAssignedEta'][filter].to_numpy()),
-                            response)
+        x = eta_transform(self.showers_dataframe['truthHitAssignedEta'][filter].to_numpy())
+        plot.add_raw_values(x, response, binning=self._binning('truth_abs_eta/matched', x, self.eta_bins))
         self.pdf_response.savefig(plot.draw())
 
         # Response fo e other
         plot = ResponsePlot(bins=self.energy_bins, x_label='$E_{other}$ [GeV]', y_label='Response')
-        plot.add_raw_values(self.showers_dataframe['truth_e_other'][filter].to_numpy(),
-                            response)
+        x = self.showers_dataframe['truth_e_other'][filter].to_numpy()
+        plot.add_raw_values(x, response, binning=self._binning('truth_e_other/matched', x, self.energy_bins))
         self.pdf_response.savefig(plot.draw())
 
     def _write_scalar_properties(self):
@@ -302,6 +326,7 @@ class HGCalAnalysisPlotter:
 
 
     def process(self):
+        self._binnings = {}
         self._make_pdfs()
 
         self._add_additional_columns()
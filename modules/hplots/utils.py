@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from hplots.binning import grouped_sum, grouped_quantiles
+
 def profile(target,xvar,bins=10,range=None,uniform=False,moments=True,
             quantiles=np.array([0.25,0.75]),average=False):
 
@@ -22,28 +24,21 @@ def profile(target,xvar,bins=10,range=None,uniform=False,moments=True,
             bins[0] = xmin
             bins[-1] = xmax
     ibins = np.digitize(xvar,bins)-1
-    categories = np.eye(np.max(ibins)+1)[ibins]
+    n_cat = np.max(ibins)+1
+    counts = np.bincount(ibins,minlength=n_cat)
 
     ret = [bins]
-    mxvar=xvar.reshape(-1,1) * categories
     if average==True :
-        if (sum(categories)!=0).all(): 
-            ret = [ np.average(mxvar,weights=categories,axis=0) ]
+        if (counts!=0).all():
+            ret = [ grouped_sum(ibins,xvar,n_cat) / counts ]
         else:
             ret = [bins[:-1]]
     if moments:
-        mtarget = target.reshape(-1,1) * categories
-        weights = categories
-        mean = np.average(mtarget,weights=categories,axis=0)
-        mean2 = np.average(mtarget**2,weights=categories,axis=0)
+        if (counts==0).any():
+            raise ZeroDivisionError("Weights sum to zero, can't be normalized")
+        mean = grouped_sum(ibins,target,n_cat) / counts
+        mean2 = grouped_sum(ibins,target**2,n_cat) / counts
         ret.extend( [mean, np.sqrt( mean2 - mean**2)] )
     if quantiles is not None:
-        values = []
-        for ibin in np.arange(categories.shape[1],dtype=int):
-            target_in_bin = target[categories[:,ibin].astype(np.bool)]
-            if len(target_in_bin)>0:
-                values.append( np.percentile(target_in_bin,quantiles*100.,axis=0).reshape(-1,1) )
-            else:
-                values.append(np.zeros_like(quantiles).reshape(-1,1))
-        ret.append( np.concatenate(values,axis=-1) )
+        ret.append( grouped_quantiles(ibins,target,quantiles,n_cat,empty_value=0.) )
     return tuple(ret)
\ No newline at end of file
@@ -72,8 +72,17 @@ class Basic_OC_per_sample(object):
                  q_min,
                  s_b,
                  use_mean_x,
-                 spect_supp=None #None means same as noise
+                 spect_supp=None, #None means same as noise
+                 knn_repulsion_k=-1,
+                 knn_repulsion_radius=-1.
                  ):
+        '''
+        knn_repulsion_k: if > 0, the repulsive potential is only evaluated for the
+                         knn_repulsion_k nearest neighbours of each condensation point 
+                         (in the clustering space, using BinnedSelectKnn) instead of all vertices.
+                         Memory K x knn_repulsion_k instead of K x V.
+        knn_repulsion_radius: if > 0, neighbours further away than this (not scaled by d) are ignored
+        '''
         
         self.q_min = q_min
         self.s_b = s_b
@@ -81,6 +90,8 @@ class Basic_OC_per_sample(object):
         if spect_supp is None:
             spect_supp = s_b
         self.spect_supp = spect_supp
+        self.knn_repulsion_k = knn_repulsion_k
+        self.knn_repulsion_radius = knn_repulsion_radius
         
         self.valid=False #constants not created
         
@@ -96,6 +107,17 @@ class Basic_OC_per_sample(object):
         
         return x_kalpha_m 
     
+    def _offset_truth_idx(self, truth_idx, row_splits):
+        '''
+        makes the truth indices unique across row splits, noise stays -1
+        '''
+        n_rs = tf.shape(row_splits)[0] - 1
+        max_t = tf.math.unsorted_segment_max(truth_idx[:,0], self.rsid_v, n_rs) # -inf (lowest) for empty
+        n_t = tf.maximum(max_t, -1) + 1 #n_rs
+        offset = tf.cumsum(n_t, exclusive=True)
+        offset_v = tf.expand_dims(tf.gather(offset, self.rsid_v), axis=1)
+        return tf.where(truth_idx < 0, truth_idx, truth_idx + offset_v)
+    
     def set_input(self, 
                          beta,
                          x,
@@ -105,8 +127,18 @@ class Basic_OC_per_sample(object):
                          object_weight,
                          is_spectator_weight,
                          
+                         row_splits=None
                          ):
+        '''
+        row_splits: if given, all row splits are processed at once (use add_batch_to_terms). 
+                    The objects of all row splits are selected in one go using truth indices 
+                    that are offset per row split, and the repulsion is restricted to the same row split.
+                    Nothing is evaluated eagerly in this mode, so it can be traced by tf.function.
+                    The dense repulsion needs K_batch x V_batch memory, for larger batches 
+                    consider knn_repulsion_k.
+        '''
         self.valid=True
+        self.batched = row_splits is not None
         #used for pll and q
         self.tanhsqbeta = tf.math.atanh(beta/(1.+1e-3))**2
         
@@ -120,10 +152,21 @@ class Basic_OC_per_sample(object):
         #spectators do not participate in the potential losses
         self.q_v = (self.tanhsqbeta + self.q_min)*tf.clip_by_value(1.-is_spectator_weight, 0., 1.)
         
-        self.Msel, self.Mnot, _ = CreateMidx(truth_idx, calc_m_not=True)
+        if self.batched:
+            self.rs = tf.cast(row_splits, 'int32')
+            self.n_rs = tf.shape(self.rs)[0] - 1
+            self.rsid_v = tf.ragged.row_splits_to_segment_ids(self.rs, out_type=tf.int32) # V
+            truth_idx = self._offset_truth_idx(truth_idx, self.rs)
+        self.truth_idx_v = truth_idx
+        
+        #the knn repulsion does not need the dense K x V matrix
+        calc_m_not = self.knn_repulsion_k <= 0
+        self.Msel, self.Mnot, N_obj_k = CreateMidx(truth_idx, calc_m_not=calc_m_not, eager=not self.batched)
         if self.Msel is None:
             self.valid=False
             return
+        if not calc_m_not:
+            self.Mnot = None
         
         self.mask_k_m = SelectWithDefault(self.Msel, tf.zeros_like(beta)+1., 0.) #K x V-obj x 1
         self.beta_k_m = SelectWithDefault(self.Msel, self.beta_v, 0.) #K x V-obj x 1
@@ -132,12 +175,25 @@ class Basic_OC_per_sample(object):
         self.d_k_m = SelectWithDefault(self.Msel, self.d_v, 0.)
         
         self.alpha_k = tf.argmax(self.q_k_m, axis=1)# high beta and not spectator -> large q
+        self.alpha_v_k = tf.gather_nd(self.Msel, self.alpha_k, batch_dims=1) # K, vertex index of alpha
+        self.truth_idx_k = tf.gather(truth_idx, self.alpha_v_k) # K x 1
         
         self.beta_k = tf.gather_nd(self.beta_k_m, self.alpha_k, batch_dims=1) # K x 1
         self.x_k = self._create_x_alpha_k() #K x C
         self.q_k = tf.gather_nd(self.q_k_m, self.alpha_k, batch_dims=1) # K x 1
         self.d_k = tf.gather_nd(self.d_k_m, self.alpha_k, batch_dims=1) # K x 1
         
+        #number of vertices not belonging to the object (in the same row split)
+        if self.batched:
+            self.rsid_k = tf.gather(self.rsid_v, self.alpha_v_k) # K
+            n_v_k = tf.gather(self.rs[1:] - self.rs[:-1], self.rsid_k)[:, tf.newaxis] # K x 1
+            if calc_m_not:
+                same_rs = tf.expand_dims(self.rsid_k, axis=1) == tf.expand_dims(self.rsid_v, axis=0) # K x V
+                self.Mnot = self.Mnot * tf.cast(same_rs, 'float32')[..., tf.newaxis]
+        else:
+            n_v_k = tf.shape(truth_idx)[0]
+        self.N_not_k = tf.cast(n_v_k - N_obj_k, 'float32') # K x 1
+        
         #just a temp
         ow_k_m = SelectWithDefault(self.Msel, object_weight, 0.)
         self.ow_k = tf.gather_nd(ow_k_m, self.alpha_k, batch_dims=1) # K x 1
@@ -170,12 +226,64 @@ class Basic_OC_per_sample(object):
     def rep_func(self,dsq_k_v):
         return tf.math.exp(-dsq_k_v/2.)
         
+    def _rep_neighbours_k(self):
+        '''
+        Output: K x N neighbour indices of the condensation points, padded with -1
+        '''
+        from binned_select_knn_query_op import BinnedSelectKnnQuery
+        
+        x_v = tf.stop_gradient(self.x_v)
+        K = self.knn_repulsion_k
+        if self.batched:
+            rs = self.rs
+        else:
+            rs = tf.stack([0, tf.shape(x_v)[0]])
+            if x_v.shape[0] is not None:
+                K = min(K, x_v.shape[0])
+        max_radius = self.knn_repulsion_radius if self.knn_repulsion_radius > 0 else None
+        #only the condensation points search, the cost does not scale with V x K
+        nidx, _ = BinnedSelectKnnQuery(K, x_v, rs, self.alpha_v_k, max_bin_dims=min(3, x_v.shape[1]),
+                                       max_radius=max_radius)
+        return tf.stop_gradient(nidx)
+    
+    def _V_rep_k_knn(self):
+        '''
+        Same as the dense V_rep_k but only summed over the neighbours of each alpha.
+        Converges to the dense version for large knn_repulsion_k (up to use_mean_x shifting 
+        the centre away from the alpha vertex used for the neighbour search)
+        '''
+        d_k_e = tf.expand_dims(self.d_k, axis=1)
+        
+        N_k = self.N_not_k #normalisation stays the same as for the dense version
+        
+        nidx = self._rep_neighbours_k() #K x N, neighbours are always in the same row split
+        x_k_n = SelectWithDefault(nidx, self.x_v, 0.) #K x N x C
+        q_k_n = SelectWithDefault(nidx, self.q_v, 0.) #K x N x 1
+        t_k_n = SelectWithDefault(nidx, self.truth_idx_v, -1) #K x N x 1
+        Mnot_k_n = tf.logical_and(tf.expand_dims(nidx, axis=2) >= 0, 
+                                  t_k_n != tf.expand_dims(self.truth_idx_k, axis=1))
+        Mnot_k_n = tf.cast(Mnot_k_n, 'float32') #K x N x 1
+        
+        dsq = tf.expand_dims(self.x_k, axis=1) - x_k_n #K x N x C
+        dsq = tf.reduce_sum(dsq**2, axis=-1, keepdims=True)  #K x N x 1
+        dsq = tf.math.divide_no_nan(dsq, d_k_e**2 + 1e-6) #K x N x 1
+        
+        V_rep = self.rep_func(dsq) * Mnot_k_n * q_k_n  #K x N x 1
+        
+        V_rep = self.q_k * tf.reduce_sum(V_rep, axis=1) #K x 1
+        V_rep = tf.math.divide_no_nan(V_rep, N_k)  #K x 1
+        
+        return V_rep
+        
     def V_rep_k(self):
         
+        if self.knn_repulsion_k > 0:
+            return self._V_rep_k_knn()
+        
         d_k_e = tf.expand_dims(self.d_k, axis=1)
         
         N_k = tf.reduce_sum(self.Mnot, axis=1)
-        #future remark: if this gets too large, one could use a kNN here
+        #for large inputs, use knn_repulsion_k
         
         dsq = tf.expand_dims(self.x_k, axis=1) - tf.expand_dims(self.x_v, axis=0) #K x V x C
         dsq = tf.reduce_sum(dsq**2, axis=-1, keepdims=True)  #K x V x 1
@@ -205,6 +313,9 @@ class Basic_OC_per_sample(object):
         
     def Noise_pen(self):
         
+        if self.batched:
+            return self._Noise_pen_batched()
+        
         nsupp_v = self.beta_v * self.isn_v
         nsupp = tf.math.divide_no_nan(tf.reduce_sum(nsupp_v), 
                                       tf.reduce_sum(self.isn_v)) # nodim
@@ -214,6 +325,19 @@ class Basic_OC_per_sample(object):
                                       tf.reduce_sum(self.sw_v)) # nodim
         
         return self.s_b * nsupp + self.spect_supp * specsupp
+    
+    def _Noise_pen_batched(self):
+        '''
+        Same as Noise_pen per row split, summed over all row splits with at least one object
+        '''
+        def per_rs(x_v):
+            return tf.math.unsorted_segment_sum(x_v, self.rsid_v, self.n_rs) #n_rs x 1
+        
+        nsupp = tf.math.divide_no_nan(per_rs(self.beta_v * self.isn_v), per_rs(self.isn_v))
+        specsupp = tf.math.divide_no_nan(per_rs(self.beta_v * self.sw_v), per_rs(self.sw_v))
+        
+        has_obj = tf.math.unsorted_segment_sum(tf.ones_like(self.beta_k), self.rsid_k, self.n_rs) > 0
+        return tf.reduce_sum(tf.where(has_obj, self.s_b * nsupp + self.spect_supp * specsupp, 0.))
         
     
     # doesn't do anything in this implementation
@@ -258,15 +382,54 @@ class Basic_OC_per_sample(object):
         high_B_pen += tf.reduce_sum(self.ow_k *self.high_B_pen_k())/K
         
         return V_att, V_rep, Noise_pen, B_pen, pll, high_B_pen
+    
+    def add_batch_to_terms(self,
+                     V_att, 
+                     V_rep,
+                     Noise_pen, 
+                     B_pen, 
+                     pll,
+                     high_B_pen
+                     ):
+        '''
+        Same as add_to_terms, called once per batch after set_input(..., row_splits=rs).
+        Adds the sum of the per row split terms.
+        '''
+        K_rs = tf.math.unsorted_segment_sum(tf.ones_like(self.beta_k), self.rsid_k, self.n_rs) #n_rs x 1
+        
+        def sum_k(x_k): # K x X -> X, sum over k / K per row split, summed over row splits
+            x_rs = tf.math.unsorted_segment_sum(x_k, self.rsid_k, self.n_rs) #n_rs x X
+            return tf.reduce_sum(tf.math.divide_no_nan(x_rs, K_rs), axis=0)
+        
+        V_att_k = self.V_att_k()
+        V_rep_k = self.V_rep_k()
+        
+        V_att += tf.reduce_sum(sum_k(self.ow_k * V_att_k))
+        V_rep += tf.reduce_sum(sum_k(self.ow_k * V_rep_k))
+        Noise_pen += self.Noise_pen()
+        B_pen += tf.reduce_sum(sum_k(self.ow_k * self.Beta_pen_k()))
+        
+        pl_ow_k = self.pll_weight_k(self.ow_k, V_att_k, V_rep_k)
+        pll += sum_k(pl_ow_k * self.Pll_k())
+        
+        high_B_pen += tf.reduce_sum(sum_k(self.ow_k *self.high_B_pen_k()))
+        
+        return V_att, V_rep, Noise_pen, B_pen, pll, high_B_pen
         
         
 
 class OC_loss(object):
     def __init__(self, 
                  loss_impl=Basic_OC_per_sample,
+                 batched=False,
                  **kwargs
                  ):
+        '''
+        batched: process all row splits in one pass instead of looping over them.
+                 Does not need eager execution.
+        '''
         self.loss_impl=loss_impl(**kwargs)
+        self.batched = batched
 
 
     def __call__(self, beta,
@@ -280,6 +443,10 @@ class OC_loss(object):
                          rs): #rs last
         
         tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen = 6*[tf.constant(0., tf.float32)]
+        
+        if self.batched:
+            return self._call_batched(beta, x, d, pll, truth_idx, object_weight, is_spectator_weight, rs)
+        
         #batch loop
             
         if rs.shape[0] is None or rs.shape[0] < 2:
@@ -306,6 +473,23 @@ class OC_loss(object):
         out = [a/bs for a in [tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen]]
         
         return out
+    
+    def _call_batched(self, beta, x, d, pll, truth_idx, object_weight, is_spectator_weight, rs):
+        
+        tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen = 6*[tf.constant(0., tf.float32)]
+        
+        self.loss_impl.set_input(beta, x, d, pll, truth_idx, object_weight, is_spectator_weight,
+                                 row_splits=rs)
+        
+        tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen = self.loss_impl.add_batch_to_terms(
+                tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen
+                )
+        
+        batch_size = tf.shape(rs)[0] - 1
+        bs = tf.cast(batch_size, dtype='float32') + 1e-3
+        out = [a/bs for a in [tot_V_att, tot_V_rep, tot_Noise_pen, tot_B_pen, tot_pll,tot_too_much_B_pen]]
+        
+        return out
 
 
 #################################################
@@ -28,8 +28,13 @@ m_not is the usual K x V dimension (for now) and can just be multiplied
 
 _op = tf.load_op_library('oc_helper_m_indices.so')
 
-def CreateMidx(truth_idxs, calc_m_not=False):
+def CreateMidx(truth_idxs, calc_m_not=False, eager=True):
     '''
+    eager=True:  returns None, None, None if there are no objects. This needs eager execution.
+    eager=False: does not evaluate any tensor and can be traced with tf.function. If there are 
+                 no objects, the outputs have zero length in the object (K) dimension.
+                 
+    
    /*
  * Takes as helper input
  * y, idx, count = tf.unique_with_counts(x)
@@ -55,9 +60,11 @@ REGISTER_OP("MIndicesOpFunctor")
     
     nmax_per_unique = tf.reduce_max(cperunique)
     #for empty tensors tf.reduce_max returns -lowest 32 bit integer or similar here
-    #eager
-    if nmax_per_unique.numpy() < 1:
-        return None, None, None
+    if eager:
+        if nmax_per_unique.numpy() < 1:
+            return None, None, None
+    else:
+        nmax_per_unique = tf.maximum(nmax_per_unique, 1) # K x 1 for K=0
 
     sel_dxs, m_not = _op.MIndices( 
         calc_m_not=calc_m_not,
@@ -65,6 +72,10 @@ REGISTER_OP("MIndicesOpFunctor")
         unique_idxs = unique_idxs,
         nmax_per_unique = nmax_per_unique
         )
+    if not eager: #the op has no shape function
+        sel_dxs = tf.reshape(sel_dxs, [tf.shape(unique_idxs)[0], nmax_per_unique])
+        if calc_m_not:
+            m_not = tf.reshape(m_not, [tf.shape(unique_idxs)[0], tf.shape(truth_idxs)[0]])
     
     return sel_dxs, tf.expand_dims(m_not,axis=2), tf.expand_dims(cperunique,axis=1) #just some conventions
     
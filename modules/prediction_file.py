@@ -0,0 +1,131 @@
+'''
+Columnar file format for the predictions written by HGCalPredictor.
+
+Each endcap is stored in its own HDF5 group with one dataset per
+feature, truth and prediction key:
+
+  /endcap_<i>/features/<key>
+  /endcap_<i>/truth/<key>
+  /endcap_<i>/predicted/<key>
+
+such that single endcaps can be read without decompressing the whole file.
+The reader also supports the old pickled .bin.gz files (these are read
+in full on opening).
+'''
+
+import gzip
+import pickle
+import os
+
+import h5py
+import numpy as np
+
+PREDICTION_FILE_EXTENSION = '.pred.h5'
+LEGACY_PREDICTION_FILE_EXTENSION = '.bin.gz'
+
+_FORMAT_NAME = 'hgcalml_prediction'
+_FORMAT_VERSION = 1
+_DICT_NAMES = ['features', 'truth', 'predicted']
+
+
+def is_prediction_file(filename):
+    filename = str(filename)
+    return filename.endswith(PREDICTION_FILE_EXTENSION) or filename.endswith(LEGACY_PREDICTION_FILE_EXTENSION)
+
+
+def prediction_file_name(filename):
+    '''
+    replaces any (known) extension by the prediction file extension
+    '''
+    filename = str(filename)
+    for ext in [PREDICTION_FILE_EXTENSION, LEGACY_PREDICTION_FILE_EXTENSION]:
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + PREDICTION_FILE_EXTENSION
+    return os.path.splitext(filename)[0] + PREDICTION_FILE_EXTENSION
+
+
+def write_prediction_file(dumping_data, outfilename, compression='lzf'):
+    '''
+    :param dumping_data: list with one [features_dict, truth_dict, predictions_dict] per endcap
+    :param outfilename: output file name
+    :param compression: h5py compression per dataset (lzf is fast to decompress)
+    '''
+    with h5py.File(outfilename, 'w') as f:
+        f.attrs['format'] = _FORMAT_NAME
+        f.attrs['version'] = _FORMAT_VERSION
+        f.attrs['n_endcaps'] = len(dumping_data)
+        for i, endcap_data in enumerate(dumping_data):
+            endcap_group = f.create_group('endcap_%d' % i)
+            for name, d in zip(_DICT_NAMES, endcap_data):
+                # keep the key order of the dicts
+                group = endcap_group.create_group(name, track_order=True)
+                for k, v in d.items():
+                    v = np.asarray(v)
+                    if v.ndim == 0:
+                        group.create_dataset(k, data=v)
+                    else:
+                        group.create_dataset(k, data=v, compression=compression)
+
+
+class PredictionFileReader(object):
+    '''
+    Random access and lazy iteration over the endcaps in a prediction file:
+
+        with PredictionFileReader(filename) as reader:
+            for features_dict, truth_dict, predictions_dict in reader:
+                ...
+            third_endcap = reader[2]
+    '''
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._file = None
+        self._legacy_data = None
+
+        if self.filename.endswith(LEGACY_PREDICTION_FILE_EXTENSION):
+            with gzip.open(self.filename, 'rb') as f:
+                self._legacy_data = pickle.load(f)
+        else:
+            self._file = h5py.File(self.filename, 'r')
+            if self._file.attrs.get('format') != _FORMAT_NAME:
+                self._file.close()
+                raise ValueError(self.filename + ' is not a prediction file')
+
+    def __len__(self):
+        if self._legacy_data is not None:
+            return len(self._legacy_data)
+        return int(self._file.attrs['n_endcaps'])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('endcap index out of range')
+        if self._legacy_data is not None:
+            return self._legacy_data[idx]
+        endcap_group = self._file['endcap_%d' % idx]
+        return [{k: v[()] for k, v in endcap_group[name].items()} for name in _DICT_NAMES]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._legacy_data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_prediction_file(filename):
+    '''
+    reads all endcaps at once, same output as the old pickled files
+    '''
+    with PredictionFileReader(filename) as reader:
+        return list(reader)
@@ -3,59 +3,111 @@ import os
 import gzip
 import pickle
 
-import mgzip
-
 import argparse
+import multiprocessing
 import time
 
 import pandas as pd
 
+from prediction_file import PredictionFileReader, is_prediction_file
 from OCHits2Showers import OCHits2Showers
 from ShowersMatcher import ShowersMatcher
 from hplots.hgcal_analysis_plotter import HGCalAnalysisPlotter
 
+def analyse_file(file, hits2showers, showers_matcher, kill_pu=True):
+    """
+    Clusters and matches all endcaps in one prediction file.
+
+    :return: list with one shower data frame per endcap, with event ids starting at 0 for this file
+    """
+    dataframes = []
+    # endcaps are read one by one
+    with PredictionFileReader(file) as file_data:
+        for j, endcap_data in enumerate(file_data):
+            print("Analysing endcap",j)
+            stopwatch = time.time()
+            features_dict, truth_dict, predictions_dict = endcap_data
+            processed_pred_dict, pred_shower_alpha_idx = hits2showers.call(features_dict, predictions_dict)
+            print('took',time.time()-stopwatch,'s for inference clustering')
+            stopwatch = time.time()
+            showers_matcher.set_inputs(
+                features_dict=features_dict,
+                truth_dict=truth_dict,
+                predictions_dict=processed_pred_dict,
+                pred_alpha_idx=pred_shower_alpha_idx
+            )
+            showers_matcher.process()
+            print('took',time.time()-stopwatch,'s to match')
+            stopwatch = time.time()
+            dataframe = showers_matcher.get_result_as_dataframe()
+            print('took',time.time()-stopwatch,'s to make data frame')
+            dataframe['event_id'] = j
+            if kill_pu:
+                from globals import pu
+                if len(dataframe[dataframe['truthHitAssignementIdx']>=pu.t_idx_offset]):
+                    print('\nWARNING REMOVING PU TRUTH MATCHED SHOWERS, HACK.\n')
+                    dataframe = dataframe[dataframe['truthHitAssignementIdx']<pu.t_idx_offset]
+            dataframes.append(dataframe)
+    return dataframes
+
+
+# per worker process state, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(beta_threshold, distance_threshold, iou_threshold, matching_mode, local_distance_scaling, is_soft, op,
+                 de_e_cut, angle_cut, kill_pu):
+    _worker_state['hits2showers'] = OCHits2Showers(beta_threshold, distance_threshold, is_soft, local_distance_scaling,
+                                                   op=op)
+    _worker_state['showers_matcher'] = ShowersMatcher(matching_mode, iou_threshold, de_e_cut, angle_cut)
+    _worker_state['kill_pu'] = kill_pu
+
+
+def _analyse_file_in_worker(file):
+    print("Analysing file", file)
+    dataframes = analyse_file(file, _worker_state['hits2showers'], _worker_state['showers_matcher'],
+                              kill_pu=_worker_state['kill_pu'])
+    # concatenate once per file, such that only one frame is sent back per file
+    n_events = len(dataframes)
+    if n_events == 0:
+        return None, 0
+    return pd.concat(dataframes), n_events
+
+
 def analyse(preddir, pdfpath, beta_threshold, distance_threshold, iou_threshold, matching_mode, analysisoutpath, nfiles,
-            local_distance_scaling, is_soft, op, de_e_cut, angle_cut, kill_pu=True):
-    hits2showers = OCHits2Showers(beta_threshold, distance_threshold, is_soft, local_distance_scaling, op=op)
-    showers_matcher = ShowersMatcher(matching_mode, iou_threshold, de_e_cut, angle_cut)
+            local_distance_scaling, is_soft, op, de_e_cut, angle_cut, kill_pu=True, nworkers=1):
 
-    files_to_be_tested = [os.path.join(preddir, x) for x in os.listdir(preddir) if x.endswith('.bin.gz')]
+    files_to_be_tested = [os.path.join(preddir, x) for x in os.listdir(preddir) if is_prediction_file(x)]
     if nfiles!=-1:
         files_to_be_tested = files_to_be_tested[0:min(nfiles, len(files_to_be_tested))]
 
-    showers_dataframe = pd.DataFrame()
+    # frames are collected and only concatenated once at the end
+    showers_dataframes = []
     event_id = 0
 
-    for i, file in enumerate(files_to_be_tested):
-        print("Analysing file", i, file)
-        with mgzip.open(file, 'rb') as f:
-            file_data = pickle.load(f)
-            for j, endcap_data in enumerate(file_data):
-                print("Analysing endcap",j)
-                stopwatch = time.time()
-                features_dict, truth_dict, predictions_dict = endcap_data
-                processed_pred_dict, pred_shower_alpha_idx = hits2showers.call(features_dict, predictions_dict)
-                print('took',time.time()-stopwatch,'s for inference clustering')
-                stopwatch = time.time()
-                showers_matcher.set_inputs(
-                    features_dict=features_dict,
-                    truth_dict=truth_dict,
-                    predictions_dict=processed_pred_dict,
-                    pred_alpha_idx=pred_shower_alpha_idx
-                )
-                showers_matcher.process()
-                print('took',time.time()-stopwatch,'s to match')
-                stopwatch = time.time()
-                dataframe = showers_matcher.get_result_as_dataframe()
-                print('took',time.time()-stopwatch,'s to make data frame')
-                dataframe['event_id'] = event_id
-                event_id += 1
-                if kill_pu:
-                    from globals import pu
-                    if len(dataframe[dataframe['truthHitAssignementIdx']>=pu.t_idx_offset]):
-                        print('\nWARNING REMOVING PU TRUTH MATCHED SHOWERS, HACK.\n')
-                        dataframe = dataframe[dataframe['truthHitAssignementIdx']<pu.t_idx_offset]
-                showers_dataframe = pd.concat((showers_dataframe, dataframe))
+    worker_args = (beta_threshold, distance_threshold, iou_threshold, matching_mode, local_distance_scaling, is_soft,
+                   op, de_e_cut, angle_cut, kill_pu)
+
+    if nworkers > 1:
+        # spawn: do not fork a process that already initialised tensorflow
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(nworkers, initializer=_init_worker, initargs=worker_args) as pool:
+            # imap keeps the file order, so event ids are the same as for the sequential processing
+            for dataframe, n_events in pool.imap(_analyse_file_in_worker, files_to_be_tested):
+                if dataframe is not None:
+                    showers_dataframes.append(dataframe.assign(event_id=dataframe['event_id'] + event_id))
+                event_id += n_events
+    else:
+        _init_worker(*worker_args)
+        for i, file in enumerate(files_to_be_tested):
+            print("Analysing file", i, file)
+            dataframes = analyse_file(file, _worker_state['hits2showers'], _worker_state['showers_matcher'],
+                                      kill_pu=kill_pu)
+            for dataframe in dataframes:
+                showers_dataframes.append(dataframe.assign(event_id=dataframe['event_id'] + event_id))
+            event_id += len(dataframes)
+
+    showers_dataframe = pd.concat(showers_dataframes) if len(showers_dataframes) else pd.DataFrame()
 
     # This is only to write to pdf files
     scalar_variables = {
@@ -88,7 +140,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         'Analyse predictions from object condensation and plot relevant results')
     parser.add_argument('preddir',
-                        help='Directory with .bin.gz files or a txt file with full paths of the bin gz files from the prediction.')
+                        help='Directory with .pred.h5 (or .bin.gz) files or a txt file with full paths of the files from the prediction.')
     parser.add_argument('-p',
                         help='Output directory for the final analysis pdf file (otherwise, it won\'t be produced)',
                         default='')
@@ -105,12 +157,14 @@ if __name__ == '__main__':
     parser.add_argument('--angle_cut', help='Angle cut for angle based matching', default=-1)
     parser.add_argument('--no_op', help='Use condensate op', action='store_true')
     parser.add_argument('--no_soft', help='Use condensate op', action='store_true')
+    parser.add_argument('--nworkers', help='Number of processes to analyse files in parallel (default 1)', default=1)
 
     args = parser.parse_args()
 
     analyse(preddir=args.preddir, pdfpath=args.p, beta_threshold=float(args.b), distance_threshold=float(args.d),
             iou_threshold=float(args.i), matching_mode=args.m, analysisoutpath=args.analysisoutpath,
             nfiles=int(args.nfiles), local_distance_scaling=not args.no_local_distance_scaling,
-            is_soft=not args.no_soft, op=not args.no_op, de_e_cut=float(args.de_e_cut), angle_cut=float(args.angle_cut))
+            is_soft=not args.no_soft, op=not args.no_op, de_e_cut=float(args.de_e_cut), angle_cut=float(args.angle_cut),
+            nworkers=int(args.nworkers))
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+'''
+Converts many NanoML root files to .djctd files in a process pool.
+
+Each input file is converted with the same TrainData class code path as the
+DeepJetCore conversion (readFromSourceFile + writeToFile), so the outputs are
+identical to the ones from the standard conversion. Optionally, the endcaps of
+each file are written in shards of --endcaps_per_shard endcaps.
+
+For every input file, the status, outputs, number of endcaps and hits and the
+conversion time are recorded in a json manifest in the output directory.
+Running again with the same output directory skips the files that were
+converted successfully, so failed files are retried. A list of all output
+files (usable e.g. with predict_hgcal.py) is written to converted_files.txt.
+'''
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import traceback
+
+MANIFEST_NAME = 'conversion_manifest.json'
+FILE_LIST_NAME = 'converted_files.txt'
+
+
+def output_base_name(infile):
+    return os.path.splitext(os.path.basename(infile))[0]
+
+
+def convert_file(infile, outdir, dataclass_name='TrainData_NanoML', endcaps_per_shard=-1, istraining=True):
+    '''
+    Converts one file, returns the manifest entry for it
+    '''
+    import datastructures
+
+    entry = {'input': infile, 'status': 'failed', 'outputs': [], 'n_endcaps': 0, 'n_hits': 0}
+    starttime = time.time()
+    try:
+        td = getattr(datastructures, dataclass_name)()
+        td.readFromSourceFile(infile, {}, istraining=istraining)
+        entry['conversion_time'] = time.time() - starttime
+
+        n_endcaps = td.nElements()
+        entry['n_endcaps'] = int(n_endcaps)
+        # recorded by convertFromSourceFile (None for classes that do not record it)
+        n_hits = getattr(td, 'n_hits', None)
+        entry['n_hits'] = None if n_hits is None else int(n_hits)
+
+        stopwatch = time.time()
+        outbase = os.path.join(outdir, output_base_name(infile))
+        if endcaps_per_shard <= 0:
+            td.writeToFile(outbase + '.djctd')
+            entry['outputs'].append(outbase + '.djctd')
+        else:
+            for i, start in enumerate(range(0, n_endcaps, endcaps_per_shard)):
+                shard = td.getSlice(start, min(start + endcaps_per_shard, n_endcaps))
+                shardname = outbase + '_shard%d.djctd' % i
+                shard.writeToFile(shardname)
+                entry['outputs'].append(shardname)
+                del shard
+        entry['write_time'] = time.time() - stopwatch
+        entry['status'] = 'ok'
+    except Exception as e:
+        entry['error'] = repr(e)
+        entry['traceback'] = traceback.format_exc()
+    entry['time'] = time.time() - starttime
+    return entry
+
+
+def _convert_file_star(args):
+    return convert_file(*args)
+
+
+def read_manifest(outdir):
+    manifest_file = os.path.join(outdir, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return {e['input']: e for e in json.load(f)}
+
+
+def write_manifest(outdir, manifest):
+    # write to a temporary file first so that an interrupted run does not corrupt the manifest
+    manifest_file = os.path.join(outdir, MANIFEST_NAME)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(list(manifest.values()), f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def convert(infiles, outdir, dataclass_name='TrainData_NanoML', nworkers=1, endcaps_per_shard=-1, istraining=True,
+            force=False):
+    '''
+    Converts all input files not yet successfully converted according to the manifest in outdir.
+    The manifest is updated after every file.
+
+    :return: the manifest as dict input file -> entry
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    manifest = {} if force else read_manifest(outdir)
+
+    todo = [f for f in infiles if f not in manifest or manifest[f]['status'] != 'ok']
+    print('converting', len(todo), 'of', len(infiles), 'files with', nworkers, 'workers')
+
+    args = [(f, outdir, dataclass_name, endcaps_per_shard, istraining) for f in todo]
+    starttime = time.time()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(nworkers, maxtasksperchild=1) as pool:
+        # unordered: slow files do not hold back the manifest
+        for entry in pool.imap_unordered(_convert_file_star, args):
+            manifest[entry['input']] = entry
+            write_manifest(outdir, manifest)
+            if entry['status'] == 'ok':
+                print('converted', entry['input'], 'in', round(entry['time'], 1), 's,',
+                      entry['n_endcaps'], 'endcaps,', entry['n_hits'], 'hits')
+            else:
+                print('FAILED', entry['input'], entry['error'])
+
+    ok = [manifest[f] for f in infiles if f in manifest and manifest[f]['status'] == 'ok']
+    with open(os.path.join(outdir, FILE_LIST_NAME), 'w') as f:
+        for entry in ok:
+            for o in entry['outputs']:
+                f.write(os.path.basename(o) + '\n')
+
+    print('done after', round(time.time() - starttime, 1), 's,', len(ok), 'of', len(infiles), 'files converted')
+    failed = [f for f in infiles if f not in manifest or manifest[f]['status'] != 'ok']
+    if len(failed):
+        print(len(failed), 'files failed, run again to retry them:')
+        for f in failed:
+            print(' ', f)
+    times = sorted([(e['time'], e['input']) for e in ok], reverse=True)
+    if len(times):
+        print('slowest files:')
+        for t, f in times[:5]:
+            print(' ', round(t, 1), 's', f)
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'Convert NanoML root files to djctd files in parallel')
+    parser.add_argument('infiles', help='Text file with one input root file per line')
+    parser.add_argument('outdir', help='Output directory (also holds the manifest)')
+    parser.add_argument('--dataclass', help='TrainData class (default TrainData_NanoML)', default='TrainData_NanoML')
+    parser.add_argument('--nworkers', help='Number of conversion processes (default: number of cores)',
+                        default=os.cpu_count())
+    parser.add_argument('--endcaps_per_shard', help='Write shards with this number of endcaps (default: one output per input)',
+                        default=-1)
+    parser.add_argument('--testing', help='Convert with istraining=False', action='store_true')
+    parser.add_argument('--force', help='Ignore the existing manifest and convert all files again', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.infiles) as f:
+        infiles = [l.strip() for l in f if len(l.strip())]
+    if os.path.dirname(args.infiles):
+        infiles = [f if os.path.isabs(f) else os.path.join(os.path.dirname(args.infiles), f) for f in infiles]
+
+    convert(infiles, args.outdir, dataclass_name=args.dataclass, nworkers=int(args.nworkers),
+            endcaps_per_shard=int(args.endcaps_per_shard), istraining=not args.testing, force=args.force)
@@ -12,6 +12,8 @@ parser.add_argument('output',
                     help='PDF file')
 parser.add_argument('--condition_string', default='',
                     help='Condition sql string')
+parser.add_argument('--database_file', default='',
+                    help='Read from this sqlite file instead of the mysql server (e.g. written with experiment_database_tools.download_experiment_to_file)')
 
 
 args = parser.parse_args()
@@ -24,7 +26,10 @@ if len(args.condition_string)!=0:
 
 plotter = HGCalAnalysisPlotter(['settings', 'efficiency_fo_truth', 'fake_rate_fo_pred', 'response_fo_truth',
                                 'response_fo_pred', 'response_sum_fo_truth', 'energy_resolution'])
-reading_manager = ExperimentDatabaseReadingManager(mysql_credentials=sql_credentials.credentials)
+if len(args.database_file)!=0:
+    reading_manager = ExperimentDatabaseReadingManager(file=args.database_file)
+else:
+    reading_manager = ExperimentDatabaseReadingManager(mysql_credentials=sql_credentials.credentials)
 plotter.add_data_from_database(reading_manager, table_prefix=args.table_prefix, condition=condition_string)
 # plotter.add_data_from_database(reading_manager, table_prefix='alpha_plots_a2')
 # plotter.write_to_pdf(args.output, formatter=lambda x: 'Optimized f1 score\n$\\alpha$ param=$%.2f$ \n$\\beta$ param$=%.2f$ \n$\\beta=%.4f$\n$d=%.4f$\n'%(x['beta_param'],x['alpha_param'],x['beta_threshold'],x['distance_threshold']))
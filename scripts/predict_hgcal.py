@@ -18,11 +18,15 @@ parser.add_argument("--unbuffered",
                     default=False, action="store_true")
 
 parser.add_argument("--max_files", help="Limit number of files", default=-1)
+parser.add_argument("--max_hits_per_batch",
+                    help="Pack several endcaps into one model call up to this number of hits (default: one endcap per call)",
+                    default=-1)
 
 args = parser.parse_args()
 
 
-HGCalPredictor(args.data_collection, args.data_collection, args.output_dir, inputdir=args.data_dir, unbuffered=False, max_files=int(args.max_files)).predict(model_path=args.inputModel)
+HGCalPredictor(args.data_collection, args.data_collection, args.output_dir, inputdir=args.data_dir, unbuffered=False, max_files=int(args.max_files),
+               max_hits_per_batch=int(args.max_hits_per_batch)).predict(model_path=args.inputModel)
 
 
 
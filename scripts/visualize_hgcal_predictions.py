@@ -2,12 +2,9 @@
 
 raise NotImplementedError('Needs to be revamped with the new code. To be done soon')
 import os
-import gzip
-import pickle
-
-import mgzip
 
 import matching_and_analysis
+from prediction_file import PredictionFileReader
 import argparse
 import hplots.hgcal_analysis_plotter as hp
 import sql_credentials
@@ -17,7 +14,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         'Visualize predictions from object condensation and plot relevant results')
     parser.add_argument('file',
-                        help='A .bin.gz file to visualize.')
+                        help='A .pred.h5 (or .bin.gz) file to visualize.')
     parser.add_argument('-b', help='Beta threshold (default 0.1)', default='0.1')
     parser.add_argument('-d', help='Distance threshold (default 0.5)', default='0.5')
     parser.add_argument('-i', help='IOU threshold (default 0.1)', default='0.1')
@@ -51,9 +48,8 @@ if __name__ == '__main__':
                                                          energy_gather_type=energy_gather_type
                                                          )
 
-    with gzip.open(args.file, 'rb') as f:
-        data_loaded = pickle.load(f)
-    endcap_data = data_loaded[int(args.n)]
+    with PredictionFileReader(args.file) as data_loaded:
+        endcap_data = data_loaded[int(args.n)]
     graph_analyzer = matching_and_analysis.OCRecoGraphAnalyzer(metadata)
     graph_analyzer.analyse(endcap_data[0], endcap_data[2], endcap_data[1], return_rechit_data=True)
     visualizer = matching_and_analysis.OCMatchingVisualizer(graph_analyzer.non_reduced_graph)
@@ -171,5 +171,45 @@ class DatabasePlotsTestCases(unittest.TestCase):
 
 
 
+    def test_read_write_6(self):
+        if os.path.exists('sample.db'):
+            os.unlink('sample.db')
+
+        for experiment_name in ['writing_numerical_data_test_case_6', 'writing_numerical_data_test_case_6_2']:
+            database_manager = ExperimentDatabaseManager(file='sample.db', cache_size=40)
+            database_manager.set_experiment(experiment_name)
+            inserted_data = dict()
+            inserted_data['var_1'] = np.arange(10)
+            inserted_data['var_2'] = np.arange(10) * 0.5
+            inserted_data['var_3'] = ['a', 'b'] * 5
+            database_manager.insert_experiment_data('writing_numerical_data_test_case_6', inserted_data)
+            database_manager.close()
+
+        database_manager_2 = ExperimentDatabaseReadingManager(file='sample.db')
+        read_back_data = database_manager_2.get_data('writing_numerical_data_test_case_6',
+                                                     ['writing_numerical_data_test_case_6', 'writing_numerical_data_test_case_6_2'],
+                                                     field_names=['var_1', 'var_2'],
+                                                     conditions={'var_1': ('>=', 5), 'var_3': 'a'}, as_numpy=True)
+        assert set(read_back_data.keys()) == {'var_1', 'var_2'}
+        assert np.all(np.sort(read_back_data['var_1']) == [6, 6, 8, 8])
+        assert read_back_data['var_2'].dtype == np.float64
+
+        read_back_data = database_manager_2.get_data('writing_numerical_data_test_case_6', 'writing_numerical_data_test_case_6_2',
+                                                     condition_string='var_1 < ?', params=[3])
+        assert read_back_data['var_1'] == [0, 1, 2] # Always returns list
+
+        pages = list(database_manager_2.iterate_data('writing_numerical_data_test_case_6', page_size=6))
+        assert [len(x['var_1']) for x in pages] == [6, 6, 6, 2]
+
+        data_frame = database_manager_2.get_data_frame('writing_numerical_data_test_case_6', conditions={'var_1': [1, 2]})
+        assert len(data_frame) == 4
+        assert len(database_manager_2.get_data_frame('writing_numerical_data_test_case_6', 'no_experiment')) == 0
+
+        database_manager = ExperimentDatabaseManager(file='sample.db', cache_size=40)
+        database_manager.delete_experiment('writing_numerical_data_test_case_6')
+        database_manager.delete_experiment('writing_numerical_data_test_case_6_2')
+        database_manager.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from callbacks import RunningFullValidation, summarise_showers
+
+
+# stand-in for full_validation_worker.py: writes one result per point once the release file exists
+STUB_WORKER = '''
+import json, os, sys, time
+with open(sys.argv[1]) as f:
+    job = json.load(f)
+release = os.path.join(os.path.dirname(job['pdfs_path']), 'release')
+while not os.path.exists(release):
+    time.sleep(0.01)
+if job['predictor'].get('fail'):
+    sys.exit(1)
+results = [dict(iteration=job['batch_idx'], beta_threshold=b, distance_threshold=d, efficiency=1.)
+           for b, d in job['test_on']]
+with open(job['result_file'], 'w') as f:
+    json.dump(results, f)
+'''
+
+
+class StubConfig(object):
+    def __init__(self, **config):
+        self.config = config
+
+    def get_config(self):
+        return dict(self.config)
+
+
+class StubModel(object):
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write('model')
+
+
+class StubTensorBoard(object):
+    def __init__(self):
+        self.steps = []
+
+    def step(self, iteration, values):
+        self.steps.append((iteration, values))
+
+
+class SummariseShowersTestCases(unittest.TestCase):
+
+    def test_summary(self):
+        nan = np.nan
+        df = pd.DataFrame({
+            'truthHitAssignementIdx': [0., 1., 2., nan, nan],
+            'pred_sid': [0., 1., nan, 2., 3.],
+            'truthHitAssignedEnergies': [10., 20., 5., nan, nan],
+            'pred_energy': [12., 18., nan, 1., 2.],
+        })
+        summary = summarise_showers(df)
+        self.assertAlmostEqual(summary['efficiency'], 2. / 3.)
+        self.assertAlmostEqual(summary['fake_rate'], 2. / 4.)
+        self.assertAlmostEqual(summary['response_mean'], (1.2 + 0.9) / 2.)
+        self.assertEqual(summary['num_truth_showers'], 3)
+        self.assertEqual(summary['num_pred_showers'], 4)
+
+    def test_empty(self):
+        summary = summarise_showers(pd.DataFrame())
+        self.assertEqual(summary['efficiency'], 0.)
+        self.assertEqual(summary['num_pred_showers'], 0)
+
+
+class BackgroundValidationTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pdfs_path = os.path.join(self.tmpdir, 'plots')
+        os.makedirs(self.pdfs_path)
+        self.worker = os.path.join(self.tmpdir, 'stub_worker.py')
+        with open(self.worker, 'w') as f:
+            f.write(STUB_WORKER)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_callback(self, policy, **predictor_config):
+        self.tensorboard = StubTensorBoard()
+        cb = RunningFullValidation(after_n_batches=2,
+                                   predictor=StubConfig(input_source_files_list='val.djcdc', **predictor_config),
+                                   hits2showers=StubConfig(is_soft=True),
+                                   showers_matcher=StubConfig(match_mode='iou_max'),
+                                   test_on_points=[(0.1, 0.5), (0.3, 1.0)],
+                                   pdfs_path=self.pdfs_path,
+                                   trial_batch=-1,
+                                   run_in_background=True,
+                                   background_policy=policy,
+                                   tensorboard_manager=self.tensorboard)
+        cb.worker_script = self.worker
+        cb.set_model(StubModel())
+        return cb
+
+    def run_batches(self, cb, n):
+        for i in range(n):
+            cb._on_train_batch_end(i)
+
+    def release_and_finish(self, cb):
+        open(os.path.join(self.tmpdir, 'release'), 'w').close()
+        cb.on_train_end()
+
+    def test_job_file(self):
+        cb = self.make_callback('skip')
+        self.run_batches(cb, 3) # starts the job after batch 2
+        with open(os.path.join(cb.background_job['job_dir'], 'job.json')) as f:
+            job = json.load(f)
+        self.assertEqual(job['predictor'], {'input_source_files_list': 'val.djcdc'})
+        self.assertEqual(job['hits2showers'], {'is_soft': True})
+        self.assertEqual(job['showers_matcher'], {'match_mode': 'iou_max'})
+        self.assertEqual(job['test_on'], [[0.1, 0.5], [0.3, 1.0]])
+        self.assertTrue(os.path.exists(job['model_path']))
+        self.release_and_finish(cb)
+
+    def test_skip(self):
+        cb = self.make_callback('skip')
+        self.run_batches(cb, 5) # the first job is still running when the next one is due
+        first_job = cb.background_job
+        self.assertEqual(os.path.basename(first_job['job_dir']), 'background_job_0000003')
+        self.assertFalse(os.path.exists(os.path.join(self.pdfs_path, 'background_job_0000005')))
+        self.release_and_finish(cb)
+        self.assertIsNone(cb.background_job)
+        self.assertEqual([s[0] for s in self.tensorboard.steps], [3, 3])
+        self.assertEqual(self.tensorboard.steps[0][1]['full_validation_b0.10_d0.50/efficiency'], 1.)
+        self.assertFalse(os.path.exists(first_job['job_dir']))
+
+    def test_replace(self):
+        cb = self.make_callback('replace')
+        self.run_batches(cb, 3)
+        first_job = cb.background_job
+        self.run_batches(cb, 2) # the next one replaces the first job
+        self.assertIsNot(cb.background_job, first_job)
+        self.assertIsNotNone(first_job['process'].poll())
+        self.assertFalse(os.path.exists(first_job['job_dir']))
+        self.release_and_finish(cb)
+        self.assertEqual([s[0] for s in self.tensorboard.steps], [5, 5])
+
+    def test_polling(self):
+        cb = self.make_callback('skip')
+        self.run_batches(cb, 3)
+        job = cb.background_job
+        open(os.path.join(self.tmpdir, 'release'), 'w').close()
+        job['process'].wait()
+        self.assertEqual(len(self.tensorboard.steps), 0)
+        cb._on_train_batch_end(3) # reported at the next batch end
+        self.assertIsNone(cb.background_job)
+        self.assertEqual(len(self.tensorboard.steps), 2)
+
+    def test_failed_job(self):
+        cb = self.make_callback('skip', fail=True)
+        self.run_batches(cb, 3)
+        job = cb.background_job
+        self.release_and_finish(cb)
+        self.assertIsNone(cb.background_job)
+        self.assertEqual(len(self.tensorboard.steps), 0)
+        self.assertTrue(os.path.exists(os.path.join(job['job_dir'], 'log.txt'))) # kept for debugging
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+
+from hgcal_predictor import split_by_row_splits
+
+
+def make_endcaps(n_endcaps=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.random((int(rng.integers(10, 40)), 3)).astype('float32') for _ in range(n_endcaps)]
+
+
+def model(features, row_splits):
+    # per-hit outputs, the row splits and a scalar, as in the dict output of the models
+    return {
+        'pred_beta': features[:, 0:1] * 2.,
+        'pred_ccoords': features[:, 1:3] - 1.,
+        'row_splits': np.array(row_splits, dtype='int32'),
+        'n_iter': np.array(3),
+    }
+
+
+def row_splits_of(endcaps):
+    return np.cumsum([0] + [len(e) for e in endcaps])
+
+
+class SplitByRowSplitsTestCases(unittest.TestCase):
+
+    def test_batched_same_as_single(self):
+        endcaps = make_endcaps()
+        single = [model(e, [0, len(e)]) for e in endcaps]
+        rs = row_splits_of(endcaps)
+        batched = split_by_row_splits(model(np.concatenate(endcaps), rs), rs)
+        self.assertEqual(len(batched), len(endcaps))
+        for s, b in zip(single, batched):
+            self.assertEqual(sorted(s.keys()), sorted(b.keys()))
+            for k in s.keys():
+                self.assertTrue(np.array_equal(s[k], b[k]), k)
+                self.assertEqual(s[k].dtype, b[k].dtype)
+
+    def test_own_row_splits(self):
+        # outputs after a hit selection: the prediction row splits differ from the input row splits
+        endcaps = make_endcaps()
+        rs = row_splits_of(endcaps)
+        selected = [e[e[:, 0] > 0.3] for e in endcaps]
+        sel_rs = row_splits_of(selected)
+        pred = model(np.concatenate(selected), sel_rs)
+        pred['orig_row_splits'] = rs
+        pred['orig_energy'] = np.concatenate(endcaps)[:, 0]
+        out = split_by_row_splits(pred, rs)
+        for e, s, o in zip(endcaps, selected, out):
+            self.assertTrue(np.array_equal(o['pred_beta'], s[:, 0:1] * 2.))
+            self.assertTrue(np.array_equal(o['orig_energy'], e[:, 0]))
+            self.assertTrue(np.array_equal(o['row_splits'], [0, len(s)]))
+            self.assertTrue(np.array_equal(o['orig_row_splits'], [0, len(e)]))
+
+    def test_mismatch_raises(self):
+        endcaps = make_endcaps()
+        rs = row_splits_of(endcaps)
+        pred = model(np.concatenate(endcaps), rs)
+        pred['per_object'] = np.zeros((7, 4))
+        with self.assertRaises(ValueError):
+            split_by_row_splits(pred, rs)
+        out = split_by_row_splits(pred, rs, metadata_keys=('per_object',))
+        for o in out:
+            self.assertEqual(o['per_object'].shape, (7, 4))
+
+    def test_wrong_number_of_events(self):
+        endcaps = make_endcaps()
+        rs = row_splits_of(endcaps)
+        pred = model(np.concatenate(endcaps), rs[:-1])
+        with self.assertRaises(ValueError):
+            split_by_row_splits(pred, rs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from hplots.binning import Binning, grouped_quantiles
+
+
+class HplotsBinningTestCases(unittest.TestCase):
+    '''
+    Compares the vectorised binned statistics with per bin masks.
+    '''
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.bins = np.array([0, 1., 2, 5, 10, 20, 50, 100])
+        self.x = rng.uniform(-5., 105., 5000)
+        self.x[:100] = rng.choice(self.bins, 100)
+        self.y = rng.uniform(0.5, 1.5, 5000)
+        self.w = rng.uniform(0.1, 2., 5000)
+
+    def _masks(self, open_lower_edge=False):
+        for l, h in zip(self.bins[:-1], self.bins[1:]):
+            low = self.x > l if open_lower_edge else self.x >= l
+            yield np.logical_and(low, self.x < h)
+
+    def test_histogram_and_means(self):
+        binning = Binning(self.x, self.bins)
+        self.assertTrue(np.all(binning.histogram() == np.histogram(self.x, self.bins)[0]))
+        mean = [np.mean(self.y[m]) for m in self._masks()]
+        weighted_mean = [np.average(self.y[m], weights=self.w[m]) for m in self._masks()]
+        self.assertTrue(np.allclose(binning.mean(self.y), mean))
+        self.assertTrue(np.allclose(binning.weighted_mean(self.y, self.w), weighted_mean))
+
+    def test_open_lower_edge(self):
+        binning = Binning(self.x, self.bins).with_open_lower_edge()
+        std = [np.std(self.y[m]) / np.mean(self.y[m]) for m in self._masks(open_lower_edge=True)]
+        self.assertTrue(np.all(binning.count == [np.sum(m) for m in self._masks(open_lower_edge=True)]))
+        self.assertTrue(np.allclose(binning.relative_std(self.y), std))
+
+    def test_quantiles(self):
+        binning = Binning(self.x, self.bins)
+        q = np.array([0.16, 0.5, 0.84])
+        expected = np.stack([np.quantile(self.y[m], q) for m in self._masks()], axis=-1)
+        self.assertTrue(np.allclose(binning.quantiles(self.y, q), expected))
+
+        values = grouped_quantiles(np.array([0, 0, 2]), np.array([1., 3., 5.]), [0.5], 4, empty_value=0.)
+        self.assertTrue(np.all(values == [[2., 0., 5., 0.]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as np
+
+from OCHits2Showers import OCHits2Showers, reconstruct_showers_kdtree, reconstruct_showers_no_op
+
+
+def make_endcap(n_hits, n_showers, seed=0):
+    '''
+    Synthetic clustering space: gaussian blobs with a high beta hit at each centre and noise hits.
+    '''
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(-5., 5., (n_showers, 3))
+    shower = rng.integers(0, n_showers, n_hits)
+    cc = (centres[shower] + rng.normal(0., 0.3, (n_hits, 3))).astype(np.float32)
+    noise = rng.random(n_hits) < 0.2
+    cc[noise] = rng.uniform(-5., 5., (np.sum(noise), 3))
+    beta = (rng.random(n_hits) * 0.5).astype(np.float32)
+    beta[:n_showers] = rng.uniform(0.5, 1., n_showers)
+    cc[:n_showers] = centres
+    pred_dist = rng.uniform(0.5, 2., n_hits).astype(np.float32)
+    return cc, beta[:, np.newaxis], pred_dist[:, np.newaxis]
+
+
+def make_event(cc, beta, pred_dist, seed=0):
+    rng = np.random.default_rng(seed)
+    n_hits = len(cc)
+    features_dict = {'recHitEnergy': rng.uniform(0.1, 2., (n_hits, 1))}
+    pred_dict = {
+        'pred_ccoords': cc,
+        'pred_beta': beta,
+        'pred_dist': pred_dist,
+        'pred_energy_corr_factor': rng.uniform(0.8, 1.2, (n_hits, 1)),
+        'pred_energy_high_quantile': np.ones((n_hits, 1)),
+        'pred_energy_low_quantile': np.zeros((n_hits, 1)),
+        'pred_id': rng.random((n_hits, 4)),
+    }
+    return features_dict, pred_dict
+
+
+class ReconstructShowersKDTreeTestCases(unittest.TestCase):
+    def test_same_as_no_op(self):
+        cc, beta, pred_dist = make_endcap(2000, 30)
+        for with_pred_dist in [False, True]:
+            for max_hits_per_shower in [-1, 20]:
+                for b, d in [(0.1, 0.5), (0.3, 1.0), (0.6, 0.3)]:
+                    args = dict(beta_threshold=b, dist_threshold=d,
+                                pred_dist=pred_dist if with_pred_dist else None,
+                                max_hits_per_shower=max_hits_per_shower)
+                    pred_sid, alpha_idx = reconstruct_showers_kdtree(cc, beta, **args)
+                    ref_pred_sid, ref_alpha_idx = reconstruct_showers_no_op(cc, beta, **args)
+                    msg = str(args)
+                    self.assertEqual([int(a) for a in alpha_idx], [int(a) for a in ref_alpha_idx], msg)
+                    self.assertTrue(np.array_equal(pred_sid, ref_pred_sid), msg)
+
+
+class ProcessShowersTestCases(unittest.TestCase):
+    def reference_energy(self, features_dict, pred_dict, pred_sid, n_showers):
+        energy = np.zeros(len(pred_sid))
+        for i in range(n_showers):
+            in_shower = pred_sid[:, 0] == i
+            energy[in_shower] = np.sum(pred_dict['pred_energy_corr_factor'][in_shower]
+                                       * features_dict['recHitEnergy'][in_shower])
+        return energy
+
+    def test_shower_energy(self):
+        cc, beta, pred_dist = make_endcap(2000, 30)
+        features_dict, pred_dict = make_event(cc, beta, pred_dist)
+        hits2showers = OCHits2Showers(0.3, 0.5, is_soft=False, with_local_distance_scaling=True, op=False)
+        processed, alpha_idx = hits2showers.call(features_dict, pred_dict)
+        pred_sid = processed['pred_sid']
+        self.assertTrue(np.any(pred_sid[:, 0] == -1))
+        reference = self.reference_energy(features_dict, pred_dict, pred_sid, len(alpha_idx))
+        self.assertTrue(np.allclose(processed['pred_energy'][:, 0], reference))
+
+    def test_condensation_point_outside_shower(self):
+        # with a zero distance threshold no hit is within the radius, not even the condensation point itself
+        cc, beta, pred_dist = make_endcap(500, 10)
+        features_dict, pred_dict = make_event(cc, beta, np.zeros_like(pred_dist))
+        for distance_threshold, with_local_distance_scaling in [(0.5, True), (0., False)]:
+            hits2showers = OCHits2Showers(0.3, distance_threshold, is_soft=False,
+                                          with_local_distance_scaling=with_local_distance_scaling, op=False)
+            processed, alpha_idx = hits2showers.call(features_dict, pred_dict)
+            self.assertGreater(len(alpha_idx), 0)
+            self.assertTrue(np.all(processed['pred_sid'] == -1))
+            self.assertTrue(np.all(processed['pred_energy'] == 0.))
+
+    def test_some_condensation_points_outside_shower(self):
+        cc, beta, pred_dist = make_endcap(2000, 30)
+        # the five condensation points with the highest beta have no hits, they end up in other showers
+        pred_dist[np.argsort(-beta[:, 0])[:5]] = 0.
+        features_dict, pred_dict = make_event(cc, beta, pred_dist)
+        hits2showers = OCHits2Showers(0.3, 0.5, is_soft=False, with_local_distance_scaling=True, op=False)
+        processed, alpha_idx = hits2showers.call(features_dict, pred_dict)
+        pred_sid = processed['pred_sid']
+        self.assertEqual(np.sum(pred_sid[alpha_idx, 0] != np.arange(len(alpha_idx))), 5)
+        reference = self.reference_energy(features_dict, pred_dict, pred_sid, len(alpha_idx))
+        self.assertTrue(np.allclose(processed['pred_energy'][:, 0], reference))
+
+
+if __name__ == '__main__':
+    unittest.main()
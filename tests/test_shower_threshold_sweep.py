@@ -0,0 +1,67 @@
+import time
+import unittest
+
+import numpy as np
+
+from OCHits2Showers import ShowerThresholdSweep, reconstruct_showers_kdtree
+
+
+def make_endcap(n_hits, n_showers, seed=0):
+    '''
+    Synthetic clustering space: gaussian blobs with a high beta hit close to each centre and noise hits.
+    '''
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(-10., 10., (n_showers, 3))
+    shower = rng.integers(0, n_showers, n_hits)
+    cc = (centres[shower] + rng.normal(0., 0.3, (n_hits, 3))).astype(np.float32)
+    noise = rng.random(n_hits) < 0.2
+    cc[noise] = rng.uniform(-10., 10., (np.sum(noise), 3))
+    beta = (rng.random(n_hits) * 0.5).astype(np.float32)
+    beta[:n_showers] = rng.uniform(0.5, 1., n_showers)
+    cc[:n_showers] = centres
+    beta[10:20] = beta[20:30] # some equal betas
+    pred_dist = rng.uniform(0.5, 2., n_hits).astype(np.float32)
+    return cc, beta[:, np.newaxis], pred_dist[:, np.newaxis]
+
+
+THRESHOLDS = [(0.1, 0.2), (0.1, 0.5), (0.1, 0.8), (0.3, 0.2), (0.3, 0.5), (0.3, 0.8), (0.6, 0.5), (0.1, 0.5)]
+
+
+class ShowerThresholdSweepTestCases(unittest.TestCase):
+    def test_same_as_kdtree(self):
+        for pred_dist_scaling in [False, True]:
+            cc, beta, pred_dist = make_endcap(20000, 200)
+            pred_dist = pred_dist if pred_dist_scaling else None
+
+            t0 = time.time()
+            reference = [reconstruct_showers_kdtree(cc, beta, b, d, pred_dist=pred_dist) for b, d in THRESHOLDS]
+            t_reference = time.time() - t0
+
+            t0 = time.time()
+            results = ShowerThresholdSweep(cc, beta, pred_dist=pred_dist).sweep(THRESHOLDS)
+            t_sweep = time.time() - t0
+            print('kdtree per point: %.3f s, sweep: %.3f s' % (t_reference, t_sweep))
+
+            for (b, d), (pred_sid, alpha_idx), (ref_pred_sid, ref_alpha_idx) in zip(THRESHOLDS, results, reference):
+                self.assertEqual(alpha_idx, ref_alpha_idx, 'alpha indices differ for %f, %f' % (b, d))
+                self.assertTrue(np.all(pred_sid == ref_pred_sid), 'pred sid differs for %f, %f' % (b, d))
+
+    def test_assign_to_closest(self):
+        cc, beta, pred_dist = make_endcap(5000, 50, seed=1)
+        sweep = ShowerThresholdSweep(cc, beta, pred_dist=pred_dist, assign_to_closest=True)
+        for b, d in THRESHOLDS:
+            pred_sid, alpha_idx = sweep.cluster(b, d)
+            _, ref_alpha_idx = reconstruct_showers_kdtree(cc, beta, b, d, pred_dist=pred_dist)
+            self.assertEqual(alpha_idx, sorted(ref_alpha_idx))
+
+            # brute force: closest condensation point in scaled distance, within the threshold
+            alpha_idx = np.array(alpha_idx)
+            scaled = np.sqrt(np.sum((cc[:, np.newaxis] - cc[np.newaxis, alpha_idx]) ** 2, axis=-1)) \
+                     / pred_dist[alpha_idx, 0][np.newaxis, :]
+            closest = np.argmin(scaled, axis=1)
+            ref_pred_sid = np.where(scaled[np.arange(len(cc)), closest] < d, closest, -1)
+            self.assertTrue(np.all(pred_sid[:, 0] == ref_pred_sid))
+
+
+if __name__ == '__main__':
+    unittest.main()
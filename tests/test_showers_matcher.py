@@ -0,0 +1,209 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ShowersMatcher import ShowersMatcher, calculate_iou_sparse, angle
+
+
+def make_event(n_hits=3000, n_truth=40, n_pred=50, seed=0):
+    '''
+    Synthetic event: predicted showers mostly follow the truth showers, some hits are noise (-1)
+    in truth or prediction. Shower attributes are the same for all hits of a shower.
+    '''
+    rng = np.random.default_rng(seed)
+    truth_sid = rng.integers(0, n_truth, n_hits)
+    pred_sid = truth_sid * n_pred // n_truth
+    scramble = rng.random(n_hits) < 0.2
+    pred_sid[scramble] = rng.integers(0, n_pred, np.sum(scramble))
+    truth_sid[rng.random(n_hits) < 0.1] = -1
+    pred_sid[rng.random(n_hits) < 0.1] = -1
+    pred_sid[:n_pred] = np.arange(n_pred) # every predicted shower has a hit, used as alpha index
+    pred_alpha_idx = list(range(n_pred))
+
+    def per_shower(sid, n_showers, low=1., high=50.):
+        values = rng.uniform(low, high, n_showers + 1)
+        return values[sid][:, np.newaxis] # -1 (noise) takes the last value
+
+    features_dict = {'recHitEnergy': rng.exponential(1., (n_hits, 1))}
+    truth_dict = {
+        'truthHitAssignementIdx': truth_sid[:, np.newaxis].astype(np.float32),
+        'truthHitAssignedEnergies': per_shower(truth_sid, n_truth),
+        'energy': per_shower(truth_sid, n_truth),
+        'x': per_shower(truth_sid, n_truth, -1., 1.),
+        'y': per_shower(truth_sid, n_truth, -1., 1.),
+        'z': per_shower(truth_sid, n_truth, 1., 2.),
+    }
+    predictions_dict = {
+        'pred_sid': pred_sid[:, np.newaxis],
+        'pred_energy': per_shower(pred_sid, n_pred),
+        'energy': per_shower(pred_sid, n_pred),
+        'dep_energy': per_shower(pred_sid, n_pred),
+        'dep_x': per_shower(pred_sid, n_pred, -1., 1.),
+        'dep_y': per_shower(pred_sid, n_pred, -1., 1.),
+        'dep_z': per_shower(pred_sid, n_pred, 1., 2.),
+        'row_splits': np.array([[0], [n_hits]]),
+    }
+    return features_dict, truth_dict, predictions_dict, pred_alpha_idx
+
+
+def make_matcher(match_mode, de_e_cut, **kwargs):
+    matcher = ShowersMatcher(match_mode, iou_threshold=0.1, de_e_cut=de_e_cut, angle_cut=0.5)
+    matcher.set_inputs(*make_event(**kwargs))
+    matcher._build_data_tables()
+    return matcher
+
+
+def pred_shower(matcher, i):
+    return {k: v[i] for k, v in matcher.pred_table.items()}
+
+
+def truth_shower(matcher, j):
+    return {k: v[j] for k, v in matcher.truth_table.items()}
+
+
+def allow_fn(de_e_cut, pred_shower_energy, truth_shower_energy):
+    if de_e_cut == -1:
+        return lambda i, j: True
+    return lambda i, j: (np.abs(pred_shower_energy[i] - truth_shower_energy[j]) / truth_shower_energy[j]) < de_e_cut
+
+
+def loop_cost_matrix_intersection_based(matcher):
+    '''
+    The per-pair loop of the previous implementation, on the shower tables instead of the graph nodes
+    '''
+    truth_shower_sid, pred_shower_sid = matcher.truth_shower_sid, matcher.pred_shower_sid
+    pred_shower_energy = [pred_shower(matcher, i)['pred_energy'] for i in range(len(pred_shower_sid))]
+    truth_shower_energy = [truth_shower(matcher, j)['truthHitAssignedEnergies'] for j in range(len(truth_shower_sid))]
+    iou_matrix = calculate_iou_sparse(matcher.truth_dict['truthHitAssignementIdx'][:, 0],
+                                      matcher.pred_sid[:, 0],
+                                      truth_shower_sid,
+                                      pred_shower_sid,
+                                      matcher.features_dict['recHitEnergy'][:, 0])
+    allow = allow_fn(matcher.de_e_cut, pred_shower_energy, truth_shower_energy)
+
+    n = max(len(truth_shower_sid), len(pred_shower_sid))
+    C = np.zeros((n, n))
+    for i in range(len(pred_shower_sid)):
+        for j in range(len(truth_shower_sid)):
+            overlap = iou_matrix[i, j]
+            if overlap >= matcher.iou_threshold and allow(i, j):
+                if matcher.match_mode == 'iou_max':
+                    C[i, j] = overlap
+                else:
+                    C[i, j] = min(truth_shower(matcher, j)['energy'], pred_shower(matcher, i)['energy'])
+    return C
+
+
+def loop_cost_matrix_angle_based(matcher):
+    # the previous loop passed the graph nodes to allow instead of the indices, which failed with an energy cut
+    truth_shower_sid, pred_shower_sid = matcher.truth_shower_sid, matcher.pred_shower_sid
+    pred_shower_energy = [pred_shower(matcher, i)['dep_energy'] for i in range(len(pred_shower_sid))]
+    truth_shower_energy = [truth_shower(matcher, j)['energy'] for j in range(len(truth_shower_sid))]
+    allow = allow_fn(matcher.de_e_cut, pred_shower_energy, truth_shower_energy)
+
+    n = max(len(truth_shower_sid), len(pred_shower_sid))
+    C = np.zeros((n, n))
+    for a in range(len(pred_shower_sid)):
+        x = pred_shower(matcher, a)
+        for b in range(len(truth_shower_sid)):
+            y = truth_shower(matcher, b)
+            if angle(x, y) < matcher.angle_cut and allow(a, b):
+                C[a, b] = min(x['energy'], y['energy'])
+    return C
+
+
+class ShowersMatcherCostMatrixTestCases(unittest.TestCase):
+    def test_intersection_based(self):
+        for match_mode in ['iou_max', 'emax_iou']:
+            for de_e_cut in [-1, 0.5]:
+                matcher = make_matcher(match_mode, de_e_cut)
+                C = matcher._cost_matrix_intersection_based(matcher.truth_shower_sid, matcher.pred_shower_sid)
+                reference = loop_cost_matrix_intersection_based(matcher)
+                self.assertTrue(np.any(reference > 0))
+                self.assertTrue(np.array_equal(C, reference), (match_mode, de_e_cut))
+
+    def test_angle_based(self):
+        for de_e_cut in [-1, 0.5]:
+            matcher = make_matcher('emax_angle', de_e_cut)
+            C = matcher._cost_matrix_angle_based(matcher.truth_shower_sid, matcher.pred_shower_sid)
+            reference = loop_cost_matrix_angle_based(matcher)
+            self.assertTrue(np.any(reference > 0))
+            self.assertTrue(np.array_equal(C, reference), de_e_cut)
+
+    def test_more_truth_showers(self):
+        # the cost matrix is square, padded with zeros for the missing predicted showers
+        matcher = make_matcher('iou_max', 0.5, n_truth=60, n_pred=20)
+        C = matcher._cost_matrix_intersection_based(matcher.truth_shower_sid, matcher.pred_shower_sid)
+        self.assertEqual(C.shape, (60, 60))
+        self.assertTrue(np.array_equal(C, loop_cost_matrix_intersection_based(matcher)))
+
+
+def dataframe_from_graph(graph):
+    '''
+    The previous get_result_as_dataframe, which built the rows from the graph: one row per node in
+    the order of the graph, merged with the matched node. Does not change the graph.
+    '''
+    skip_keys = {'type'}
+    keys_ = [k for n, attr in graph.nodes(data=True) for k in attr.keys() if k not in skip_keys]
+    result_data = {k: [] for k in keys_}
+
+    done = set()
+    for n, attr in graph.nodes(data=True):
+        if n in done:
+            continue
+        done.add(n)
+        attr = dict(attr)
+
+        N = list(graph.neighbors(n))
+        assert len(N) == 0 or len(N) == 1
+        if len(N) == 1:
+            attr.update(graph.nodes[N[0]])
+            done.add(N[0])
+
+        for k in result_data.keys():
+            result_data[k].append(attr.get(k, np.nan))
+
+    return pd.DataFrame(result_data)
+
+
+class ShowersMatcherDataFrameTestCases(unittest.TestCase):
+    def check_same_as_graph(self, matcher):
+        frame = matcher.get_result_as_dataframe()
+        reference = dataframe_from_graph(matcher.get_result_as_graph())
+        self.assertEqual(list(frame.columns), list(reference.columns))
+        self.assertEqual(len(frame), len(reference))
+        for k in reference.columns:
+            values = frame[k].to_numpy(dtype=np.float64)
+            ref_values = reference[k].to_numpy(dtype=np.float64)
+            self.assertTrue(np.array_equal(np.isnan(values), np.isnan(ref_values)), k)
+            self.assertTrue(np.array_equal(values, ref_values, equal_nan=True), k)
+
+    def test_same_as_graph(self):
+        for n_truth, n_pred in [(40, 50), (60, 20), (40, 40)]:
+            matcher = ShowersMatcher('iou_max', iou_threshold=0.1, de_e_cut=0.5, angle_cut=0.5)
+            matcher.set_inputs(*make_event(n_truth=n_truth, n_pred=n_pred))
+            matcher.process()
+            # unmatched showers on both sides, or the test does not check the NaN placement
+            self.assertTrue(np.any(matcher.truth_matched_pred_idx == -1))
+            self.assertTrue(np.any(matcher.pred_matched_truth_idx == -1))
+            self.assertTrue(np.any(matcher.truth_matched_pred_idx >= 0))
+            self.check_same_as_graph(matcher)
+
+    def test_all_matched(self):
+        # predicted showers identical to the truth showers
+        features_dict, truth_dict, predictions_dict, _ = make_event(n_truth=30, n_pred=30)
+        truth_sid = truth_dict['truthHitAssignementIdx'][:, 0].astype(np.int64)
+        predictions_dict['pred_sid'] = truth_sid[:, np.newaxis]
+        predictions_dict['pred_energy'] = truth_dict['truthHitAssignedEnergies']
+        pred_alpha_idx = [int(np.argmax(truth_sid == i)) for i in range(30)]
+        matcher = ShowersMatcher('iou_max', iou_threshold=0.1, de_e_cut=0.5, angle_cut=0.5)
+        matcher.set_inputs(features_dict, truth_dict, predictions_dict, pred_alpha_idx)
+        matcher.process()
+        self.assertTrue(np.all(matcher.truth_matched_pred_idx >= 0))
+        self.check_same_as_graph(matcher)
+        self.assertFalse(matcher.get_result_as_dataframe().isnull().values.any())
+
+
+if __name__ == '__main__':
+    unittest.main()
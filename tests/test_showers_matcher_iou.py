@@ -0,0 +1,60 @@
+import time
+import unittest
+
+import numpy as np
+
+from ShowersMatcher import calculate_iou_tf, calculate_iou_sparse
+
+
+def make_event(n_hits, n_truth, n_pred, seed=0):
+    '''
+    Synthetic event: hits are assigned to truth showers and to predicted showers that
+    mostly follow the truth assignment. Some hits are noise (-1) in truth or prediction.
+    '''
+    rng = np.random.default_rng(seed)
+    truth_sid = rng.integers(0, n_truth, n_hits)
+    pred_sid = truth_sid * n_pred // n_truth + 2000
+    scramble = rng.random(n_hits) < 0.2
+    pred_sid[scramble] = rng.integers(0, n_pred, np.sum(scramble)) + 2000
+    truth_sid[rng.random(n_hits) < 0.1] = -1
+    pred_sid[rng.random(n_hits) < 0.1] = -1
+    hit_weight = rng.exponential(1., n_hits).astype(np.float32)
+
+    truth_shower_sid = np.unique(truth_sid[truth_sid != -1])
+    pred_shower_sid = np.unique(pred_sid[pred_sid != -1])
+    return truth_sid, pred_sid, truth_shower_sid, pred_shower_sid, hit_weight
+
+
+class ShowersMatcherIoUTestCases(unittest.TestCase):
+    def test_sparse_iou_same_as_tf(self):
+        event = make_event(20000, 300, 350)
+        dense = calculate_iou_tf(*event, return_all=True)
+        sparse = calculate_iou_sparse(*event, return_all=True)
+        for d, s in zip(dense, sparse):
+            d = np.array(d)
+            self.assertEqual(d.shape, s.shape)
+            self.assertTrue(np.allclose(d, s, rtol=1e-4, atol=1e-3, equal_nan=True))
+
+
+def benchmark(n_hits=100000, n_truth=1000, n_pred=1000):
+    '''
+    Roughly the size of one endcap of a 200 PU event
+    '''
+    event = make_event(n_hits, n_truth, n_pred)
+
+    t0 = time.time()
+    calculate_iou_sparse(*event)
+    t_sparse = time.time() - t0
+
+    t0 = time.time()
+    calculate_iou_tf(*event)
+    t_dense = time.time() - t0
+
+    print('hits', n_hits, 'truth showers', n_truth, 'pred showers', n_pred)
+    print('calculate_iou_tf     took', t_dense, 's')
+    print('calculate_iou_sparse took', t_sparse, 's')
+
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Binary protocol for the named pipes of the triton forward client (-p binary).
+
+One message is a list of arrays. All numbers are little endian:
+
+    int64  number of arrays
+    per array:
+        int64  dtype code (see DTYPE_CODES)
+        int64  number of dimensions
+        int64  size of each dimension
+        raw array data, C order
+
+The forward client expects one message with the float32 hit features [N, 9] per event
+(optionally followed by the int64 row splits in the input_2 format
+of the model) and answers with one message containing
+the float32 condensates [M, F]: one row per condensate (M condensates found in the N hits,
+see LayersRagged.Condensate) with the F model output features of the condensate hit.
+A writer can keep the pipe open and send several messages, or open and close it per message.
+'''
+
+import numpy as np
+
+DTYPE_CODES = {
+    0: np.dtype('<f4'),
+    1: np.dtype('<i8'),
+    2: np.dtype('<i4'),
+    3: np.dtype('<f8'),
+}
+_CODE_FOR_DTYPE = {v: k for k, v in DTYPE_CODES.items()}
+
+
+def _read_exactly(f, buffer):
+    '''
+    fills the writable buffer from f, returns False if f ended before anything was read
+    '''
+    view = memoryview(buffer).cast('B')
+    n_read = 0
+    while n_read < len(view):
+        n = f.readinto(view[n_read:])
+        if not n:
+            if n_read == 0:
+                return False
+            raise EOFError('pipe closed in the middle of a message')
+        n_read += n
+    return True
+
+
+def _read_int64(f, n=1):
+    values = np.empty(n, dtype='<i8')
+    if n and not _read_exactly(f, values):
+        return None
+    return values
+
+
+def _read_in_message(f, buffer):
+    # inside a message, f ending before the buffer is filled is always an error
+    if not _read_exactly(f, buffer):
+        raise EOFError('pipe closed in the middle of a message')
+
+
+def read_message(f):
+    '''
+    :param f: binary file object (e.g. open(fifo, 'rb'))
+    :return: list of numpy arrays, or None if f ended before the next message
+    '''
+    n_arrays = _read_int64(f)
+    if n_arrays is None:
+        return None
+    arrays = []
+    for _ in range(int(n_arrays[0])):
+        header = np.empty(2, dtype='<i8')
+        _read_in_message(f, header)
+        code, ndim = header
+        shape = np.empty(int(ndim), dtype='<i8')
+        if len(shape):
+            _read_in_message(f, shape)
+        shape = tuple(int(s) for s in shape)
+        if int(code) not in DTYPE_CODES:
+            raise ValueError('unknown dtype code ' + str(code))
+        array = np.empty(shape, dtype=DTYPE_CODES[int(code)])
+        if array.size:
+            _read_in_message(f, array)
+        arrays.append(array)
+    return arrays
+
+
+def write_message(f, arrays):
+    '''
+    :param f: binary file object (e.g. open(fifo, 'wb'))
+    :param arrays: list of numpy arrays with one of the dtypes in DTYPE_CODES
+    '''
+    f.write(np.array([len(arrays)], dtype='<i8').tobytes())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        dtype = array.dtype.newbyteorder('<')
+        if dtype not in _CODE_FOR_DTYPE:
+            raise ValueError('unsupported dtype ' + str(array.dtype))
+        array = array.astype(dtype, copy=False)
+        f.write(np.array([_CODE_FOR_DTYPE[dtype], array.ndim] + list(array.shape), dtype='<i8').tobytes())
+        if array.size:
+            f.write(memoryview(array).cast('B'))
+    f.flush()
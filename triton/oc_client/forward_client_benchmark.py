@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+Sends events with random hits through the pipes of a running triton forward client and
+measures the round trip time per event, e.g. to compare the text and binary protocols.
+With the binary protocol, up to --in_flight events are sent before the predictions are read,
+to test the client with --max_in_flight and --merge_max_hits.
+Without a triton deployment, start the client with --local_model:
+
+    python triton_forward_client.py -m hgcal_oc_reco -f /dev/shm/oc_bench -p binary \\
+        --local_model ../oc_models/hgcal_oc_reco/1/model.savedmodel &
+    python forward_client_benchmark.py -f /dev/shm/oc_bench -p binary -n 100000
+'''
+
+import argparse
+import os
+import threading
+import time
+import numpy as np
+
+from fifo_protocol import read_message, write_message
+
+
+def send_event_text(fifo_name, hit_data):
+    with open(fifo_name, 'w') as fifo:
+        np.savetxt(fifo, hit_data)
+    with open(fifo_name + '_pred') as fifo:
+        return np.loadtxt(fifo, skiprows=1, dtype='float32')
+
+
+def send_events_binary(fifo_name, events, in_flight):
+    '''
+    sends the events from a separate thread with at most in_flight events waiting for their prediction
+    :return: predictions, time from sending to receiving per event
+    '''
+    slots = threading.Semaphore(in_flight)
+    sent = [0.] * len(events)
+
+    def send_all():
+        with open(fifo_name, 'wb') as fifo:
+            for i, hit_data in enumerate(events):
+                slots.acquire()
+                sent[i] = time.time()
+                write_message(fifo, [hit_data])
+
+    sender = threading.Thread(target=send_all, daemon=True)
+    sender.start()
+    predictions, times = [], []
+    with open(fifo_name + '_pred', 'rb') as fifo:
+        for i in range(len(events)):
+            predictions.append(read_message(fifo)[0])
+            times.append(time.time() - sent[i])
+            slots.release()
+    sender.join()
+    return predictions, times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f',
+                        '--fifo_name',
+                        type=str,
+                        default='/dev/shm/triton_test',
+                        help='Fifo name of the forward client')
+    parser.add_argument('-p',
+                        '--protocol',
+                        type=str,
+                        choices=['text', 'binary'],
+                        default='text',
+                        help='Protocol the forward client was started with')
+    parser.add_argument('-n',
+                        '--n_hits',
+                        type=int,
+                        default=100000,
+                        help='Number of hits per event')
+    parser.add_argument('-e',
+                        '--n_events',
+                        type=int,
+                        default=10,
+                        help='Number of events')
+    parser.add_argument('-i',
+                        '--in_flight',
+                        type=int,
+                        default=1,
+                        help='Number of events sent before waiting for a prediction (binary protocol only)')
+    FLAGS = parser.parse_args()
+
+    while not os.path.exists(FLAGS.fifo_name + '_pred'):
+        print('waiting for the forward client...')
+        time.sleep(1)
+
+    events = [np.random.rand(FLAGS.n_hits, 9).astype('float32') for _ in range(FLAGS.n_events)]
+    t_start = time.time()
+    if FLAGS.protocol == 'binary':
+        predictions, times = send_events_binary(FLAGS.fifo_name, events, FLAGS.in_flight)
+    else:
+        predictions, times = [], []
+        for hit_data in events:
+            t0 = time.time()
+            predictions.append(send_event_text(FLAGS.fifo_name, hit_data))
+            times.append(time.time() - t0)
+    total_time = time.time() - t_start
+
+    for i, (predicted, t) in enumerate(zip(predictions, times)):
+        print('event', i, predicted.shape, '%.3f s' % t) # one row per condensate
+
+    print(FLAGS.protocol, 'protocol,', FLAGS.n_hits, 'hits: mean round trip %.3f s, min %.3f s, %.1f events/s'
+          % (np.mean(times), np.min(times), FLAGS.n_events / total_time))
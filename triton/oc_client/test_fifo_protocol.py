@@ -0,0 +1,33 @@
+import io
+import unittest
+
+import numpy as np
+
+from fifo_protocol import read_message, write_message
+
+
+class FifoProtocolTestCases(unittest.TestCase):
+
+    def message(self):
+        f = io.BytesIO()
+        write_message(f, [np.random.rand(5, 9).astype('float32'), np.arange(5, dtype='int64')])
+        return f.getvalue()
+
+    def test_round_trip(self):
+        f = io.BytesIO(self.message() + self.message())
+        for _ in range(2):
+            arrays = read_message(f)
+            self.assertEqual([a.shape for a in arrays], [(5, 9), (5,)])
+            self.assertEqual([a.dtype for a in arrays], [np.dtype('<f4'), np.dtype('<i8')])
+        self.assertIsNone(read_message(f))
+
+    def test_truncated(self):
+        raw = self.message()
+        # anywhere after the first bytes, including inside an array header
+        for cut in range(1, len(raw)):
+            with self.assertRaises(EOFError):
+                read_message(io.BytesIO(raw[:cut]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import threading
+import unittest
+
+import numpy as np
+
+from triton_forward_client import (RequestPipeline, encode_row_splits, make_row_splits,
+                                   merge_events, split_condensates, decode_row_splits)
+
+
+def stub_model(hit_data, row_splits):
+    '''
+    Behaves like the deployed model (LayersRagged.Condensate): one output row per condensate
+    (here the hits with first feature > 0.7), and output_1 with a leading 0 followed by the
+    number of condensates per row split.
+    '''
+    splits = decode_row_splits(row_splits)
+    iscond = hit_data[:, 0] > 0.7
+    n_condensates = [np.sum(iscond[start:end]) for start, end in zip(splits[:-1], splits[1:])]
+    return hit_data[iscond], np.array([0] + n_condensates, dtype='int32').reshape(-1, 1)
+
+
+def make_events(n_events=6, seed=0):
+    rng = np.random.default_rng(seed)
+    events = []
+    for i in range(n_events):
+        data = rng.random((int(rng.integers(20, 60)), 4)).astype('float32')
+        data[:, 1] = i # tags the event
+        if i % 2:
+            events.append((data, make_row_splits(data)))
+        else: # two row splits in one event
+            events.append((data, encode_row_splits(np.array([0, len(data) // 3, len(data)]), len(data))))
+    return events
+
+
+class RequestPipelineTestCases(unittest.TestCase):
+
+    def test_split_condensates(self):
+        events = make_events()
+        data, rs, n_segments = merge_events(events)
+        predicted, n_condensates = stub_model(data, rs)
+        split = split_condensates(predicted, n_condensates, n_segments)
+        self.assertEqual(len(split), len(events))
+        for (event_data, event_rs), event_predicted in zip(events, split):
+            self.assertTrue(np.array_equal(event_predicted, stub_model(event_data, event_rs)[0]))
+
+    def test_count_mismatch(self):
+        events = make_events()
+        data, rs, n_segments = merge_events(events)
+        predicted, n_condensates = stub_model(data, rs)
+        with self.assertRaises(RuntimeError):
+            split_condensates(predicted, n_condensates[:-1], n_segments)
+        with self.assertRaises(RuntimeError):
+            split_condensates(predicted[:-1], n_condensates, n_segments)
+
+    def test_merged_pipeline(self):
+        events = make_events()
+        entered, release = threading.Event(), threading.Event()
+        request_sizes = []
+
+        def submit(hit_data, row_splits, done):
+            request_sizes.append(len(hit_data))
+            entered.set()
+            release.wait() # the dispatcher waits here, the other events queue up
+            done(*stub_model(hit_data, row_splits), None)
+
+        pipeline = RequestPipeline(submit, max_in_flight=1, merge_max_hits=10000)
+        pipeline.put(*events[0])
+        entered.wait()
+        for event in events[1:]:
+            pipeline.put(*event)
+        release.set()
+
+        for event in events:
+            self.assertTrue(np.array_equal(pipeline.get(), stub_model(*event)[0]))
+        self.assertEqual(len(request_sizes), 2) # the first event alone, then all others merged
+
+    def test_merged_error(self):
+        events = make_events()
+        entered, release = threading.Event(), threading.Event()
+
+        def submit(hit_data, row_splits, done):
+            entered.set()
+            release.wait()
+            predicted, n_condensates = stub_model(hit_data, row_splits)
+            done(predicted[:-1], n_condensates, None) # counts do not match the output
+
+        pipeline = RequestPipeline(submit, max_in_flight=1, merge_max_hits=10000)
+        pipeline.put(*events[0])
+        entered.wait()
+        for event in events[1:]:
+            pipeline.put(*event)
+        release.set()
+
+        self.assertEqual(len(pipeline.get()), len(stub_model(*events[0])[0]) - 1) # alone, passed through
+        for _ in events[1:]:
+            with self.assertRaises(RuntimeError):
+                pipeline.get()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,6 +35,9 @@ import random
 import glob
 import errno
 import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # ############# HACK #############
 # tritongrpcclient python api is currently limiting
@@ -56,9 +59,39 @@ import os
 #        f.write(fixed_init_file)
 # ############# HACK #############
 
-import tritongrpcclient
+try:
+    import tritongrpcclient
+except ImportError: # only needed if not running with --local_model
+    tritongrpcclient = None
+
+from fifo_protocol import read_message, write_message
+
+
+class LocalModelServer(object):
+    '''
+    Stand-in for the triton server: runs the saved model (the model.savedmodel directory of the
+    triton model repository) in this process with tensorflow. Useful to test and benchmark the
+    client without a triton deployment.
+    '''
+    def __init__(self, model_path):
+        import tensorflow as tf
+        self.tf = tf
+        self.model = tf.saved_model.load(model_path)
+        self.infer_fn = self.model.signatures['serving_default']
+
+    def request_eval(self, hit_data, row_splits):
+        '''
+        :return: condensates (output), number of condensates per row split (output_1)
+        '''
+        results = self.infer_fn(input_1=self.tf.constant(hit_data), input_2=self.tf.constant(row_splits))
+        return results['output'].numpy(), results['output_1'].numpy()
+
+    def request_eval_async(self, hit_data, row_splits, done, executor):
+        # tensorflow releases the GIL while running, so requests in threads run concurrently
+        future = executor.submit(self.request_eval, hit_data, row_splits)
+        future.add_done_callback(lambda f: done(None, None, f.exception()) if f.exception() is not None
+                                 else done(*f.result(), None))
 
-        
 
 def configure_triton_client(model_name):                
 
@@ -86,7 +119,7 @@ def get_statistics(triton_client):
         sys.exit(1)
     print('PASS: infer')
 
-def request_eval(hit_data,row_splits, triton_client, model_name):
+def make_request(hit_data, row_splits):
     
     np_rs_type = 'int64'
     tr_rs_type = 'INT64'
@@ -109,6 +142,12 @@ def request_eval(hit_data,row_splits, triton_client, model_name):
     #outputs.append(tritongrpcclient.InferRequestedOutput('predicted_final_condensates'))
     #outputs.append(tritongrpcclient.InferRequestedOutput('output_row_splits'))
     # predicted_final_1 doesn't matter
+    return inputs, outputs
+
+
+def request_eval(hit_data,row_splits, triton_client, model_name):
+    
+    inputs, outputs = make_request(hit_data, row_splits)
     
     results = triton_client.infer(
         model_name=model_name,
@@ -122,21 +161,243 @@ def request_eval(hit_data,row_splits, triton_client, model_name):
     
     #print('output',condensates,condensates.shape)
     return condensates
+
+
+def request_eval_async(hit_data, row_splits, triton_client, model_name, done):
+    '''
+    returns immediately, done(condensates, n_condensates, error) is called from a triton client thread
+    when finished. n_condensates is output_1, the number of condensates per row split after a leading 0.
+    '''
+    inputs, outputs = make_request(hit_data, row_splits)
+    
+    def callback(result, error):
+        if error is not None:
+            done(None, None, error)
+        else:
+            done(result.as_numpy('output'), result.as_numpy('output_1'), None)
+    
+    triton_client.async_infer(
+        model_name=model_name,
+        inputs=inputs,
+        callback=callback,
+        outputs=outputs
+        )
     
 
 def encode_prediction(data_arr):
-    enc=""
     shape = data_arr.shape
-    enc += str(shape[0])+" "+str(shape[1])+"\n"
-    #a = np.reshape(data_arr,[-1])
-    #white = ""
-    for a in data_arr:
-        white=""
-        for i in a:
-            enc += white+str(i)
-            white = " "
-        enc+='\n'
-    return enc
+    # joined once instead of growing the string per number
+    lines = [str(shape[0])+" "+str(shape[1])]
+    lines += [" ".join([str(i) for i in a]) for a in data_arr]
+    return "\n".join(lines)+"\n"
+
+
+def make_row_splits(data):
+    # the row splits are passed with one entry per hit, see the model config
+    rs = np.zeros((data.shape[0],1),dtype="int64")
+    rs[1] = max(data.shape[0],3)
+    rs[-1]=2
+    return rs
+
+
+def decode_row_splits(rs):
+    # the first entries are the row splits, the last entry is their number
+    return rs[:int(rs[-1,0]),0]
+
+
+def encode_row_splits(splits, n_hits):
+    rs = np.zeros((n_hits,1),dtype="int64")
+    rs[:len(splits),0] = splits
+    rs[-1,0] = len(splits)
+    return rs
+
+
+def merge_events(events):
+    '''
+    concatenates the hits of several events into one request, the row splits of the events are
+    concatenated with the corresponding offsets
+    :return: hit data, row splits, number of row splits (segments) per event
+    '''
+    n_hits = [len(data) for data, _ in events]
+    offsets = np.cumsum([0] + n_hits)
+    splits = [decode_row_splits(events[0][1])]
+    for (_, rs), offset in zip(events[1:], offsets[1:-1]):
+        splits.append(decode_row_splits(rs)[1:] + offset)
+    n_segments = [len(decode_row_splits(rs)) - 1 for _, rs in events]
+    splits = np.concatenate(splits)
+    data = np.concatenate([data for data, _ in events], axis=0)
+    return data, encode_row_splits(splits, len(data)), n_segments
+
+
+def split_condensates(predicted, n_condensates, n_segments):
+    '''
+    splits the output of a merged request back per event. The output has one row per condensate,
+    ordered by row split, and n_condensates (output_1) holds the number of condensates per row split
+    after a leading 0.
+    :param n_segments: number of row splits (segments) per event, as returned by merge_events
+    '''
+    n_condensates = np.reshape(n_condensates, (-1,))[1:]
+    if len(n_condensates) != sum(n_segments):
+        raise RuntimeError('split_condensates: the model returned condensate counts for '
+                           + str(len(n_condensates)) + ' row splits, the request had ' + str(sum(n_segments)))
+    seg_offsets = np.cumsum([0] + list(n_segments))
+    per_event = np.add.reduceat(n_condensates, seg_offsets[:-1]) # every event has at least one row split
+    offsets = np.cumsum(np.concatenate([[0], per_event]))
+    if offsets[-1] != len(predicted):
+        raise RuntimeError('split_condensates: the model returned ' + str(len(predicted))
+                           + ' condensates, but counts for ' + str(offsets[-1]))
+    return [predicted[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class RequestPipeline(object):
+    '''
+    Keeps up to max_in_flight requests running at the same time. If merge_max_hits > 0, events that
+    are already waiting are merged into one request up to this number of hits, and the output
+    (one row per condensate) is split back per event with the condensate counts per row split.
+    The predictions are returned in the order of the events.
+
+    :param submit: function(hit_data, row_splits, done) that starts one request and calls
+                   done(predicted, n_condensates, error) when it is finished
+    :param max_waiting: maximum number of events read but not yet sent, put blocks if reached
+    '''
+    def __init__(self, submit, max_in_flight=1, merge_max_hits=0, max_waiting=64):
+        self.submit = submit
+        self.merge_max_hits = merge_max_hits
+        self.in_flight = threading.Semaphore(max_in_flight)
+        self.waiting = queue.Queue(maxsize=max_waiting)
+        self.results = queue.Queue()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def put(self, hit_data, row_splits):
+        future = Future()
+        self.results.put(future)
+        self.waiting.put((hit_data, row_splits, future))
+
+    def get(self):
+        '''
+        blocks until the prediction of the next event in order is ready
+        '''
+        return self.results.get().result()
+
+    def _can_merge(self, data, rs):
+        # the row splits need to fit into the per-hit input_2 format
+        return len(data) >= 3 and len(decode_row_splits(rs)) < len(data)
+
+    def _next_request(self, carry):
+        events = [carry if carry is not None else self.waiting.get()]
+        carry = None
+        if self.merge_max_hits > 0 and self._can_merge(*events[0][:2]):
+            n_hits = len(events[0][0])
+            while n_hits < self.merge_max_hits:
+                try:
+                    event = self.waiting.get_nowait()
+                except queue.Empty:
+                    break
+                if n_hits + len(event[0]) > self.merge_max_hits or not self._can_merge(*event[:2]):
+                    carry = event
+                    break
+                events.append(event)
+                n_hits += len(event[0])
+        return events, carry
+
+    def _dispatch(self):
+        carry = None
+        while True:
+            events, carry = self._next_request(carry)
+            futures = [future for _, _, future in events]
+            if len(events) == 1:
+                data, rs, n_segments = events[0][0], events[0][1], None
+            else:
+                data, rs, n_segments = merge_events([event[:2] for event in events])
+
+            self.in_flight.acquire()
+            def done(predicted, n_condensates, error, futures=futures, n_segments=n_segments):
+                self.in_flight.release()
+                if error is None and n_segments is not None:
+                    try:
+                        predicted = split_condensates(predicted, n_condensates, n_segments)
+                    except Exception as e:
+                        error = e
+                if error is not None:
+                    for future in futures:
+                        future.set_exception(error if isinstance(error, Exception) else RuntimeError(str(error)))
+                elif n_segments is None:
+                    futures[0].set_result(predicted)
+                else:
+                    for future, event_predicted in zip(futures, predicted):
+                        future.set_result(event_predicted)
+            try:
+                self.submit(data, rs, done)
+            except Exception as e:
+                done(None, None, e)
+
+
+def read_events_text(fifo_name):
+    '''
+    text protocol: one event per opening of the pipe, the hit features as text matrix
+    '''
+    while True:
+        try:
+            with open(fifo_name) as fifo:
+                data = np.loadtxt(fifo)
+            data = np.array(data,dtype='float32')
+        except Exception as e:
+            print(e)
+            print('waiting for next data batch')
+            continue
+        yield data, make_row_splits(data)
+
+
+def read_events_binary(fifo_name):
+    '''
+    binary protocol (see fifo_protocol.py): any number of messages per opening of the pipe
+    '''
+    while True:
+        with open(fifo_name, 'rb') as fifo:
+            while True:
+                try:
+                    arrays = read_message(fifo)
+                except Exception as e:
+                    print(e)
+                    print('waiting for next data batch')
+                    break
+                if arrays is None:
+                    break
+                data = arrays[0]
+                rs = arrays[1] if len(arrays) > 1 else make_row_splits(data)
+                yield data, rs
+
+
+class PredictionWriter(object):
+    '''
+    text protocol: one opening of the pipe per event.
+    binary protocol: the pipe stays open, such that the reader can read several predictions
+    in a row. It is opened again if the reader closed it.
+    '''
+    def __init__(self, fifo_name, protocol):
+        self.fifo_name = fifo_name
+        self.protocol = protocol
+        self.fifo = None
+
+    def write(self, predicted):
+        if self.protocol != 'binary':
+            enc = encode_prediction(predicted)
+            with open(self.fifo_name,'w') as fifo:
+                fifo.write(enc)
+            return
+        while True:
+            if self.fifo is None:
+                self.fifo = open(self.fifo_name,'wb')
+            try:
+                write_message(self.fifo, [predicted])
+                return
+            except BrokenPipeError:
+                try:
+                    self.fifo.close()
+                except BrokenPipeError:
+                    pass
+                self.fifo = None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -162,6 +423,25 @@ if __name__ == '__main__':
                         required=False,
                         default='localhost:8001',
                         help='Inference server URL. Default is localhost:8001.')
+    parser.add_argument('-p',
+                        '--protocol',
+                        type=str,
+                        choices=['text', 'binary'],
+                        default='text',
+                        help='Data format on the pipes, see fifo_protocol.py for the binary format. Default is text.')
+    parser.add_argument('--local_model',
+                        type=str,
+                        required=False,
+                        default='',
+                        help='Run this saved model in-process instead of connecting to a triton server (e.g. for benchmarking)')
+    parser.add_argument('--max_in_flight',
+                        type=int,
+                        default=1,
+                        help='Maximum number of requests running at the same time. Default is 1.')
+    parser.add_argument('--merge_max_hits',
+                        type=int,
+                        default=0,
+                        help='Merge waiting events into one request up to this number of hits. Default is 0 (no merging).')
     
     
     FLAGS = parser.parse_args()
@@ -171,39 +451,35 @@ if __name__ == '__main__':
     
         
     model_name = FLAGS.model_name
-    triton_client = configure_triton_client(model_name = model_name)
+    if len(FLAGS.local_model):
+        local_server = LocalModelServer(FLAGS.local_model)
+        executor = ThreadPoolExecutor(max_workers=FLAGS.max_in_flight)
+        submit = lambda data, rs, done: local_server.request_eval_async(data, rs, done, executor)
+    else:
+        triton_client = configure_triton_client(model_name = model_name)
+        submit = lambda data, rs, done: request_eval_async(data, rs, triton_client, model_name, done)
     
     
     print('Triton forward client started. Waiting for data...')
     
     os.mkfifo(FIFO)
     os.mkfifo(FIFO_out)
+    read_events = read_events_binary if FLAGS.protocol == 'binary' else read_events_text
+    pipeline = RequestPipeline(submit, max_in_flight=FLAGS.max_in_flight, merge_max_hits=FLAGS.merge_max_hits)
+    
+    # events are read in a separate thread, such that more events can be requested while
+    # the predictions are written back in order
+    def read_all():
+        for data, rs in read_events(FIFO):
+            print('request eval')
+            pipeline.put(data, rs)
+    reader = threading.Thread(target=read_all, daemon=True)
+    reader.start()
+    
+    writer = PredictionWriter(FIFO_out, FLAGS.protocol)
     while True:
-        try:
-            with open(FIFO) as fifo:
-                data = np.loadtxt(fifo)
-                
-            data = np.array(data,dtype='float32')
-            rs = np.zeros((data.shape[0],1),dtype="int64")
-            rs[1] = max(data.shape[0],3)
-            rs[-1]=2
-            
-        except Exception as e:
-            print(e)
-            print('waiting for next data batch')
-            continue
-        
-        print('request eval')
-        predicted = request_eval(data,rs, triton_client, model_name)
+        predicted = pipeline.get()
         
-        enc = encode_prediction(predicted)
-        #print(enc)
-        with open(FIFO_out,'w') as fifo:
-            fifo.write(enc)
+        writer.write(predicted)
             
         print('result ready')
-                
-    
-    
-    
-    